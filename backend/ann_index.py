@@ -0,0 +1,242 @@
+import logging
+import pathlib
+from typing import Any
+
+import numpy as np
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+
+from .vector_store import NumpyVectorStore, _atomic_save
+
+
+def kmeans(
+    data: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """spherical k-means (cosine similarity) on L2 normalized rows,
+    returns the normalized centroids and the cluster assignment of each row
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    assignments = np.zeros(len(data), dtype=np.int32)
+    for _ in range(n_iter):
+        assignments = np.argmax(data @ centroids.T, axis=1).astype(np.int32)
+        centroids = np.zeros_like(centroids)
+        np.add.at(centroids, assignments, data)
+        # re-seed empty clusters with random rows
+        empty = np.flatnonzero(np.bincount(assignments, minlength=n_clusters) == 0)
+        centroids[empty] = data[rng.integers(len(data), size=len(empty))]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32), assignments
+
+
+class IVFVectorStore(NumpyVectorStore):
+    """Approximate nearest neighbour search with an inverted file index.
+
+    The embeddings are clustered with k-means, a query only scores the rows of
+    the n_probe clusters with the most similar centroids. Recall and latency are
+    tuned with n_lists and n_probe. Below min_train_size rows the search is
+    exact. New rows are assigned to their nearest centroid, the clustering is
+    retrained once the store grew by retrain_factor since the last training.
+    Queries restricted to the documents of a session score their rows exactly.
+    """
+
+    centroids_fname = "ivf_centroids.npy"
+    assignments_fname = "ivf_assignments.npy"
+    max_train_samples = 20_000
+
+    def __init__(
+        self,
+        embeddings: np.ndarray | None = None,
+        node_ids: list[str] | None = None,
+        ref_doc_ids: list[str] | None = None,
+        n_lists: int | None = None,
+        n_probe: int = 8,
+        min_train_size: int = 10_000,
+        retrain_factor: float = 2.0,
+    ) -> None:
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+        self._centroids: np.ndarray | None = None
+        self._trained_size = 0
+        self._lists: list[np.ndarray] = []
+        super().__init__(embeddings, node_ids, ref_doc_ids)
+
+    def _reset(self, *args: Any, **kwargs: Any) -> None:
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._lists_outdated = True
+        super()._reset(*args, **kwargs)
+
+    def _append(
+        self, embeddings: np.ndarray, node_ids: list[str], ref_doc_ids: list[str]
+    ) -> None:
+        super()._append(embeddings, node_ids, ref_doc_ids)
+        # new rows are assigned lazily, in one batch before the next query
+        self._assignments = np.concatenate(
+            [self._assignments, np.full(len(node_ids), -1, dtype=np.int32)]
+        )
+        self._lists_outdated = True
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    def _rows(self, rows: np.ndarray) -> np.ndarray:
+        """gathers the embeddings of the given rows from all blocks"""
+        offsets = np.cumsum([0] + [len(block) for block in self._blocks])
+        result = np.empty((len(rows), self.dim or 0), dtype=np.float32)
+        block_of_row = np.searchsorted(offsets, rows, side="right") - 1
+        for block_index, block in enumerate(self._blocks):
+            selected = block_of_row == block_index
+            if selected.any():
+                result[selected] = block[rows[selected] - offsets[block_index]]
+        return result
+
+    def train(self) -> None:
+        alive_rows = np.flatnonzero(self._alive)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(alive_rows))))
+        # k-means on a sample is sufficient and keeps the training time bounded
+        rng = np.random.default_rng(0)
+        n_samples = min(len(alive_rows), 32 * n_lists, self.max_train_samples)
+        sample_rows = np.sort(rng.choice(alive_rows, n_samples, replace=False))
+        self._centroids, _ = kmeans(self._rows(sample_rows), n_lists)
+        self._assignments[:] = -1
+        self._lists_outdated = True
+        self._trained_size = len(alive_rows)
+        logging.info(
+            f"trained ivf index with {n_lists} lists on {len(alive_rows)} rows"
+        )
+
+    def _assign_pending(self) -> None:
+        pending = np.flatnonzero(self._assignments < 0)
+        batch_size = 8192
+        for start in range(0, len(pending), batch_size):
+            rows = pending[start : start + batch_size]
+            self._assignments[rows] = np.argmax(
+                self._rows(rows) @ self._centroids.T, axis=1  # type: ignore
+            )
+
+    def _build_lists(self) -> None:
+        n_lists = len(self._centroids)  # type: ignore
+        order = np.argsort(self._assignments, kind="stable")
+        counts = np.bincount(self._assignments, minlength=n_lists)
+        self._lists = np.split(order, np.cumsum(counts)[:-1])
+        self._lists_outdated = False
+
+    def _ensure_index(self) -> bool:
+        """(re)trains and updates the inverted lists if needed, returns False if
+        the store is too small for approximate search
+        """
+        n_alive = len(self)
+        if n_alive < self.min_train_size:
+            return False
+        if not self.trained or n_alive > self._trained_size * self.retrain_factor:
+            self.train()
+        if self._lists_outdated:
+            self._assign_pending()
+            self._build_lists()
+        return True
+
+    def _probe(self, query_embedding: np.ndarray, n_probe: int) -> np.ndarray:
+        """rows of the n_probe clusters with the most similar centroids"""
+        n_probe = min(n_probe, len(self._lists))
+        centroid_scores = self._centroids @ query_embedding  # type: ignore
+        probed = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        return np.concatenate([self._lists[cluster] for cluster in probed])
+
+    def _candidate_rows(
+        self, query: VectorStoreQuery, query_embedding: np.ndarray, n_probe: int
+    ) -> np.ndarray:
+        """rows to score: the documents of a session (doc_ids or node_ids) are
+        searched exactly, if they have fewer rows than the probed clusters, else
+        clusters are probed until similarity_top_k rows pass the filter
+        """
+        mask = self._candidate_mask(query)
+        if query.doc_ids is not None or query.node_ids is not None:
+            filtered_rows = np.flatnonzero(mask)
+            if len(filtered_rows) <= len(self) * n_probe / len(self._lists):
+                return filtered_rows
+        while True:
+            rows = self._probe(query_embedding, n_probe)
+            rows = rows[mask[rows]]
+            if len(rows) >= query.similarity_top_k or n_probe >= len(self._lists):
+                return rows
+            n_probe *= 2
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None or not self._ensure_index():
+            return super().query(query, **kwargs)
+        query_embedding = self._normalize(
+            np.asarray([query.query_embedding], dtype=np.float32)
+        )[0]
+        rows = self._candidate_rows(
+            query, query_embedding, kwargs.get("n_probe", self.n_probe)
+        )
+        top_k = min(query.similarity_top_k, len(rows))
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        scores = self._rows(rows) @ query_embedding
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=scores[best].tolist(),
+            ids=[self._node_ids[row] for row in rows[best]],
+        )
+
+    def recall_at_k(self, query_embeddings: np.ndarray, k: int = 10) -> float:
+        """mean fraction of the exact top-k neighbours, which are found by the
+        approximate search
+        """
+        recalls = []
+        for query_embedding in query_embeddings:
+            query = VectorStoreQuery(
+                query_embedding=list(query_embedding), similarity_top_k=k
+            )
+            exact = set(NumpyVectorStore.query(self, query).ids or [])
+            if exact:
+                approximate = set(self.query(query).ids or [])
+                recalls.append(len(exact & approximate) / len(exact))
+        return float(np.mean(recalls)) if recalls else 1.0
+
+    def compact(self) -> None:
+        alive_rows = np.flatnonzero(self._alive)
+        assignments = self._assignments[alive_rows]
+        super().compact()
+        self._assignments = assignments
+        self._lists_outdated = True
+
+    def persist(self, persist_path: str, fs: Any | None = None) -> None:
+        self.compact()
+        assignments = self._assignments
+        super().persist(persist_path, fs)
+        # the reload of the memory-mapped matrix resets the assignments
+        self._assignments = assignments
+        self._lists_outdated = True
+        if self.trained:
+            persist_dir = pathlib.Path(persist_path).parent
+            _atomic_save(persist_dir / self.centroids_fname, self._centroids)
+            _atomic_save(persist_dir / self.assignments_fname, self._assignments)
+
+    @classmethod
+    def from_persist_dir(
+        cls, persist_dir: str | pathlib.Path, **kwargs: Any
+    ) -> "IVFVectorStore":
+        persist_dir = pathlib.Path(persist_dir)
+        exact_store = NumpyVectorStore.from_persist_dir(persist_dir)
+        store = cls(**kwargs)
+        store._reset(
+            exact_store._blocks[0] if exact_store._blocks else None,
+            exact_store._node_ids,
+            exact_store._ref_doc_ids,
+        )
+        centroids_file = persist_dir / cls.centroids_fname
+        assignments_file = persist_dir / cls.assignments_fname
+        if centroids_file.exists() and assignments_file.exists():
+            assignments = np.load(assignments_file)
+            if len(assignments) == len(store._assignments):
+                store._centroids = np.load(centroids_file)
+                store._assignments = assignments
+                store._trained_size = len(store)
+        return store
@@ -0,0 +1,134 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+
+import numpy as np
+
+
+class CachedAnswer(str):
+    """an answer, which was served from the answer cache"""
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+class SemanticAnswerCache:
+    """LRU cache with TTL for answers to self-contained questions.
+
+    Entries are keyed by the index version (the searchable documents and the
+    answer settings) and the normalized question. A lookup first tries the exact
+    normalized question, which needs no embedding, then the cached question of
+    the same index version with the most similar embedding, if the cosine
+    similarity reaches similarity_threshold.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: float = 3600,
+        similarity_threshold: float = 0.95,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        # (index version, normalized question) -> (embedding, answer, created)
+        self.entries: OrderedDict[
+            tuple[str, str], tuple[np.ndarray | None, str, float]
+        ] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _expired(self, created: float) -> bool:
+        return time.monotonic() - created > self.ttl_seconds
+
+    def _get_similar(
+        self, embedding: np.ndarray, index_version: str
+    ) -> tuple[str, str] | None:
+        with self._lock:
+            candidates = [
+                (key, entry[0])
+                for key, entry in self.entries.items()
+                if key[0] == index_version
+                and entry[0] is not None
+                and not self._expired(entry[2])
+            ]
+        if not candidates:
+            return None
+        similarities = np.stack([e for _, e in candidates]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return candidates[best][0]
+
+    def lookup(
+        self,
+        question: str,
+        index_version: str,
+        embed: Callable[[str], list[float]] | None,
+    ) -> tuple[CachedAnswer | None, np.ndarray | None]:
+        """returns the cached answer (or None) and the question embedding, if it
+        had to be computed, for storing the answer with put. Without embed only
+        the exact normalized question is looked up.
+        """
+        key: tuple[str, str] | None = (index_version, normalize_question(question))
+        embedding = None
+        with self._lock:
+            entry = self.entries.get(key)  # type: ignore
+        if entry is None or self._expired(entry[2]):
+            if embed is None:
+                key = None
+            else:
+                embedding = _normalize(np.asarray(embed(question), dtype=np.float32))
+                key = self._get_similar(embedding, index_version)
+        with self._lock:
+            if key is not None and (entry := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                logging.debug(f"answer cache hit for: {question}")
+                return CachedAnswer(entry[1]), embedding
+            self.misses += 1
+        return None, embedding
+
+    def put(
+        self,
+        question: str,
+        index_version: str,
+        answer: str,
+        embedding: np.ndarray | None = None,
+    ) -> None:
+        key = (index_version, normalize_question(question))
+        with self._lock:
+            self.entries[key] = (embedding, str(answer), time.monotonic())
+            self.entries.move_to_end(key)
+            for expired_key in [
+                k for k, entry in self.entries.items() if self._expired(entry[2])
+            ]:
+                del self.entries[expired_key]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, index_version: str) -> None:
+        """drops all answers of the index version"""
+        with self._lock:
+            for key in [k for k in self.entries if k[0] == index_version]:
+                del self.entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses}
+
+
+def _normalize(embedding: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+
+class ConcurrencyLimiter:
+    """Limits the number of chats, which run concurrently in this process.
+
+    Further requests wait in first-come first-served order (asyncio.Semaphore
+    is fair), the counters show how many requests run, wait and how long they
+    waited.
+    """
+
+    def __init__(self, max_concurrent: int = 32) -> None:
+        self.max_concurrent = max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def __aenter__(self) -> "ConcurrencyLimiter":
+        start = time.monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        wait_seconds = time.monotonic() - start
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.active -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        started = self.completed + self.active
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "completed": self.completed,
+            "mean_wait_seconds": self.total_wait_seconds / started if started else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
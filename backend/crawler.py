@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import time
+import xml.etree.ElementTree as ElementTree
+from collections.abc import AsyncIterator, Callable
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+from .helpers import normalize_url
+from .http_cache import HttpResponse
+from .ingestion_cache import IngestionCache
+
+CRAWL_MODES = ("seed", "list", "sitemap")
+# links to these files are not followed
+SKIPPED_EXTENSIONS = (
+    ".pdf", ".zip", ".gz", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp",
+    ".ico", ".css", ".js", ".mp3", ".mp4", ".avi", ".woff", ".woff2", ".xml",
+)  # fmt: skip
+
+
+@dataclass
+class CrawledPage:
+    url: str
+    content: bytes
+    content_hash: str
+    depth: int = 0
+
+    @property
+    def host(self) -> str:
+        return urlsplit(self.url).netloc
+
+
+class LinkParser(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.links: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag == "a" and (href := dict(attrs).get("href")):
+            self.links.append(href)
+
+
+def extract_links(content: bytes, base_url: str) -> list[str]:
+    """absolute http(s) links of an html page, without fragments"""
+    parser = LinkParser()
+    parser.feed(content.decode("utf-8", errors="replace"))
+    links = []
+    for href in parser.links:
+        url = urljoin(base_url, href.strip()).split("#")[0]
+        parts = urlsplit(url)
+        if parts.scheme in ("http", "https") and not parts.path.lower().endswith(
+            SKIPPED_EXTENSIONS
+        ):
+            links.append(url)
+    return links
+
+
+def parse_sitemap(content: bytes) -> tuple[list[str], list[str]]:
+    """page urls and nested sitemap urls (of a sitemap index) of a sitemap"""
+    root = ElementTree.fromstring(content)
+    pages, sitemaps = [], []
+    for element in root.iter():
+        # {http://www.sitemaps.org/schemas/sitemap/0.9}loc
+        if element.tag.rsplit("}", 1)[-1] != "loc" or not element.text:
+            continue
+        if root.tag.rsplit("}", 1)[-1] == "sitemapindex":
+            sitemaps.append(element.text.strip())
+        else:
+            pages.append(element.text.strip())
+    return pages, sitemaps
+
+
+class HostLimiter:
+    """at most max_concurrency requests to the host at a time, started at most
+    rate times per second
+    """
+
+    def __init__(self, max_concurrency: int, rate: float) -> None:
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self) -> None:
+        await self.semaphore.acquire()
+        try:
+            async with self._lock:
+                now = time.monotonic()
+                wait = self.next_start - now
+                self.next_start = max(now, self.next_start) + self.interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.semaphore.release()
+
+
+class HostStats:
+    def __init__(self) -> None:
+        self.pages = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.ingested = 0
+        self.bytes = 0
+        self.started: float | None = None
+        self.finished: float | None = None
+
+    def to_dict(self) -> dict:
+        seconds = (
+            self.finished - self.started
+            if self.started is not None and self.finished is not None
+            else 0.0
+        )
+        return {
+            "pages": self.pages,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "ingested": self.ingested,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(self.pages / seconds, 2) if seconds else 0.0,
+        }
+
+
+class Crawler:
+    """Fetches many pages concurrently for the ingestion.
+
+    The urls are a seed url, whose links are followed (on the same host, up to
+    max_depth), a list of urls or sitemaps. Pages are fetched on asyncio tasks,
+    the blocking fetch (e.g. the pooled and cached CachedHttpFetcher) runs in
+    threads. Every host gets its own concurrency and rate limit. Urls are
+    deduplicated by their canonical form (normalize_url), pages by the hash of
+    their content. Fetch errors are counted per host and do not stop the crawl.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], HttpResponse],
+        max_pages: int = 50,
+        max_depth: int = 1,
+        max_concurrency: int = 16,
+        host_concurrency: int = 4,
+        host_rate: float = 5.0,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> None:
+        self.fetch = fetch
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.max_concurrency = max_concurrency
+        self.host_concurrency = host_concurrency
+        self.host_rate = host_rate
+        # called before each request, e.g. to stop a cancelled ingestion job
+        self.stage_callback = stage_callback
+        self.hosts: dict[str, HostStats] = {}
+        self.limiters: dict[str, HostLimiter] = {}
+        self.seen_urls: set[str] = set()
+        self.seen_hashes: set[str] = set()
+
+    def _host(self, url: str) -> str:
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostStats()
+            self.limiters[host] = HostLimiter(self.host_concurrency, self.host_rate)
+        return host
+
+    async def _fetch(self, url: str) -> HttpResponse | None:
+        if self.stage_callback:
+            self.stage_callback("crawl")
+        host = self._host(url)
+        stats = self.hosts[host]
+        async with self.limiters[host]:
+            if stats.started is None:
+                stats.started = time.monotonic()
+            try:
+                response = await asyncio.to_thread(self.fetch, url)
+            except Exception as e:
+                stats.errors += 1
+                logging.debug(f"crawling {url} failed: {e}")
+                return None
+            finally:
+                stats.finished = time.monotonic()
+        stats.pages += 1
+        stats.bytes += len(response.content)
+        return response
+
+    async def sitemap_urls(self, sitemap_url: str, max_nesting: int = 3) -> list[str]:
+        """page urls of a sitemap and its nested sitemaps, up to max_pages"""
+        pages: list[str] = []
+        sitemaps = [(sitemap_url, 0)]
+        while sitemaps and len(pages) < self.max_pages:
+            url, nesting = sitemaps.pop(0)
+            if not (response := await self._fetch(url)):
+                continue
+            try:
+                new_pages, nested = parse_sitemap(response.content)
+            except ElementTree.ParseError:
+                self.hosts[self._host(url)].errors += 1
+                logging.debug(f"{url} is no valid sitemap")
+                continue
+            pages.extend(new_pages)
+            if nesting < max_nesting:
+                sitemaps.extend((nested_url, nesting + 1) for nested_url in nested)
+        return pages[: self.max_pages]
+
+    def _enqueue(self, queue: asyncio.Queue, url: str, depth: int) -> None:
+        if len(self.seen_urls) >= self.max_pages:
+            return
+        if (canonical := normalize_url(url)) in self.seen_urls:
+            return
+        self.seen_urls.add(canonical)
+        queue.put_nowait((url, depth))
+
+    async def _worker(
+        self, queue: asyncio.Queue, pages: asyncio.Queue, follow_links: bool
+    ) -> None:
+        while True:
+            url, depth = await queue.get()
+            try:
+                if not (response := await self._fetch(url)):
+                    continue
+                content_hash = IngestionCache.hash_bytes(response.content)
+                if content_hash in self.seen_hashes:
+                    self.hosts[self._host(url)].duplicates += 1
+                    continue
+                self.seen_hashes.add(content_hash)
+                await pages.put(CrawledPage(url, response.content, content_hash, depth))
+                content_type = response.headers.get("content-type", "text/html")
+                if follow_links and depth < self.max_depth and "html" in content_type:
+                    host = urlsplit(url).netloc
+                    for link in extract_links(response.content, url):
+                        if urlsplit(link).netloc == host:
+                            self._enqueue(queue, link, depth + 1)
+            finally:
+                queue.task_done()
+
+    async def crawl(
+        self, urls: list[str], mode: str = "seed"
+    ) -> AsyncIterator[CrawledPage]:
+        """yields the new pages as soon as they are fetched"""
+        if mode not in CRAWL_MODES:
+            raise ValueError(f"unknown crawl mode: {mode}")
+        if mode == "sitemap":
+            urls = [url for sitemap in urls for url in await self.sitemap_urls(sitemap)]
+        queue: asyncio.Queue = asyncio.Queue()
+        pages: asyncio.Queue = asyncio.Queue()
+        for url in urls:
+            self._enqueue(queue, url, 0)
+        workers = [
+            asyncio.create_task(self._worker(queue, pages, mode == "seed"))
+            for _ in range(self.max_concurrency)
+        ]
+        done = asyncio.create_task(queue.join())
+        try:
+            while not (done.done() and pages.empty()):
+                next_page = asyncio.create_task(pages.get())
+                await asyncio.wait(
+                    {next_page, done, *workers}, return_when=asyncio.FIRST_COMPLETED
+                )
+                for worker in workers:
+                    # an exception of the stage callback, e.g. a cancelled job
+                    if worker.done() and worker.exception():
+                        next_page.cancel()
+                        raise worker.exception()  # type: ignore
+                if next_page.done():
+                    yield next_page.result()
+                else:
+                    next_page.cancel()
+        finally:
+            for task in [*workers, done]:
+                task.cancel()
+            await asyncio.gather(*workers, done, return_exceptions=True)
+
+    async def crawl_batches(
+        self, urls: list[str], mode: str = "seed", batch_size: int = 8
+    ) -> AsyncIterator[list[CrawledPage]]:
+        """the new pages in batches of batch_size, the crawl continues while the
+        consumer processes a batch
+        """
+        batch: list[CrawledPage] = []
+        async for page in self.crawl(urls, mode):
+            batch.append(page)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def record_ingestion(self, page: CrawledPage, failed: bool = False) -> None:
+        stats = self.hosts[self._host(page.url)]
+        if failed:
+            stats.errors += 1
+        else:
+            stats.ingested += 1
+
+    def stats(self) -> dict:
+        hosts = {host: stats.to_dict() for host, stats in self.hosts.items()}
+        return {
+            "pages": sum(stats["pages"] for stats in hosts.values()),
+            "errors": sum(stats["errors"] for stats in hosts.values()),
+            "duplicates": sum(stats["duplicates"] for stats in hosts.values()),
+            "ingested": sum(stats["ingested"] for stats in hosts.values()),
+            "hosts": hosts,
+        }
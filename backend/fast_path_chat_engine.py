@@ -0,0 +1,79 @@
+import logging
+import re
+import threading
+
+from llama_index.chat_engine.condense_question import CondenseQuestionChatEngine
+from llama_index.llms import ChatMessage
+
+# words which usually refer to something earlier in the conversation
+REFERENCE_WORDS = frozenset(
+    """it its itself they them their theirs themselves he him his she her hers
+    this that these those there then former latter above previous previously
+    earlier aforementioned same more else another other again too also""".split()
+)
+FOLLOW_UP_STARTS = frozenset({"and", "but", "or", "so", "what about", "how about"})
+
+
+def needs_condensing(question: str) -> bool:
+    """cheap heuristic, whether the question refers to the chat history
+    (pronouns, demonstratives or an elliptic follow-up like "and why?")
+    """
+    stripped = question.strip()
+    if stripped.startswith(("...", "…")) or stripped.endswith(("...", "…")):
+        return True
+    words = re.findall(r"[\w']+", stripped.lower())
+    if len(words) <= 2:
+        return True
+    if words[0] in FOLLOW_UP_STARTS or " ".join(words[:2]) in FOLLOW_UP_STARTS:
+        return True
+    return any(word in REFERENCE_WORDS for word in words)
+
+
+class FastPathCondenseQuestionChatEngine(CondenseQuestionChatEngine):
+    """Skips the condense question llm call, when the chat history is empty or
+    the question is self-contained (see needs_condensing), the question is then
+    used as query unchanged.
+    """
+
+    n_turns = 0
+    n_skipped = 0
+    _stats_lock = threading.Lock()
+
+    @classmethod
+    def _count_turn(cls, skipped: bool) -> None:
+        with cls._stats_lock:
+            FastPathCondenseQuestionChatEngine.n_turns += 1
+            FastPathCondenseQuestionChatEngine.n_skipped += int(skipped)
+
+    def _skip_condensing(
+        self, chat_history: list[ChatMessage], last_message: str
+    ) -> bool:
+        skip = not chat_history or not needs_condensing(last_message)
+        self._count_turn(skip)
+        if skip:
+            logging.debug(f"not condensing self-contained question: {last_message}")
+        return skip
+
+    def _condense_question(
+        self, chat_history: list[ChatMessage], last_message: str
+    ) -> str:
+        if self._skip_condensing(chat_history, last_message):
+            return last_message
+        return super()._condense_question(chat_history, last_message)
+
+    async def _acondense_question(
+        self, chat_history: list[ChatMessage], last_message: str
+    ) -> str:
+        if self._skip_condensing(chat_history, last_message):
+            return last_message
+        return await super()._acondense_question(chat_history, last_message)
+
+    @classmethod
+    def stats(cls) -> dict:
+        n_turns = FastPathCondenseQuestionChatEngine.n_turns
+        n_skipped = FastPathCondenseQuestionChatEngine.n_skipped
+        return {
+            "turns": n_turns,
+            "skipped": n_skipped,
+            "skipped_fraction": n_skipped / n_turns if n_turns else 0.0,
+        }
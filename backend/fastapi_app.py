@@ -1,16 +1,23 @@
 # command to run: uvicorn backend.fastapi_app:app --reload
+import asyncio
 import os
 import re
 import logging
 import sys
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException, UploadFile, Form
-from llama_index import ServiceContext
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from llama_index.callbacks import TokenCountingHandler
 from requests.exceptions import MissingSchema
 from dotenv import load_dotenv
 import errno
 import certifi
+from collections import Counter
+from collections.abc import AsyncIterator, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import sentry_sdk
 
@@ -18,24 +25,44 @@ from .script_RAG import (
     AITextDocument,
     AIPdfDocument,
     AIHtmlDocument,
+    CustomLlamaIndexChatEngineWrapper,
+    load_and_split,
     set_up_text_chatbot,
 )
 from .script_SQL_querying import (
     AIDataBase,
+    CustomTokenCounter,
+    DataChatBotWrapper,
     set_up_database_chatbot,
 )
+from .answer_cache import CachedAnswer
+from .concurrency import ConcurrencyLimiter
+from .crawler import CRAWL_MODES, CrawledPage, Crawler
+from .fast_path_chat_engine import FastPathCondenseQuestionChatEngine
+from .ingestion_jobs import IngestionJob, IngestionJobQueue
+from .pdf_pages import get_pool, shutdown_pool
+from .quiz import QuizGenerator, QuizPool
+from .session_pool import DEFAULT_SESSION_ID, ChatSession, SessionPool
+from .single_flight import SingleFlight
 from .models import (
+    BulkUploadSummaryModel,
+    CrawlRequestModel,
+    CrawlSummaryModel,
     DoubleUploadException,
     NoUploadException,
     EmptyQuestionException,
+    IngestionJobModel,
+    JobCancelledException,
+    MetricsModel,
     TextSummaryModel,
+    UploadTooLargeException,
     QuestionModel,
     QAResponseModel,
     TextResponseModel,
     MultipleChoiceTest,
     ErrorResponse,
 )
-from .helpers import load_aws_secrets
+from .helpers import format_sse, load_aws_secrets, normalize_url, save_upload_file
 
 # workaround for mac to solve "SSL: CERTIFICATE_VERIFY_FAILED Error"
 os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
@@ -70,111 +97,452 @@ cfd = Path(__file__).parent
 data_dir = "data"
 logging.info(f"Current fastapiapp dir : {cfd}")
 
-# Set-up Chat Engine:
+# Set-up Chat Engine per client session (X-Session-ID header):
 # - LlamaIndex CondenseQuestionChatEngine with RetrieverQueryEngine for text files
 # - or querying a database with langchain SQLDatabaseChain and Runnables
-app.state.chat_engine = None
-app.state.callback_manager = None
-app.state.token_counter = None
+# text sessions share one vector index, idle sessions are evicted (LRU)
+app.state.sessions = SessionPool(
+    max_sessions=int(os.getenv("MAX_SESSIONS", 100)),
+    max_bytes=int(os.getenv("MAX_SESSIONS_MB", 512)) * 1024**2,
+)
+
+# llm calls of the chats are awaited, at most MAX_CONCURRENT_CHATS at a time
+app.state.chat_limiter = ConcurrencyLimiter(int(os.getenv("MAX_CONCURRENT_CHATS", 32)))
 
+# documents are loaded, split, enriched and embedded in background worker threads
+app.state.ingestion_jobs = IngestionJobQueue(
+    max_workers=int(os.getenv("INGESTION_WORKERS", 2))
+)
+# concurrent uploads of the same url or file content load the document once
+app.state.upload_flight = SingleFlight()
+# quizzes are generated in the background after a document was added and kept
+# per index version, /quiz serves them from the pool
+MAX_QUIZ_SIZE = int(os.getenv("MAX_QUIZ_SIZE", 20))
+app.state.quiz_pool = QuizPool(
+    QuizGenerator(
+        llm_name=LLM_NAME,
+        max_parallel_calls=int(os.getenv("QUIZ_PARALLEL_CALLS", 8)),
+    ),
+    pool_size=int(os.getenv("QUIZ_POOL_SIZE", 2)),
+    max_workers=int(os.getenv("QUIZ_WORKERS", 2)),
+)
 
-def load_text_chat_engine() -> None:
-    if not app.state.chat_engine or app.state.chat_engine.data_category == "database":
-        logging.debug("setting up text chatbot")
+# crawls fetch the pages concurrently with per host limits, the pages are added
+# in batches, the documents of a batch are built in parallel
+MAX_CRAWL_PAGES = int(os.getenv("MAX_CRAWL_PAGES", 500))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 16))
+CRAWL_HOST_CONCURRENCY = int(os.getenv("CRAWL_HOST_CONCURRENCY", 4))
+CRAWL_HOST_RATE = float(os.getenv("CRAWL_HOST_RATE", 5))
+CRAWL_BATCH_SIZE = int(os.getenv("CRAWL_BATCH_SIZE", 8))
+
+# bulk uploads load and split the files in the worker processes of the parse
+# pool (pdf parsing is cpu bound), the files of a batch are embedded, inserted
+# and persisted together
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 16))
+MAX_BULK_FILES = int(os.getenv("MAX_BULK_FILES", 200))
+BULK_DOCUMENT_TYPES = {"txt": AITextDocument, "pdf": AIPdfDocument}
+
+DocumentLoader = Callable[..., AITextDocument | AIDataBase]
+# loader and the key, which identifies uploads of the same content
+Upload = tuple[DocumentLoader, str]
+
+# maximum upload size in bytes per file type
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 100)) * 1024**2
+MAX_DATABASE_UPLOAD_BYTES = int(os.getenv("MAX_DATABASE_UPLOAD_MB", 1024)) * 1024**2
+UPLOAD_LIMITS = {
+    "txt": MAX_UPLOAD_BYTES,
+    "pdf": MAX_UPLOAD_BYTES,
+    "sqlite": MAX_DATABASE_UPLOAD_BYTES,
+    "db": MAX_DATABASE_UPLOAD_BYTES,
+}
+
+
+@app.on_event("shutdown")
+def shutdown_ingestion_jobs() -> None:
+    app.state.ingestion_jobs.shutdown()
+    app.state.quiz_pool.shutdown()
+    shutdown_pool()
+
+
+def get_session(x_session_id: str = Header(DEFAULT_SESSION_ID)) -> ChatSession:
+    return app.state.sessions.get(x_session_id)
+
+
+def load_text_chat_engine(session: ChatSession) -> None:
+    if not session.chat_engine or session.chat_engine.data_category == "database":
+        logging.debug(f"setting up text chatbot for session {session.session_id}")
         logging.debug(f"Debug: {DEBUG_MODE}")
-        (
-            app.state.chat_engine,
-            app.state.callback_manager,
-            app.state.token_counter,
-        ) = set_up_text_chatbot()
+        session.set_chat_engine(*set_up_text_chatbot())
+
+
+def load_database_chat_engine(session: ChatSession) -> None:
+    if not session.chat_engine or session.chat_engine.data_category != "database":
+        logging.debug(f"setting up database chatbot for session {session.session_id}")
+        # the callback manager is None in database mode
+        session.set_chat_engine(*set_up_database_chatbot())
 
 
-def load_database_chat_engine() -> None:
-    if not app.state.chat_engine or app.state.chat_engine.data_category != "database":
-        logging.debug("setting up database chatbot")
-        (
-            app.state.chat_engine,
-            app.state.callback_manager,  # is None in database mode
-            app.state.token_counter,
-        ) = set_up_database_chatbot()
+def load_database(uri: str, stage_callback: Callable[[str], None]) -> AIDataBase:
+    stage_callback("load")
+    return AIDataBase.from_uri(uri)
 
 
 async def handle_uploadfile(
-    upload_file: UploadFile,
-) -> AITextDocument | AIDataBase | AIPdfDocument | None:
+    upload_file: UploadFile, session: ChatSession
+) -> Upload | None:
+    """saves the uploaded file and returns a loader, which builds the document
+    in the ingestion job
+    """
     if not (file_name := Path(upload_file.filename).name):
         return None
-    with open(cfd / data_dir / file_name, "wb") as f:
-        f.write(await upload_file.read())
-    match upload_file.filename.split(".")[-1]:
+    file_type = upload_file.filename.split(".")[-1]
+    if file_type not in UPLOAD_LIMITS:
+        return None
+    # data/<content hash>/<file name>, the documents are loaded from this path
+    destination, content_hash = await save_upload_file(
+        upload_file, cfd / data_dir, file_name, max_bytes=UPLOAD_LIMITS[file_type]
+    )
+    session.files.add(destination)
+    identifier = f"{content_hash}/{file_name}"
+    upload_key = f"file:{file_type}:{content_hash}"
+    match file_type:
         case "txt":
-            load_text_chat_engine()
-            return AITextDocument(file_name, LLM_NAME, app.state.callback_manager)
+            load_text_chat_engine(session)
+            return (
+                partial(
+                    AITextDocument,
+                    identifier,
+                    LLM_NAME,
+                    session.callback_manager,
+                    content_hash=content_hash,
+                ),
+                upload_key,
+            )
         case "pdf":
-            load_text_chat_engine()
-            return AIPdfDocument(file_name, LLM_NAME, app.state.callback_manager)
+            load_text_chat_engine(session)
+            return (
+                partial(
+                    AIPdfDocument,
+                    identifier,
+                    LLM_NAME,
+                    session.callback_manager,
+                    content_hash=content_hash,
+                ),
+                upload_key,
+            )
         case "sqlite" | "db":
-            uri = f"sqlite:///{app_dir}/{data_dir}/{file_name}"
+            uri = f"sqlite:///{app_dir}/{data_dir}/{identifier}"
             logging.debug(f"uri: {uri} debug {DEBUG_MODE}")
-            load_database_chat_engine()
-            return AIDataBase.from_uri(uri)
+            load_database_chat_engine(session)
+            return partial(load_database, uri), upload_key
     return None
 
 
-async def handle_upload_url(upload_url: str) -> AITextDocument | AIHtmlDocument:
+async def handle_upload_url(upload_url: str, session: ChatSession) -> Upload:
     match re.split(r"[./]", upload_url):
         case [*_, dir, file_name, "txt"] if dir == "data":
-            try:
-                load_text_chat_engine()
-                return AITextDocument(file_name, LLM_NAME, app.state.callback_manager)
-            except OSError:
+            if not (AITextDocument.cfd / file_name).is_file():
                 raise FileNotFoundError(
                     errno.ENOENT,
                     os.strerror(errno.ENOENT) + " in data folder",
                     file_name,
                 )
+            load_text_chat_engine(session)
+            return (
+                partial(AITextDocument, file_name, LLM_NAME, session.callback_manager),
+                f"data:{file_name}",
+            )
         case [http, *_] if "http" in http.lower():
-            load_text_chat_engine()
-            return AIHtmlDocument(upload_url, LLM_NAME, app.state.callback_manager)
+            load_text_chat_engine(session)
+            return (
+                partial(AIHtmlDocument, upload_url, LLM_NAME, session.callback_manager),
+                f"url:{normalize_url(upload_url)}",
+            )
         case _:
             raise MissingSchema
 
 
-@app.post("/upload", response_model=TextSummaryModel)
-async def upload_file(
-    upload_file: UploadFile | None = None, upload_url: str = Form("")
+def load_coalesced(
+    job: IngestionJob, load_document: DocumentLoader, upload_key: str
+) -> AITextDocument | AIDataBase:
+    """loads the document once for all concurrent uploads with the same key,
+    the other jobs wait in the load stage for the result
+    """
+    job.report_stage("load")
+    while True:
+        try:
+            document, shared = app.state.upload_flight.do(
+                upload_key, partial(load_document, stage_callback=job.report_stage)
+            )
+        except JobCancelledException:
+            if job.cancelled:
+                raise
+            logging.debug(f"job loading {upload_key} was cancelled, loading again")
+            continue
+        if shared:
+            logging.info(f"{job.job_id} uses the document loaded for {upload_key}")
+        return document
+
+
+def ingest_document(
+    job: IngestionJob,
+    load_document: DocumentLoader,
+    chat_engine: CustomLlamaIndexChatEngineWrapper | DataChatBotWrapper,
+    token_counter: TokenCountingHandler | CustomTokenCounter,
+    upload_key: str,
 ) -> TextSummaryModel:
-    message = ""
-    text_category = ""
+    """runs in a worker thread of the ingestion job queue"""
+    document = load_coalesced(job, load_document, upload_key)
+    is_text = chat_engine.data_category != "database"
+    old_version = chat_engine.index_version if is_text else None
+    chat_engine.add_document(document, stage_callback=job.report_stage)
+    if is_text:
+        # quizzes about the previous documents are outdated
+        app.state.quiz_pool.invalidate(old_version)
+        app.state.quiz_pool.refill(
+            chat_engine.index_version, chat_engine.vector_index, chat_engine.doc_ids
+        )
+    return TextSummaryModel(
+        file_name=job.file_name,
+        text_category=document.category,
+        summary=document.summary,
+        used_tokens=token_counter.total_llm_token_count,
+        metadata_llm_calls=getattr(document, "metadata_llm_calls", 0),
+        metadata_tokens=getattr(document, "metadata_tokens", 0),
+    )
+
+
+def build_bulk_document(
+    job: IngestionJob,
+    document_cls: type[AITextDocument],
+    identifier: str,
+    content_hash: str,
+    callback_manager,
+) -> AITextDocument:
+    """a cached document or a document loaded and split in the process pool"""
+
+    def load_nodes() -> list:
+        return get_pool().submit(load_and_split, document_cls, identifier).result()
+
+    return document_cls(
+        identifier,
+        LLM_NAME,
+        callback_manager,
+        content_hash=content_hash,
+        load_nodes=load_nodes,
+        # the files are built in parallel, the callback only checks for cancelling
+        stage_callback=lambda _: job.report_stage("load"),
+    )
+
+
+def ingest_bulk(
+    job: IngestionJob,
+    uploads: list[tuple[type[AITextDocument], str, str]],
+    chat_engine: CustomLlamaIndexChatEngineWrapper,
+    token_counter: TokenCountingHandler,
+    callback_manager,
+) -> BulkUploadSummaryModel:
+    """runs in a worker thread of the ingestion job queue, uploads are
+    (document class, <content hash>/<file name> in the data folder, content hash)
+    """
+    old_version = chat_engine.index_version
+    documents: list[AITextDocument] = []
+    failed: dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=BULK_BATCH_SIZE) as executor:
+        for start in range(0, len(uploads), BULK_BATCH_SIZE):
+            batch = uploads[start : start + BULK_BATCH_SIZE]
+            job.report_stage("load")
+            futures = [
+                executor.submit(build_bulk_document, job, *upload, callback_manager)
+                for upload in batch
+            ]
+            batch_documents = []
+            for (_, identifier, _), future in zip(batch, futures):
+                try:
+                    batch_documents.append(future.result())
+                except JobCancelledException:
+                    raise
+                except Exception as e:
+                    file_name = Path(identifier).name
+                    logging.warning(f"{file_name} could not be ingested: {e}")
+                    failed[file_name] = str(e)
+            if batch_documents:
+                chat_engine.add_documents(
+                    batch_documents, stage_callback=job.report_stage
+                )
+                documents += batch_documents
+            job.progress = {
+                "files": len(uploads),
+                "ingested": len(documents),
+                "failed": len(failed),
+            }
+    if not documents:
+        raise ValueError(f"None of the files could be ingested: {failed}")
+    app.state.quiz_pool.invalidate(old_version)
+    app.state.quiz_pool.refill(
+        chat_engine.index_version, chat_engine.vector_index, chat_engine.doc_ids
+    )
+    category = Counter(document.category for document in documents).most_common(1)
+    return BulkUploadSummaryModel(
+        file_name=job.file_name,
+        text_category=category[0][0],
+        summary=f"You uploaded {len(documents)} files, please ask any question "
+        "about them.",
+        used_tokens=token_counter.total_llm_token_count,
+        metadata_llm_calls=sum(
+            getattr(document, "metadata_llm_calls", 0) for document in documents
+        ),
+        metadata_tokens=sum(
+            getattr(document, "metadata_tokens", 0) for document in documents
+        ),
+        files=len(documents),
+        failed=failed,
+    )
+
+
+def ingest_page_batch(
+    job: IngestionJob,
+    batch: list[CrawledPage],
+    crawler: Crawler,
+    chat_engine: CustomLlamaIndexChatEngineWrapper,
+    callback_manager,
+) -> list[AITextDocument]:
+    """builds the documents of the pages in parallel and adds them to the index
+    together (one batched embedding call, index insert and persist), a page,
+    which fails, is counted as error of its host
+    """
+
+    def build(page: CrawledPage) -> AITextDocument | None:
+        try:
+            return AIHtmlDocument(
+                page.url,
+                LLM_NAME,
+                callback_manager,
+                # the crawler fetched the page already, it is not requested again
+                content=page.content,
+                content_hash=page.content_hash,
+                # a crawl reports one stage, the callback only checks for cancelling
+                stage_callback=lambda _: job.report_stage("crawl"),
+            )
+        except JobCancelledException:
+            raise
+        except Exception as e:
+            logging.warning(f"crawled page {page.url} could not be ingested: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+        built = list(executor.map(build, batch))
+    documents = [document for document in built if document is not None]
+    if documents:
+        chat_engine.add_documents(
+            documents, stage_callback=lambda _: job.report_stage("crawl")
+        )
+    for page, document in zip(batch, built):
+        crawler.record_ingestion(page, failed=document is None)
+    job.progress = crawler.stats()
+    return documents
+
+
+async def crawl_documents(
+    job: IngestionJob,
+    crawl_request: CrawlRequestModel,
+    crawler: Crawler,
+    chat_engine: CustomLlamaIndexChatEngineWrapper,
+    callback_manager,
+) -> list[AITextDocument]:
+    """the crawl goes on, while a batch of pages is ingested in a thread"""
+    documents = []
+    async for batch in crawler.crawl_batches(
+        crawl_request.urls, crawl_request.mode, CRAWL_BATCH_SIZE
+    ):
+        job.progress = crawler.stats()
+        documents += await asyncio.to_thread(
+            ingest_page_batch, job, batch, crawler, chat_engine, callback_manager
+        )
+    return documents
+
+
+def ingest_crawl(
+    job: IngestionJob,
+    crawl_request: CrawlRequestModel,
+    chat_engine: CustomLlamaIndexChatEngineWrapper,
+    token_counter: TokenCountingHandler,
+    callback_manager,
+) -> CrawlSummaryModel:
+    """runs in a worker thread of the ingestion job queue"""
+    job.report_stage("crawl")
+    crawler = Crawler(
+        AIHtmlDocument.http_fetcher.fetch,
+        max_pages=crawl_request.max_pages,
+        max_depth=crawl_request.max_depth,
+        max_concurrency=CRAWL_CONCURRENCY,
+        host_concurrency=CRAWL_HOST_CONCURRENCY,
+        host_rate=CRAWL_HOST_RATE,
+        stage_callback=job.report_stage,
+    )
+    old_version = chat_engine.index_version
+    try:
+        documents = asyncio.run(
+            crawl_documents(job, crawl_request, crawler, chat_engine, callback_manager)
+        )
+    finally:
+        job.progress = stats = crawler.stats()
+        logging.info(f"crawl of {job.file_name}: {stats}")
+    if not documents:
+        raise ValueError(f"No page of {job.file_name} could be ingested.")
+    app.state.quiz_pool.invalidate(old_version)
+    app.state.quiz_pool.refill(
+        chat_engine.index_version, chat_engine.vector_index, chat_engine.doc_ids
+    )
+    category = Counter(document.category for document in documents).most_common(1)
+    return CrawlSummaryModel(
+        file_name=job.file_name,
+        text_category=category[0][0],
+        summary=f"You uploaded {len(documents)} web pages of "
+        f"{len(stats['hosts'])} host(s), please ask any question about them.",
+        used_tokens=token_counter.total_llm_token_count,
+        metadata_llm_calls=sum(
+            getattr(document, "metadata_llm_calls", 0) for document in documents
+        ),
+        metadata_tokens=sum(
+            getattr(document, "metadata_tokens", 0) for document in documents
+        ),
+        pages=len(documents),
+        hosts=stats["hosts"],
+    )
+
+
+@app.post("/upload", response_model=IngestionJobModel)
+async def upload_file(
+    upload_file: UploadFile | None = None,
+    upload_url: str = Form(""),
+    session: ChatSession = Depends(get_session),
+) -> IngestionJobModel:
+    """saves the upload and starts a background ingestion job, the job status
+    can be polled via /upload/{job_id}
+    """
     file_name: str | None = ""
-    used_tokens = 0
     try:
         if upload_file:
             if upload_url:
                 raise DoubleUploadException("You can not provide both, file and URL.")
             if not (file_name := upload_file.filename):
-                return TextSummaryModel(
-                    file_name="",
-                    text_category=text_category,
-                    summary=message,
-                    used_tokens=used_tokens,
+                raise HTTPException(
+                    status_code=400, detail="The uploaded file has no name."
+                )
+            if not (upload := await handle_uploadfile(upload_file, session)):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"The file type of {file_name} is not supported.",
                 )
-            destination_file = Path(cfd / "data" / file_name)
-            destination_file.parent.mkdir(exist_ok=True, parents=True)
-            document = await handle_uploadfile(upload_file)
 
         elif upload_url:
-            document = await handle_upload_url(upload_url)
+            upload = await handle_upload_url(upload_url, session)
             file_name = upload_url
         else:
             raise NoUploadException(
                 "You must provide either a file or URL to upload.",
             )
-        if app.state.chat_engine and document:
-            app.state.chat_engine.add_document(document)
-            message = document.summary
-            text_category = document.category
-            used_tokens = app.state.token_counter.total_llm_token_count
     except MissingSchema:
         raise HTTPException(
             status_code=400,
@@ -182,6 +550,8 @@ async def upload_file(
             {upload_url}
             """,
         )
+    except UploadTooLargeException as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except FileNotFoundError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except OSError as e:
@@ -189,58 +559,303 @@ async def upload_file(
             status_code=400,
             detail=f"There was an unexpected OSError on uploading the file:{e}",
         )
-    logging.debug(f"engine_up?: {app.state.chat_engine is not None}")
-    logging.debug(f"message: {message}")
-    return TextSummaryModel(
-        file_name=file_name,
-        text_category=text_category,
-        summary=message,
-        used_tokens=used_tokens,
+    load_document, upload_key = upload
+    # the session must not be evicted while its upload is queued or running
+    session.acquire()
+    job = app.state.ingestion_jobs.submit(
+        file_name,
+        partial(
+            ingest_document,
+            load_document=load_document,
+            chat_engine=session.chat_engine,
+            token_counter=session.token_counter,
+            upload_key=upload_key,
+        ),
+        owner=session.session_id,
     )
+    job.future.add_done_callback(lambda _: session.release())
+    logging.debug(f"started ingestion job {job.job_id} for {file_name}")
+    return job.to_model()
+
+
+@app.post(
+    "/upload_bulk",
+    response_model=IngestionJobModel,
+    responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}},
+)
+async def upload_bulk(
+    upload_files: list[UploadFile], session: ChatSession = Depends(get_session)
+) -> IngestionJobModel:
+    """saves many txt and pdf files and starts one background ingestion job for
+    all of them, the job status can be polled via /upload/{job_id}
+    """
+    if len(upload_files) > MAX_BULK_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_FILES} files can be uploaded at once.",
+        )
+    names = [Path(upload_file.filename or "").name for upload_file in upload_files]
+    if unsupported := [
+        name for name in names if name.split(".")[-1] not in BULK_DOCUMENT_TYPES
+    ]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only txt and pdf files can be uploaded in bulk: {unsupported}",
+        )
+    uploads = []
+    try:
+        for upload_file, file_name in zip(upload_files, names):
+            file_type = file_name.split(".")[-1]
+            destination, content_hash = await save_upload_file(
+                upload_file,
+                cfd / data_dir,
+                file_name,
+                max_bytes=UPLOAD_LIMITS[file_type],
+            )
+            session.files.add(destination)
+            uploads.append(
+                (
+                    BULK_DOCUMENT_TYPES[file_type],
+                    f"{content_hash}/{file_name}",
+                    content_hash,
+                )
+            )
+    except UploadTooLargeException as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    load_text_chat_engine(session)
+    file_name = f"{names[0]} (+{len(names) - 1} files)" if len(names) > 1 else names[0]
+    session.acquire()
+    job = app.state.ingestion_jobs.submit(
+        file_name,
+        partial(
+            ingest_bulk,
+            uploads=uploads,
+            chat_engine=session.chat_engine,
+            token_counter=session.token_counter,
+            callback_manager=session.callback_manager,
+        ),
+        owner=session.session_id,
+    )
+    job.future.add_done_callback(lambda _: session.release())
+    logging.debug(f"started bulk ingestion job {job.job_id} for {len(uploads)} files")
+    return job.to_model()
+
+
+@app.post(
+    "/crawl",
+    response_model=IngestionJobModel,
+    responses={400: {"model": ErrorResponse}},
+)
+async def crawl(
+    crawl_request: CrawlRequestModel, session: ChatSession = Depends(get_session)
+) -> IngestionJobModel:
+    """starts a background job, which crawls the urls (a seed url, whose links
+    are followed, a list of urls or sitemaps) and ingests the pages, the job
+    status incl. the statistics per host can be polled via /upload/{job_id}
+    """
+    if crawl_request.mode not in CRAWL_MODES:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown crawl mode: {crawl_request.mode}"
+        )
+    urls = [url.strip() for url in crawl_request.urls if url.strip()]
+    if not urls:
+        raise NoUploadException("You must provide at least one URL to crawl.")
+    if invalid := [url for url in urls if not re.match(r"https?://", url, re.I)]:
+        raise HTTPException(
+            status_code=400, detail=f"Only http(s) urls can be crawled: {invalid}"
+        )
+    crawl_request.urls = urls
+    crawl_request.max_pages = min(crawl_request.max_pages, MAX_CRAWL_PAGES)
+    load_text_chat_engine(session)
+    file_name = urls[0] if len(urls) == 1 else f"{urls[0]} (+{len(urls) - 1} urls)"
+    session.acquire()
+    job = app.state.ingestion_jobs.submit(
+        file_name,
+        partial(
+            ingest_crawl,
+            crawl_request=crawl_request,
+            chat_engine=session.chat_engine,
+            token_counter=session.token_counter,
+            callback_manager=session.callback_manager,
+        ),
+        owner=session.session_id,
+    )
+    job.future.add_done_callback(lambda _: session.release())
+    logging.debug(f"started crawl job {job.job_id} for {file_name}")
+    return job.to_model()
+
+
+@app.get(
+    "/upload/{job_id}",
+    response_model=IngestionJobModel,
+    responses={404: {"model": ErrorResponse}},
+)
+async def get_upload_status(job_id: str) -> IngestionJobModel:
+    if not (job := app.state.ingestion_jobs.get(job_id)):
+        raise HTTPException(status_code=404, detail=f"Unknown upload job: {job_id}")
+    return job.to_model()
+
+
+@app.delete(
+    "/upload/{job_id}",
+    response_model=IngestionJobModel,
+    responses={404: {"model": ErrorResponse}},
+)
+async def cancel_upload(job_id: str) -> IngestionJobModel:
+    if not (job := app.state.ingestion_jobs.cancel(job_id)):
+        raise HTTPException(status_code=404, detail=f"Unknown upload job: {job_id}")
+    return job.to_model()
 
 
 @app.post("/qa_text", response_model=QAResponseModel)
-async def qa_text(question: QuestionModel) -> QAResponseModel:
-    logging.debug(f"engine_up?: {app.state.chat_engine is not None}")
+async def qa_text(
+    question: QuestionModel, session: ChatSession = Depends(get_session)
+) -> QAResponseModel:
+    logging.debug(f"engine_up?: {session.chat_engine is not None}")
     if not question.prompt:
         raise EmptyQuestionException(
             "Your Question is empty, please type a message and resend it."
         )
-    if app.state.chat_engine:
-        app.state.token_counter.reset_counts()
-        app.state.chat_engine.update_temp(question.temperature)
-        response = app.state.chat_engine.answer_question(question)
-        ai_answer = str(response)
-        used_tokens = app.state.token_counter.total_llm_token_count
-    else:
-        ai_answer = "Sorry, no context loaded. Please upload a file or url."
-        used_tokens = 0
+    # the session must not be evicted while the answer is awaited
+    session.acquire()
+    try:
+        if session.chat_engine:
+            async with app.state.chat_limiter:
+                session.token_counter.reset_counts()
+                session.chat_engine.update_temp(question.temperature)
+                response = await session.chat_engine.aanswer_question(question)
+            ai_answer = str(response)
+            used_tokens = session.token_counter.total_llm_token_count
+            prompt_tokens = session.token_counter.prompt_llm_token_count
+        else:
+            ai_answer = "Sorry, no context loaded. Please upload a file or url."
+            used_tokens = prompt_tokens = 0
+            response = None
+    finally:
+        session.release()
 
     return QAResponseModel(
         user_question=question.prompt,
         ai_answer=ai_answer,
         used_tokens=used_tokens,
+        prompt_tokens=prompt_tokens,
+        **answer_cache_info(session.chat_engine, isinstance(response, CachedAnswer)),
+    )
+
+
+def answer_cache_info(
+    chat_engine: CustomLlamaIndexChatEngineWrapper | DataChatBotWrapper | None,
+    answer_cache_hit: bool,
+) -> dict:
+    """hit of the current question and the counters of the answer cache"""
+    if not (answer_cache := getattr(chat_engine, "answer_cache", None)):
+        return {}
+    return {
+        "answer_cache_hit": answer_cache_hit,
+        "answer_cache_hits": answer_cache.hits,
+        "answer_cache_misses": answer_cache.misses,
+    }
+
+
+def stream_answer_events(
+    question: QuestionModel, session: ChatSession
+) -> Iterator[str]:
+    """server-sent events with the answer: "token" events with the next part of
+    the answer and a final "done" event with the QAResponseModel (incl. the used
+    tokens), or an "error" event. Starlette iterates in its threadpool, the
+    blocking llm calls do not block the event loop.
+    """
+    session.acquire()
+    try:
+        if session.chat_engine:
+            session.token_counter.reset_counts()
+            session.chat_engine.update_temp(question.temperature)
+            tokens = []
+            for token in session.chat_engine.stream_answer(question):
+                tokens.append(token)
+                yield format_sse("token", {"token": token})
+            ai_answer = "".join(tokens)
+            used_tokens = session.token_counter.total_llm_token_count
+            prompt_tokens = session.token_counter.prompt_llm_token_count
+            cached = len(tokens) == 1 and isinstance(tokens[0], CachedAnswer)
+        else:
+            ai_answer = "Sorry, no context loaded. Please upload a file or url."
+            used_tokens = prompt_tokens = 0
+            cached = False
+            yield format_sse("token", {"token": ai_answer})
+        response = QAResponseModel(
+            user_question=question.prompt,
+            ai_answer=ai_answer,
+            used_tokens=used_tokens,
+            prompt_tokens=prompt_tokens,
+            **answer_cache_info(session.chat_engine, cached),
+        )
+        yield format_sse("done", dict(response))
+    except Exception as e:
+        logging.exception("streaming the answer failed")
+        yield format_sse("error", {"detail": str(e)})
+    finally:
+        session.release()
+
+
+async def limited_stream(events: Iterator[str]) -> AsyncIterator[str]:
+    """iterates the blocking event stream in the threadpool, counted as one chat
+    by the concurrency limiter
+    """
+    async with app.state.chat_limiter:
+        async for event in iterate_in_threadpool(events):
+            yield event
+
+
+@app.post("/qa_text/stream")
+async def qa_text_stream(
+    question: QuestionModel, session: ChatSession = Depends(get_session)
+) -> StreamingResponse:
+    """like /qa_text, but the answer is streamed as server-sent events"""
+    if not question.prompt:
+        raise EmptyQuestionException(
+            "Your Question is empty, please type a message and resend it."
+        )
+    return StreamingResponse(
+        limited_stream(stream_answer_events(question, session)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics", response_model=MetricsModel)
+async def get_metrics() -> MetricsModel:
+    return MetricsModel(
+        chat_concurrency=app.state.chat_limiter.stats(),
+        sessions=app.state.sessions.stats(),
+        ingestion_jobs=app.state.ingestion_jobs.stats(),
+        single_flight={
+            "uploads": app.state.upload_flight.stats(),
+            "answers": CustomLlamaIndexChatEngineWrapper.answer_flight.stats(),
+        },
+        condense_question=FastPathCondenseQuestionChatEngine.stats(),
+        quiz_pool=app.state.quiz_pool.stats(),
+        sql_examples=AIDataBase.sql_examples.stats(),
     )
 
 
 @app.get("/clear_storage", response_model=TextResponseModel)
-async def clear_storage():
-    if app.state.chat_engine:
-        app.state.chat_engine.clear_data_storage()
-        logging.info("chat engine cleared...")
-    if (cfd / "data").exists():
-        for file in Path(cfd / "data").iterdir():
-            os.remove(file)
-    app.state.chat_engine = None
-    app.state.token_counter = None
-    app.state.callback_manager = None
+async def clear_storage(session: ChatSession = Depends(get_session)):
+    app.state.ingestion_jobs.cancel_all(owner=session.session_id)
+    chat_engine = session.chat_engine
+    if chat_engine and chat_engine.data_category != "database":
+        app.state.quiz_pool.invalidate(chat_engine.index_version)
+    # releases the documents and deletes the uploaded files of the session,
+    # other sessions keep theirs
+    app.state.sessions.clear(session.session_id)
+    logging.info(f"chat engine of session {session.session_id} cleared...")
     return TextResponseModel(message="Knowledge base succesfully cleared")
 
 
 @app.get("/clear_history", response_model=TextResponseModel)
-async def clear_history():
-    if app.state.chat_engine:
-        message = app.state.chat_engine.clear_chat_history()
+async def clear_history(session: ChatSession = Depends(get_session)):
+    if session.chat_engine:
+        message = session.chat_engine.clear_chat_history()
         # logging.debug("chat history cleared...")
         return TextResponseModel(message=message)
     return TextResponseModel(
@@ -253,16 +868,23 @@ async def clear_history():
     responses={
         200: {"model": MultipleChoiceTest},
         400: {"model": ErrorResponse},
+        502: {"model": ErrorResponse},
     },
 )
-def get_quiz():
-    if not app.state.chat_engine or not app.state.chat_engine.vector_index.ref_doc_info:
+async def get_quiz(
+    size: int = Query(3, ge=1, le=MAX_QUIZ_SIZE),
+    session: ChatSession = Depends(get_session),
+):
+    chat_engine = session.chat_engine
+    if not chat_engine or (
+        chat_engine.data_category != "database" and not chat_engine.doc_ids
+    ):
         raise HTTPException(
             status_code=400,
             detail="No context provided, please provide a url or a text file!",
         )
 
-    if app.state.chat_engine.data_category == "database":
+    if chat_engine.data_category == "database":
         raise HTTPException(
             status_code=400,
             detail="""A database is loaded, but no valid context for a quiz.
@@ -270,50 +892,17 @@ def get_quiz():
             """,
         )
 
-    quiz = generate_quiz_from_context()
-    return quiz
-
-
-def generate_quiz_from_context():
-    # Possible enhancements for future:
-    # use  Llamaindex DatasetGenerator and RelevancyEvaluator in combination with gpt4
-    # to generate a list of questions of relevance that could be asked about the data
-    # https://gpt-index.readthedocs.io/en/latest/examples/evaluation/QuestionGeneration.html
-    # https://betterprogramming.pub/llamaindex-how-to-evaluate-your-rag-retrieval-augmented-generation-applications-2c83490f489
-
-    from llama_index.output_parsers import LangchainOutputParser
-    from langchain.output_parsers import PydanticOutputParser
-    from llama_index.prompts.default_prompts import (
-        DEFAULT_TEXT_QA_PROMPT_TMPL,
-        DEFAULT_REFINE_PROMPT_TMPL,
+    # usually already generated, otherwise waits for the generation
+    quiz = app.state.quiz_pool.get(
+        chat_engine.index_version,
+        chat_engine.vector_index,
+        chat_engine.doc_ids,
+        size=size,
     )
-    from llama_index.prompts import PromptTemplate
-    from llama_index.response import Response
-
-    vector_index = app.state.chat_engine.vector_index
-    lc_output_parser = PydanticOutputParser(pydantic_object=MultipleChoiceTest)
-    output_parser = LangchainOutputParser(lc_output_parser)
-
-    # format each prompt with langchain output parser instructions
-    fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
-    fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = PromptTemplate(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = PromptTemplate(fmt_refine_tmpl, output_parser=output_parser)
-
-    question_query_engine = vector_index.as_query_engine(
-        service_context=ServiceContext.from_defaults(llm="gpt-3.5-turbo"),
-        text_qa_template=qa_prompt,
-        refine_template=refine_prompt,
-    )
-
-    response: Response = question_query_engine.query(
-        """Please create a MultipleChoiceTest of 3 interesting and unique 
-        MultipleChoiceQuestions about the main subject of the given context. Remember to
-        only formulate questions about the given context.
-        """
-    )
-
-    return output_parser.parse(response.response)
+    try:
+        return await asyncio.wrap_future(quiz)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Quiz could not be generated: {e}")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,17 @@
 from boto3 import Session as BotoSession
 from botocore.exceptions import ClientError
+from pathlib import Path
+import hashlib
 import json
 import os
+import tempfile
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from fastapi import UploadFile
+
+from .models import UploadTooLargeException
+
+UPLOAD_CHUNK_SIZE = 1024**2
 
 
 def get_secret_dict_from_id(secret_id, client):
@@ -25,3 +35,69 @@ def load_aws_secrets():
         secret_dict = get_secret_dict_from_id(secret_id, client)
         for secret_key, secret_value in secret_dict.items():
             os.environ[secret_key] = secret_value
+
+
+async def save_upload_file(
+    upload_file: UploadFile,
+    directory: Path,
+    file_name: str,
+    max_bytes: int | None = None,
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+) -> tuple[Path, str]:
+    """copies the upload chunk by chunk into a temporary file in the directory
+    and atomically renames it to directory/<content hash>/file_name, so memory
+    usage per upload stays constant, no partial files end up in the data folder
+    and concurrent uploads with the same name never overwrite each other (the
+    file always has exactly the hashed content).
+    Returns the path and the sha256 hash of the file content.
+    """
+    if max_bytes and (getattr(upload_file, "size", None) or 0) > max_bytes:
+        raise UploadTooLargeException(
+            f"{upload_file.filename} exceeds the upload limit of {max_bytes} bytes"
+        )
+    sha256 = hashlib.sha256()
+    written = 0
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := await upload_file.read(chunk_size):
+                written += len(chunk)
+                if max_bytes and written > max_bytes:
+                    raise UploadTooLargeException(
+                        f"{upload_file.filename} exceeds the upload limit of "
+                        f"{max_bytes} bytes"
+                    )
+                sha256.update(chunk)
+                f.write(chunk)
+        content_hash = sha256.hexdigest()
+        destination = directory / content_hash / file_name
+        destination.parent.mkdir(exist_ok=True)
+        try:
+            os.replace(tmp_path, destination)
+        except FileNotFoundError:
+            # the empty folder was just removed by the clean-up of a session
+            destination.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, destination)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return destination, content_hash
+
+
+def format_sse(event: str, data: dict) -> str:
+    """one server-sent event with a json payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def normalize_url(url: str) -> str:
+    """canonical form of an url: lowercase scheme and host, no default port,
+    fragment or trailing slash and sorted query parameters
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path.rstrip("/") or "/", query, ""))
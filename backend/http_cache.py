@@ -0,0 +1,169 @@
+import email.utils
+import hashlib
+import logging
+import pathlib
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .ingestion_cache import IngestionCache
+
+
+@dataclass
+class HttpResponse:
+    url: str
+    content: bytes
+    headers: dict[str, str] = field(default_factory=dict)
+    # served from the cache without a request
+    from_cache: bool = False
+    # the cached copy was confirmed by a conditional request (304)
+    revalidated: bool = False
+
+
+def parse_cache_control(header: str) -> dict[str, str | None]:
+    directives: dict[str, str | None] = {}
+    for directive in header.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def freshness_lifetime(headers: dict[str, str]) -> float:
+    """seconds the response may be used without revalidation (0: revalidate
+    every time), from Cache-Control max-age or the Expires header
+    """
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0.0
+    if (max_age := cache_control.get("max-age")) and re.fullmatch(r"\d+", max_age):
+        return float(max_age)
+    if expires := headers.get("expires"):
+        try:
+            expires_at = email.utils.parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
+        return max(0.0, expires_at - time.time())
+    return 0.0
+
+
+class CachedHttpFetcher:
+    """Fetches web pages with pooled connections and an on-disk HTTP cache.
+
+    A cached page is used without a request while it is fresh (Cache-Control
+    max-age or Expires), afterwards it is revalidated with a conditional GET
+    (If-None-Match / If-Modified-Since), a 304 response reuses the cached body.
+    Responses with Cache-Control no-store are not cached. The entries are
+    stored in the same size-bounded lru store as the ingestion results.
+    """
+
+    cached_headers = ("content-type", "etag", "last-modified", "cache-control")
+
+    def __init__(
+        self,
+        cache_dir: pathlib.Path | None,
+        max_bytes: int = 256 * 1024**2,
+        pool_connections: int = 10,
+        pool_maxsize: int = 32,
+        max_retries: int = 2,
+        timeout: float = 30.0,
+        user_agent: str = "Mozilla/5.0 (compatible; quaigle/1.0)",
+    ) -> None:
+        self.store = IngestionCache(cache_dir, max_bytes) if cache_dir else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=max_retries,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.requests = 0
+        self.fresh_hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _store(self, url: str, response: HttpResponse) -> None:
+        if self.store is None:
+            return
+        if "no-store" in parse_cache_control(response.headers.get("cache-control", "")):
+            self.store.invalidate(self._key(url))
+            return
+        self.store.put(
+            self._key(url),
+            {
+                "headers": response.headers,
+                "content": response.content,
+                "fetched_at": time.time(),
+                "lifetime": freshness_lifetime(response.headers),
+            },
+        )
+
+    def fetch(self, url: str, revalidate: bool = True) -> HttpResponse:
+        """revalidate=False uses a cached copy as is, e.g. right after a fetch"""
+        entry = self.store.get(self._key(url)) if self.store else None
+        if entry is not None:
+            age = time.time() - entry["fetched_at"]
+            if not revalidate or age < entry["lifetime"]:
+                self._count("fresh_hits")
+                return HttpResponse(url, entry["content"], entry["headers"], True)
+
+        request_headers = {}
+        if entry is not None:
+            if etag := entry["headers"].get("etag"):
+                request_headers["If-None-Match"] = etag
+            if last_modified := entry["headers"].get("last-modified"):
+                request_headers["If-Modified-Since"] = last_modified
+        self._count("requests")
+        response = self.session.get(url, headers=request_headers, timeout=self.timeout)
+
+        if response.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            logging.debug(f"cached copy of {url} is still valid")
+            # the 304 may update the caching headers
+            headers = entry["headers"] | {
+                name: value
+                for name, value in response.headers.lower_items()
+                if name in self.cached_headers
+            }
+            result = HttpResponse(url, entry["content"], headers, revalidated=True)
+        else:
+            response.raise_for_status()
+            self._count("downloads")
+            headers = {
+                name: value
+                for name, value in response.headers.lower_items()
+                if name in self.cached_headers
+            }
+            result = HttpResponse(url, response.content, headers)
+        self._store(url, result)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "fresh_hits": self.fresh_hits,
+            "revalidated": self.revalidated,
+            "downloads": self.downloads,
+        }
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import pathlib
+import shutil
+import zlib
+from collections.abc import Iterator
+
+from llama_index import (
+    ServiceContext,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+
+from .lexical_index import BM25Index
+from .vector_store import NumpyVectorStore
+
+
+class WriteAheadLog:
+    """Append-only log of index changes.
+
+    Every record is one line "<crc32> <json>" and is fsynced before the write
+    returns. A torn last line (crash during the write) fails the checksum and
+    is cut off on the next read, all records before it stay valid.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.last_seq = 0
+        self.n_records = 0
+
+    def append(self, record: dict) -> int:
+        self.last_seq += 1
+        payload = json.dumps({"seq": self.last_seq, **record})
+        line = f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_records += 1
+        return self.last_seq
+
+    def read(self) -> Iterator[dict]:
+        """yields all intact records and truncates the file after the last one"""
+        if not self.path.exists():
+            return
+        valid_bytes = 0
+        with open(self.path, "rb") as f:
+            for raw_line in f:
+                try:
+                    checksum, payload = (
+                        raw_line.decode("utf-8").rstrip("\n").split(" ", 1)
+                    )
+                    if not raw_line.endswith(b"\n") or int(checksum, 16) != zlib.crc32(
+                        payload.encode("utf-8")
+                    ):
+                        raise ValueError("checksum mismatch")
+                    record = json.loads(payload)
+                except ValueError as e:
+                    logging.warning(f"discarding damaged index log tail: {e}")
+                    break
+                valid_bytes += len(raw_line)
+                self.last_seq = max(self.last_seq, record["seq"])
+                self.n_records += 1
+                yield record
+        if valid_bytes < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+    def size_bytes(self) -> int:
+        return self.path.stat().st_size if self.path.exists() else 0
+
+    def truncate(self) -> None:
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_records = 0
+
+
+class IndexPersistence:
+    """Persists the vector index as snapshot plus write-ahead log.
+
+    An upload only appends its own nodes to the log instead of rewriting the
+    whole docstore, index store and vector store. After compact_every records
+    (or max_log_bytes) the log is compacted into a new snapshot, which is
+    written to a temporary directory and swapped in by renaming. On startup the
+    snapshot is loaded and all log records newer than the snapshot are replayed.
+    """
+
+    snapshot_dirname = "snapshot"
+    meta_fname = "snapshot_meta.json"
+    lexical_index_fname = "lexical_index.json"
+    log_fname = "index.wal"
+
+    def __init__(
+        self,
+        storage_dir: pathlib.Path,
+        compact_every: int = 50,
+        max_log_bytes: int = 256 * 1024**2,
+        vector_store_cls: type[NumpyVectorStore] = NumpyVectorStore,
+        vector_store_kwargs: dict | None = None,
+    ) -> None:
+        self.vector_store_cls = vector_store_cls
+        self.vector_store_kwargs = vector_store_kwargs or {}
+        self.storage_dir = pathlib.Path(storage_dir)
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.compact_every = compact_every
+        self.max_log_bytes = max_log_bytes
+        self.log = WriteAheadLog(self.storage_dir / self.log_fname)
+        self.lexical_index = BM25Index()
+
+    @property
+    def snapshot_dir(self) -> pathlib.Path:
+        return self.storage_dir / self.snapshot_dirname
+
+    def _recover_snapshot_dir(self) -> None:
+        """finishes an interrupted snapshot swap or migrates the old layout, where
+        the storage context was persisted directly into the storage dir
+        """
+        old_dir = self.storage_dir / f"{self.snapshot_dirname}.old"
+        if not self.snapshot_dir.exists() and old_dir.exists():
+            old_dir.rename(self.snapshot_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        shutil.rmtree(
+            self.storage_dir / f"{self.snapshot_dirname}.tmp", ignore_errors=True
+        )
+        if (
+            not self.snapshot_dir.exists()
+            and (self.storage_dir / "docstore.json").exists()
+        ):
+            logging.info("migrating persisted storage context into snapshot dir")
+            self.snapshot_dir.mkdir()
+            for file in self.storage_dir.glob("*.*"):
+                if file.name != self.log_fname:
+                    file.rename(self.snapshot_dir / file.name)
+
+    def _snapshot_seq(self) -> int:
+        meta_file = self.snapshot_dir / self.meta_fname
+        if not meta_file.exists():
+            return 0
+        return json.loads(meta_file.read_text())["last_seq"]
+
+    def load_index(self, service_context: ServiceContext) -> VectorStoreIndex:
+        self._recover_snapshot_dir()
+        if self.snapshot_dir.exists():
+            storage_context = StorageContext.from_defaults(
+                persist_dir=str(self.snapshot_dir),
+                vector_store=self.vector_store_cls.from_persist_dir(
+                    self.snapshot_dir, **self.vector_store_kwargs
+                ),
+            )
+            vector_index = load_index_from_storage(
+                storage_context=storage_context, service_context=service_context
+            )
+            lexical_index_file = self.snapshot_dir / self.lexical_index_fname
+            if lexical_index_file.exists():
+                self.lexical_index = BM25Index.from_persist_path(lexical_index_file)
+            else:
+                # snapshot from before the lexical index existed
+                self.lexical_index.add_nodes(vector_index.docstore.docs.values())
+        else:
+            logging.debug("creating new vec index")
+            vector_index = VectorStoreIndex(
+                [],
+                storage_context=StorageContext.from_defaults(
+                    vector_store=self.vector_store_cls(**self.vector_store_kwargs)
+                ),
+                service_context=service_context,
+            )
+        snapshot_seq = self._snapshot_seq()
+        self.log.last_seq = snapshot_seq
+        n_replayed = 0
+        for record in self.log.read():
+            if record["seq"] <= snapshot_seq:
+                continue
+            self._apply(vector_index, self.lexical_index, record)
+            n_replayed += 1
+        logging.info(f"replayed {n_replayed} index log records")
+        return vector_index
+
+    @staticmethod
+    def _apply(
+        vector_index: VectorStoreIndex, lexical_index: BM25Index, record: dict
+    ) -> None:
+        match record["op"]:
+            case "insert":
+                # nodes are logged with their embeddings, no embedding calls here
+                nodes = [json_to_doc(node_json) for node_json in record["nodes"]]
+                vector_index.insert_nodes(nodes)
+                lexical_index.add_nodes(nodes)
+            case "delete":
+                vector_index.delete_ref_doc(
+                    record["ref_doc_id"], delete_from_docstore=True
+                )
+                lexical_index.remove_group(record["ref_doc_id"])
+            case op:
+                raise ValueError(f"unknown index log operation: {op}")
+
+    def log_insert(self, nodes: list[BaseNode]) -> None:
+        self.log.append({"op": "insert", "nodes": [doc_to_json(n) for n in nodes]})
+
+    def log_delete(self, ref_doc_id: str) -> None:
+        self.log.append({"op": "delete", "ref_doc_id": ref_doc_id})
+
+    def needs_compaction(self) -> bool:
+        return (
+            self.log.n_records >= self.compact_every
+            or self.log.size_bytes() >= self.max_log_bytes
+        )
+
+    def maybe_compact(self, storage_context: StorageContext) -> None:
+        if self.needs_compaction():
+            self.compact(storage_context)
+
+    def compact(self, storage_context: StorageContext) -> None:
+        """writes a full snapshot of the current index and empties the log"""
+        tmp_dir = self.storage_dir / f"{self.snapshot_dirname}.tmp"
+        old_dir = self.storage_dir / f"{self.snapshot_dirname}.old"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        storage_context.persist(persist_dir=str(tmp_dir))
+        self.lexical_index.persist(tmp_dir / self.lexical_index_fname)
+        (tmp_dir / self.meta_fname).write_text(
+            json.dumps({"last_seq": self.log.last_seq})
+        )
+        # until the log is truncated, a crash at any point leaves a snapshot
+        # which is consistent with the log (records <= last_seq are skipped)
+        if self.snapshot_dir.exists():
+            self.snapshot_dir.rename(old_dir)
+        tmp_dir.rename(self.snapshot_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.log.truncate()
+        logging.info(f"compacted index log into snapshot (seq {self.log.last_seq})")
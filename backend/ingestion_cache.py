@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+import tempfile
+from typing import Any
+
+
+class IngestionCache:
+    """Content-addressed on-disk cache for the results of the ingestion pipeline
+    (parsed nodes incl. marvin metadata and embeddings).
+
+    Entries are stored as one pickle file per key. The cache is bounded by
+    max_bytes, the least recently used entries are evicted first.
+    """
+
+    suffix = ".pkl"
+
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int = 512 * 1024**2):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content_hash: str, *settings: Any) -> str:
+        """combines the hash of the raw content with all settings that
+        influence the ingestion result (llm, chunking, ...) to a cache key
+        """
+        key = hashlib.sha256(content_hash.encode("utf-8"))
+        for setting in settings:
+            key.update(b"\x00" + str(setting).encode("utf-8"))
+        return key.hexdigest()
+
+    @staticmethod
+    def hash_bytes(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def hash_file(file_path: pathlib.Path, chunk_size: int = 1024**2) -> str:
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / f"{key}{self.suffix}"
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logging.warning(f"dropping unreadable ingestion cache entry {key}: {e}")
+            self.invalidate(key)
+            self.misses += 1
+            return None
+        # refresh the modification time, which is used as lru marker
+        os.utime(entry)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so a crash never leaves a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def invalidate(self, key: str) -> bool:
+        """removes a single entry, returns True if the entry existed"""
+        try:
+            self._entry_path(key).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def clear(self) -> None:
+        for entry in self._entries():
+            entry.unlink(missing_ok=True)
+
+    def size_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def evict(self) -> None:
+        """removes least recently used entries until the cache fits into max_bytes"""
+        entries = sorted(
+            ((entry.stat(), entry) for entry in self._entries()),
+            key=lambda stat_entry: stat_entry[0].st_mtime,
+        )
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in entries:
+            if total <= self.max_bytes:
+                break
+            logging.debug(f"evicting ingestion cache entry {entry.name}")
+            entry.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def _entries(self) -> list[pathlib.Path]:
+        if not self.cache_dir.exists():
+            return []
+        return list(self.cache_dir.glob(f"*{self.suffix}"))
@@ -0,0 +1,146 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .models import IngestionJobModel, JobCancelledException, TextSummaryModel
+
+INGESTION_STAGES = ("load", "split", "extract", "embed", "persist")
+
+
+class IngestionJob:
+    """State of one background ingestion (load -> split -> extract -> embed ->
+    persist). The running pipeline reports each stage via report_stage, which is
+    also the point where a requested cancellation takes effect.
+    """
+
+    def __init__(self, file_name: str, owner: str | None = None) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.owner = owner  # e.g. the chat session, which started the upload
+        self.status = "queued"  # queued | running | done | failed | cancelled
+        self.stage: str | None = None
+        self.completed_stages: list[str] = []
+        # e.g. the crawl statistics of a running crawl
+        self.progress: dict = {}
+        self.result: TextSummaryModel | None = None
+        self.error: str | None = None
+        self.future: Future | None = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def report_stage(self, stage: str) -> None:
+        with self._lock:
+            if self._cancel_event.is_set():
+                raise JobCancelledException(f"job {self.job_id} was cancelled")
+            if stage == self.stage:
+                return
+            if self.stage is not None:
+                self.completed_stages.append(self.stage)
+            self.stage = stage
+
+    def cancel(self) -> None:
+        with self._lock:
+            # once persisting started, the document is part of the index
+            if self.finished or self.stage == "persist":
+                return
+            self._cancel_event.set()
+            if self.future is not None and self.future.cancel():
+                self.status = "cancelled"
+
+    def to_model(self) -> IngestionJobModel:
+        return IngestionJobModel(
+            job_id=self.job_id,
+            file_name=self.file_name,
+            status=self.status,
+            stage=self.stage,
+            completed_stages=list(self.completed_stages),
+            progress=dict(self.progress),
+            result=self.result,
+            error=self.error,
+        )
+
+
+class IngestionJobQueue:
+    """Runs ingestion jobs on a bounded thread pool, so uploads do not block the
+    event loop. Finished jobs are kept for status polling, up to max_finished_jobs.
+    """
+
+    def __init__(self, max_workers: int = 2, max_finished_jobs: int = 100) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingestion"
+        )
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        file_name: str,
+        ingest: Callable[[IngestionJob], TextSummaryModel],
+        owner: str | None = None,
+    ) -> IngestionJob:
+        job = IngestionJob(file_name, owner)
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._drop_finished_jobs()
+        job.future = self.executor.submit(self._run, job, ingest)
+        return job
+
+    def get(self, job_id: str) -> IngestionJob | None:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> IngestionJob | None:
+        if job := self.jobs.get(job_id):
+            job.cancel()
+        return job
+
+    def cancel_all(self, owner: str | None = None) -> None:
+        """cancels all jobs, or only the jobs of the given owner"""
+        for job in list(self.jobs.values()):
+            if owner is None or job.owner == owner:
+                job.cancel()
+
+    def stats(self) -> dict:
+        """number of known jobs per status"""
+        counts: dict[str, int] = {}
+        for job in list(self.jobs.values()):
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def shutdown(self) -> None:
+        self.cancel_all()
+        self.executor.shutdown(wait=True)
+
+    def _run(
+        self, job: IngestionJob, ingest: Callable[[IngestionJob], TextSummaryModel]
+    ) -> None:
+        job.status = "running"
+        try:
+            job.result = ingest(job)
+            if job.stage is not None:
+                job.completed_stages.append(job.stage)
+            job.stage = None
+            job.status = "done"
+        except JobCancelledException:
+            logging.info(f"ingestion job {job.job_id} cancelled")
+            job.status = "cancelled"
+        except Exception as e:
+            logging.exception(f"ingestion job {job.job_id} failed")
+            job.error = str(e)
+            job.status = "failed"
+
+    def _drop_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
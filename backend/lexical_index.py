@@ -0,0 +1,261 @@
+import asyncio
+import json
+import math
+import os
+import pathlib
+import re
+import tempfile
+from collections import Counter
+from collections.abc import Iterable
+
+from llama_index.indices.base_retriever import BaseRetriever
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.schema import BaseNode, NodeWithScore
+from llama_index.storage.docstore.types import BaseDocumentStore
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Incrementally built inverted index with Okapi BM25 scoring.
+
+    Every entry belongs to a group (e.g. the ref doc id of a node), so all
+    entries of a document can be removed at once.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[str, int]] = {}
+        self.doc_lengths: dict[str, int] = {}
+        self.groups: dict[str, list[str]] = {}
+        # doc_id -> group
+        self.doc_groups: dict[str, str] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: str, text: str, group: str | None = None) -> None:
+        if doc_id in self.doc_lengths:
+            self._remove_many({doc_id})
+        term_counts = Counter(tokenize(text))
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        length = sum(term_counts.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+        self.doc_groups[doc_id] = group or doc_id
+        self.groups.setdefault(group or doc_id, []).append(doc_id)
+
+    def add_nodes(self, nodes: Iterable[BaseNode]) -> None:
+        for node in nodes:
+            self.add(node.node_id, node.get_content(), group=node.ref_doc_id)
+
+    def _remove_many(self, doc_ids: set[str]) -> None:
+        """one pass over the postings for all removed entries, a group without
+        entries is deleted
+        """
+        removed_from_group: dict[str, set[str]] = {}
+        for doc_id in doc_ids:
+            self.total_length -= self.doc_lengths.pop(doc_id, 0)
+            if (group := self.doc_groups.pop(doc_id, None)) is not None:
+                removed_from_group.setdefault(group, set()).add(doc_id)
+        for group, removed in removed_from_group.items():
+            remaining = [
+                doc_id for doc_id in self.groups.get(group, []) if doc_id not in removed
+            ]
+            if remaining:
+                self.groups[group] = remaining
+            else:
+                self.groups.pop(group, None)
+        for term, docs in list(self.postings.items()):
+            for doc_id in doc_ids.intersection(docs):
+                del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+
+    def remove(self, doc_id: str) -> None:
+        self._remove_many({doc_id})
+
+    def remove_group(self, group: str) -> None:
+        self._remove_many(set(self.groups.pop(group, [])))
+
+    def clear(self) -> None:
+        self.__init__(self.k1, self.b)  # type: ignore
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 10,
+        groups: Iterable[str] | None = None,
+    ) -> list[tuple[str, float]]:
+        """returns the top_k (doc_id, score) pairs, optionally restricted to the
+        entries of the given groups
+        """
+        if not self.doc_lengths:
+            return []
+        allowed = (
+            {doc_id for group in groups for doc_id in self.groups.get(group, [])}
+            if groups is not None
+            else None
+        )
+        n_docs = len(self.doc_lengths)
+        avg_length = self.total_length / n_docs
+        scores: dict[str, float] = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in list(docs.items()):
+                if allowed is not None and doc_id not in allowed:
+                    continue
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length
+                )
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (
+                    tf + norm
+                )
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def to_dict(self) -> dict:
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "postings": self.postings,
+            "doc_lengths": self.doc_lengths,
+            "groups": self.groups,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        index = cls(k1=data["k1"], b=data["b"])
+        index.postings = data["postings"]
+        index.doc_lengths = data["doc_lengths"]
+        index.groups = data["groups"]
+        index.doc_groups = {
+            doc_id: group
+            for group, doc_ids in index.groups.items()
+            for doc_id in doc_ids
+        }
+        index.total_length = sum(index.doc_lengths.values())
+        return index
+
+    def persist(self, persist_path: pathlib.Path) -> None:
+        persist_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=persist_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, persist_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: pathlib.Path) -> "BM25Index":
+        with open(persist_path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses lexical BM25 and vector retrieval with reciprocal rank fusion.
+
+    mode "lexical" answers from the inverted index only and does not need a
+    query embedding (no embedding api call), "vector" is the plain vector
+    retriever and "hybrid" merges both result lists.
+    """
+
+    modes = ("hybrid", "lexical", "vector")
+    # on the async path, larger lexical indexes are searched in a thread
+    lexical_thread_min_entries = int(os.getenv("LEXICAL_THREAD_MIN_ENTRIES", 5000))
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        lexical_index: BM25Index,
+        docstore: BaseDocumentStore,
+        mode: str = "hybrid",
+        similarity_top_k: int = 10,
+        rrf_k: int = 60,
+        doc_ids: list[str] | None = None,
+        query_embeddings: dict[str, list[float]] | None = None,
+    ) -> None:
+        """query_embeddings: embeddings of queries, which were computed already
+        (e.g. for the answer cache lookup), they are used once
+        """
+        if mode not in self.modes:
+            raise ValueError(f"unknown retrieval mode: {mode}")
+        self.vector_retriever = vector_retriever
+        self.lexical_index = lexical_index
+        self.docstore = docstore
+        self.mode = mode
+        self.similarity_top_k = similarity_top_k
+        self.rrf_k = rrf_k
+        self.doc_ids = doc_ids
+        self.query_embeddings = query_embeddings if query_embeddings is not None else {}
+
+    def _lexical_retrieve(self, query_str: str) -> list[NodeWithScore]:
+        hits = self.lexical_index.search(
+            query_str, top_k=self.similarity_top_k, groups=self.doc_ids
+        )
+        return [
+            NodeWithScore(node=self.docstore.get_node(node_id), score=score)
+            for node_id, score in hits
+            if self.docstore.document_exists(node_id)
+        ]
+
+    def _fuse(
+        self, lexical_results: list[NodeWithScore], vector_results: list[NodeWithScore]
+    ) -> list[NodeWithScore]:
+        fused_scores: dict[str, float] = {}
+        nodes: dict[str, NodeWithScore] = {}
+        for results in (lexical_results, vector_results):
+            for rank, result in enumerate(results):
+                node_id = result.node.node_id
+                fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1 / (
+                    self.rrf_k + rank + 1
+                )
+                nodes.setdefault(node_id, result)
+        ranking = sorted(fused_scores, key=fused_scores.get, reverse=True)  # type: ignore
+        return [
+            NodeWithScore(node=nodes[node_id].node, score=fused_scores[node_id])
+            for node_id in ranking[: self.similarity_top_k]
+        ]
+
+    def _with_embedding(self, query_bundle: QueryBundle) -> QueryBundle:
+        embedding = self.query_embeddings.pop(query_bundle.query_str, None)
+        if query_bundle.embedding is None and embedding is not None:
+            query_bundle.embedding = embedding
+        return query_bundle
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        query_bundle = self._with_embedding(query_bundle)
+        if self.mode == "vector":
+            return self.vector_retriever.retrieve(query_bundle)
+        lexical_results = self._lexical_retrieve(query_bundle.query_str)
+        if self.mode == "lexical":
+            return lexical_results
+        vector_results = self.vector_retriever.retrieve(query_bundle)
+        return self._fuse(lexical_results, vector_results)
+
+    async def _alexical_retrieve(self, query_str: str) -> list[NodeWithScore]:
+        if len(self.lexical_index) < self.lexical_thread_min_entries:
+            return self._lexical_retrieve(query_str)
+        return await asyncio.to_thread(self._lexical_retrieve, query_str)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        """the query embedding and the vector search with the async api, the
+        lexical search at the same time
+        """
+        query_bundle = self._with_embedding(query_bundle)
+        if self.mode == "vector":
+            return await self.vector_retriever.aretrieve(query_bundle)
+        if self.mode == "lexical":
+            return await self._alexical_retrieve(query_bundle.query_str)
+        lexical_results, vector_results = await asyncio.gather(
+            self._alexical_retrieve(query_bundle.query_str),
+            self.vector_retriever.aretrieve(query_bundle),
+        )
+        return self._fuse(lexical_results, vector_results)
@@ -13,11 +13,58 @@ class EmptyQuestionException(Exception):
     pass
 
 
+class JobCancelledException(Exception):
+    pass
+
+
+class UploadTooLargeException(Exception):
+    pass
+
+
+class QueryRejectedException(Exception):
+    pass
+
+
 class TextSummaryModel(BaseModel):
     file_name: str
     text_category: str
     summary: str
     used_tokens: int
+    metadata_llm_calls: int = 0
+    # tokens of the metadata extraction (marvin calls are not seen by the
+    # token counter)
+    metadata_tokens: int = 0
+
+
+class CrawlSummaryModel(TextSummaryModel):
+    pages: int
+    # per host: pages, duplicates, errors, ingested, bytes, pages_per_second
+    hosts: dict
+
+
+class BulkUploadSummaryModel(TextSummaryModel):
+    files: int
+    # file name -> error of the files, which could not be ingested
+    failed: dict[str, str] = {}
+
+
+class CrawlRequestModel(BaseModel):
+    urls: list[str]
+    # "seed": follows the links of the urls, "list": only the urls, "sitemap"
+    mode: str = "seed"
+    max_pages: int = Field(50, ge=1)
+    max_depth: int = Field(1, ge=0)
+
+
+class IngestionJobModel(BaseModel):
+    job_id: str
+    file_name: str
+    status: str
+    stage: str | None = None
+    completed_stages: list[str] = []
+    progress: dict = {}
+    result: CrawlSummaryModel | BulkUploadSummaryModel | TextSummaryModel | None = None
+    error: str | None = None
 
 
 class QuestionModel(BaseModel):
@@ -29,6 +76,20 @@ class QAResponseModel(BaseModel):
     user_question: str
     ai_answer: str
     used_tokens: int
+    prompt_tokens: int = 0
+    answer_cache_hit: bool = False
+    answer_cache_hits: int = 0
+    answer_cache_misses: int = 0
+
+
+class MetricsModel(BaseModel):
+    chat_concurrency: dict
+    sessions: dict
+    ingestion_jobs: dict
+    single_flight: dict
+    condense_question: dict
+    quiz_pool: dict
+    sql_examples: dict
 
 
 class TextResponseModel(BaseModel):
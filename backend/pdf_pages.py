@@ -0,0 +1,88 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pypdf import PdfReader
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def pool_size() -> int:
+    return int(os.getenv("PARSE_WORKERS", 0)) or os.cpu_count() or 2
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """process pool for the cpu bound parsing, shared by the page extraction of
+    all pdf uploads and the files of bulk uploads, created on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=pool_size())
+        return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def extract_pages(path: Path, start: int, stop: int) -> list[tuple[int, str]]:
+    """(page number starting at 1, text) of the pages start to stop - 1"""
+    reader = PdfReader(path)
+    return [
+        (number + 1, reader.pages[number].extract_text() or "")
+        for number in range(start, min(stop, len(reader.pages)))
+    ]
+
+
+def iter_pages(path: Path, pages_per_task: int = 16) -> Iterator[tuple[int, str]]:
+    """(page number, text) of all pages in order.
+
+    Page ranges are extracted in parallel in worker processes, at most two
+    ranges per worker are in flight, so a large pdf is never held in memory as
+    a whole. Every task opens the file again, so a range has at least
+    pages_per_task pages and there are about four ranges per worker. Small
+    pdfs, single cpu machines and pdfs loaded in a worker process (e.g. of a
+    bulk upload, which parses the files in parallel already) are extracted here.
+    """
+    reader = PdfReader(path)
+    n_pages = len(reader.pages)
+    workers = pool_size()
+    if (
+        n_pages <= pages_per_task
+        or workers < 2
+        or multiprocessing.parent_process() is not None
+    ):
+        for number, page in enumerate(reader.pages, start=1):
+            yield number, page.extract_text() or ""
+        return
+    del reader
+    pool = get_pool()
+    pages_per_task = max(pages_per_task, -(-n_pages // (4 * workers)))
+    ranges = iter(range(0, n_pages, pages_per_task))
+    in_flight: deque = deque()
+    try:
+        while True:
+            while len(in_flight) < 2 * workers:
+                if (start := next(ranges, None)) is None:
+                    break
+                in_flight.append(
+                    pool.submit(extract_pages, path, start, start + pages_per_task)
+                )
+            if not in_flight:
+                break
+            yield from in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+    logging.debug(f"extracted {n_pages} pages of {path.name}")
@@ -0,0 +1,313 @@
+import logging
+import math
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cached_property
+
+import numpy as np
+
+from langchain.output_parsers import PydanticOutputParser
+from llama_index import VectorStoreIndex
+from llama_index.llms import OpenAI
+from llama_index.output_parsers import LangchainOutputParser
+from llama_index.prompts import PromptTemplate
+from llama_index.schema import BaseNode, MetadataMode
+
+from .ann_index import kmeans
+from .answer_cache import normalize_question
+from .models import MultipleChoiceQuestion, MultipleChoiceTest
+
+
+def dedupe_questions(
+    questions: list[MultipleChoiceQuestion], threshold: float = 0.7
+) -> list[MultipleChoiceQuestion]:
+    """drops questions whose words overlap (jaccard similarity) with an earlier
+    question by at least the threshold
+    """
+    kept: list[tuple[MultipleChoiceQuestion, set[str]]] = []
+    for question in questions:
+        words = set(normalize_question(question.question).split())
+        if all(
+            len(words & other) / max(len(words | other), 1) < threshold
+            for _, other in kept
+        ):
+            kept.append((question, words))
+    return [question for question, _ in kept]
+
+
+class QuizGenerator:
+    """Generates a MultipleChoiceTest about the documents of a vector index.
+
+    The chunk embeddings of the documents are clustered, every cluster gets its
+    share of the questions, which are generated from the chunks closest to its
+    centroid. So the questions cover the whole documents and the llm calls of the
+    clusters run in parallel (at most max_parallel_calls at a time). A few more
+    questions than requested are generated, near-identical ones are dropped.
+    Output parser, prompt and llm are created once and reused for all quizzes.
+    """
+
+    # Possible enhancements for future:
+    # use  Llamaindex DatasetGenerator and RelevancyEvaluator in combination with gpt4
+    # to generate a list of questions of relevance that could be asked about the data
+    # https://gpt-index.readthedocs.io/en/latest/examples/evaluation/QuestionGeneration.html
+    # https://betterprogramming.pub/llamaindex-how-to-evaluate-your-rag-retrieval-augmented-generation-applications-2c83490f489
+
+    quiz_prompt_tmpl = (
+        "Context information is below.\n"
+        "---------------------\n"
+        "{context_str}\n"
+        "---------------------\n"
+        "Please create a MultipleChoiceTest of {n_questions} interesting and unique "
+        "MultipleChoiceQuestions about the main subject of the given context. "
+        "Remember to only formulate questions about the given context.\n"
+    )
+
+    def __init__(
+        self,
+        llm_name: str = "gpt-3.5-turbo",
+        temperature: float = 0.5,
+        max_parallel_calls: int = 8,
+        chunks_per_cluster: int = 2,
+        oversampling: float = 1.25,
+    ):
+        self.llm_name = llm_name
+        # > 0, so the quizzes in the pool differ
+        self.temperature = temperature
+        self.chunks_per_cluster = chunks_per_cluster
+        self.oversampling = oversampling
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_parallel_calls, thread_name_prefix="quiz_llm"
+        )
+        self.output_parser = LangchainOutputParser(
+            PydanticOutputParser(pydantic_object=MultipleChoiceTest)
+        )
+        # format the prompt with langchain output parser instructions
+        self.quiz_prompt = PromptTemplate(
+            self.output_parser.format(self.quiz_prompt_tmpl),
+            output_parser=self.output_parser,
+        )
+
+    @cached_property
+    def llm(self) -> OpenAI:
+        return OpenAI(model=self.llm_name, temperature=self.temperature)
+
+    @staticmethod
+    def _get_chunks(
+        vector_index: VectorStoreIndex, doc_ids: list[str]
+    ) -> tuple[list[BaseNode], np.ndarray]:
+        """nodes of the documents with their embeddings from the vector store"""
+        docstore = vector_index.docstore
+        node_ids = [
+            node_id
+            for doc_id in doc_ids
+            if (ref_doc_info := docstore.get_ref_doc_info(doc_id)) is not None
+            for node_id in ref_doc_info.node_ids
+        ]
+        nodes, embeddings = [], []
+        for node_id in node_ids:
+            node = docstore.get_document(node_id, raise_error=False)
+            if node is None:
+                continue
+            try:
+                embeddings.append(vector_index.vector_store.get(node.node_id))
+            except KeyError:
+                continue
+            nodes.append(node)
+        return nodes, np.asarray(embeddings, dtype=np.float32)
+
+    def _cluster_contexts(
+        self, nodes: list[BaseNode], embeddings: np.ndarray, n_questions: int
+    ) -> list[tuple[str, int]]:
+        """the context of each cluster and its number of questions, the largest
+        clusters get the remaining questions
+        """
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        # random seed, so the quizzes in the pool differ
+        seed = int(np.random.default_rng().integers(2**31))
+        centroids, assignments = kmeans(embeddings, n_questions, seed=seed)
+        clusters = [
+            rows
+            for cluster in range(len(centroids))
+            if len(rows := np.flatnonzero(assignments == cluster))
+        ]
+        clusters.sort(key=len, reverse=True)
+        shares = [n_questions // len(clusters)] * len(clusters)
+        for i in range(n_questions % len(clusters)):
+            shares[i] += 1
+
+        contexts = []
+        for rows, n in zip(clusters, shares):
+            centroid = embeddings[rows].mean(axis=0)
+            closest = rows[np.argsort(-(embeddings[rows] @ centroid))]
+            context = "\n\n".join(
+                nodes[row].get_content(metadata_mode=MetadataMode.LLM)
+                for row in closest[: self.chunks_per_cluster]
+            )
+            contexts.append((context, n))
+        return contexts
+
+    def _generate_questions(
+        self, context: str, n_questions: int
+    ) -> list[MultipleChoiceQuestion]:
+        prompt = self.quiz_prompt.format(context_str=context, n_questions=n_questions)
+        response = self.llm.complete(prompt)
+        return self.output_parser.parse(response.text).questions
+
+    def generate(
+        self, vector_index: VectorStoreIndex, doc_ids: list[str], size: int = 3
+    ) -> MultipleChoiceTest:
+        nodes, embeddings = self._get_chunks(vector_index, doc_ids)
+        if not nodes:
+            raise ValueError("no chunks with embeddings found for the documents")
+        n_questions = math.ceil(size * self.oversampling)
+        contexts = self._cluster_contexts(nodes, embeddings, n_questions)
+        futures = [
+            self.executor.submit(self._generate_questions, context, n)
+            for context, n in contexts
+        ]
+        # round robin over the clusters, so a shortened test still covers them
+        generated: list[list[MultipleChoiceQuestion]] = []
+        for future in futures:
+            try:
+                generated.append(future.result())
+            except Exception:
+                logging.exception("questions of a cluster could not be generated")
+        questions = [
+            cluster_questions[i]
+            for i in range(max(map(len, generated), default=0))
+            for cluster_questions in generated
+            if i < len(cluster_questions)
+        ]
+        questions = dedupe_questions(questions)[:size]
+        if not questions:
+            raise ValueError("no questions could be generated")
+        logging.debug(
+            f"generated {len(questions)} quiz questions from {len(contexts)} clusters"
+        )
+        return MultipleChoiceTest(questions=questions)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class QuizPool:
+    """Quizzes generated in the background, keyed by the index version (the
+    documents of a session) and the number of questions.
+
+    Every key holds up to pool_size quizzes, finished or still generating. A
+    request takes the next one and the pool is refilled right away, so usually a
+    quiz is served without waiting for the llm. refill is called after a
+    document was added, invalidate when the documents are cleared.
+    """
+
+    def __init__(
+        self,
+        generator: QuizGenerator,
+        pool_size: int = 2,
+        max_workers: int = 2,
+        max_pools: int = 100,
+        default_size: int = 3,
+    ) -> None:
+        self.generator = generator
+        self.pool_size = pool_size
+        self.max_pools = max_pools
+        self.default_size = default_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="quiz"
+        )
+        self.pools: OrderedDict[tuple[str, int], deque[Future]] = OrderedDict()
+        self.served_ready = 0
+        self.served_pending = 0
+        self._lock = threading.Lock()
+
+    def _generate(
+        self, vector_index: VectorStoreIndex, doc_ids: list[str], size: int
+    ) -> MultipleChoiceTest:
+        try:
+            return self.generator.generate(vector_index, doc_ids, size=size)
+        except Exception:
+            logging.exception("quiz generation failed")
+            raise
+
+    def _submit(
+        self, vector_index: VectorStoreIndex, doc_ids: list[str], size: int
+    ) -> Future:
+        return self.executor.submit(self._generate, vector_index, list(doc_ids), size)
+
+    @staticmethod
+    def _failed(future: Future) -> bool:
+        return future.cancelled() or (future.done() and future.exception() is not None)
+
+    def _cancel(self, pool: deque[Future]) -> None:
+        for future in pool:
+            future.cancel()
+
+    def refill(
+        self,
+        index_version: str,
+        vector_index: VectorStoreIndex,
+        doc_ids: list[str],
+        size: int | None = None,
+    ) -> None:
+        key = (index_version, size or self.default_size)
+        with self._lock:
+            pool = self.pools.setdefault(key, deque())
+            self.pools.move_to_end(key)
+            for future in [f for f in pool if self._failed(f)]:
+                pool.remove(future)
+            while len(pool) < self.pool_size:
+                pool.append(self._submit(vector_index, doc_ids, key[1]))
+            while len(self.pools) > self.max_pools:
+                self._cancel(self.pools.popitem(last=False)[1])
+
+    def get(
+        self,
+        index_version: str,
+        vector_index: VectorStoreIndex,
+        doc_ids: list[str],
+        size: int | None = None,
+    ) -> Future:
+        """takes the next quiz (maybe still generating) and refills the pool"""
+        size = size or self.default_size
+        with self._lock:
+            pool = self.pools.get((index_version, size), deque())
+            while pool and self._failed(pool[0]):
+                pool.popleft()
+            if pool:
+                future = pool.popleft()
+            else:
+                future = self._submit(vector_index, doc_ids, size)
+            if future.done():
+                self.served_ready += 1
+            else:
+                self.served_pending += 1
+        self.refill(index_version, vector_index, doc_ids, size)
+        return future
+
+    def invalidate(self, index_version: str) -> None:
+        """drops the quizzes of all sizes of the index version"""
+        with self._lock:
+            for key in [key for key in self.pools if key[0] == index_version]:
+                self._cancel(self.pools.pop(key))
+
+    def clear(self) -> None:
+        with self._lock:
+            for pool in self.pools.values():
+                self._cancel(pool)
+            self.pools.clear()
+
+    def shutdown(self) -> None:
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.generator.shutdown()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pools": len(self.pools),
+                "ready": sum(f.done() for p in self.pools.values() for f in p),
+                "served_ready": self.served_ready,
+                "served_pending": self.served_pending,
+            }
@@ -0,0 +1,135 @@
+import hashlib
+import logging
+from collections.abc import Iterable
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.utilities import SQLDatabase
+
+from .lexical_index import BM25Index
+
+
+def describe_table(
+    table: str, columns: Iterable[tuple[str, str]], foreign_keys: Iterable[str]
+) -> str:
+    """short description of a table for retrieval, identifiers are split into
+    words as well, so "user_reviews" matches a question about "reviews"
+    """
+    columns = list(columns)
+    description = f"Table {table} ({table.replace('_', ' ')}). "
+    description += (
+        f"Columns: {', '.join(f'{name} {type_}' for name, type_ in columns)} "
+    )
+    description += f"({' '.join(name.replace('_', ' ') for name, _ in columns)})."
+    if foreign_keys:
+        description += f" Foreign keys: {', '.join(foreign_keys)}."
+    return description
+
+
+def table_descriptions(
+    database: SQLDatabase,
+) -> tuple[dict[str, str], dict[str, set[str]]]:
+    """descriptions of the usable tables and the tables linked with each table
+    by foreign keys
+    """
+    inspector = database._inspector
+    tables = sorted(database.get_usable_table_names())
+    descriptions = {}
+    neighbours: dict[str, set[str]] = {table: set() for table in tables}
+    for table in tables:
+        columns = [
+            (column["name"], str(column["type"]))
+            for column in inspector.get_columns(table)
+        ]
+        foreign_keys = []
+        for foreign_key in inspector.get_foreign_keys(table):
+            referred_table = foreign_key["referred_table"]
+            foreign_keys.append(
+                f"{', '.join(foreign_key['constrained_columns'])} -> "
+                f"{referred_table}({', '.join(foreign_key['referred_columns'])})"
+            )
+            if referred_table in neighbours and referred_table != table:
+                neighbours[table].add(referred_table)
+                neighbours[referred_table].add(table)
+        descriptions[table] = describe_table(table, columns, foreign_keys)
+    logging.debug(f"described {len(tables)} tables")
+    return descriptions, neighbours
+
+
+def schema_fingerprint(descriptions: dict[str, str]) -> str:
+    """hash of the tables and columns, the same for all copies of a database"""
+    return hashlib.sha256(
+        "\n".join(descriptions[table] for table in sorted(descriptions)).encode()
+    ).hexdigest()
+
+
+class SchemaIndex:
+    """Lexical (BM25) and embedding index over table descriptions of a database.
+
+    retrieve returns the top_k tables for a question, fused with reciprocal rank
+    fusion, followed by the tables they are linked with by foreign keys (in
+    both directions), so the sql prompt only contains the relevant part of the
+    schema. Without an embedding model the retrieval is lexical only.
+    """
+
+    def __init__(
+        self,
+        descriptions: dict[str, str],
+        neighbours: dict[str, set[str]],
+        embed_model: Embeddings | None = None,
+        rrf_k: int = 60,
+    ) -> None:
+        self.descriptions = descriptions
+        self.neighbours = neighbours
+        self.embed_model = embed_model
+        self.rrf_k = rrf_k
+        self.tables = list(descriptions)
+        self.lexical_index = BM25Index()
+        for table, description in descriptions.items():
+            self.lexical_index.add(table, description)
+        self.embeddings: np.ndarray | None = None
+        if embed_model is not None and self.tables:
+            embeddings = np.asarray(
+                embed_model.embed_documents(list(descriptions.values())),
+                dtype=np.float32,
+            )
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            self.embeddings = embeddings / np.maximum(norms, 1e-12)
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+    @classmethod
+    def from_database(
+        cls, database: SQLDatabase, embed_model: Embeddings | None = None
+    ) -> "SchemaIndex":
+        return cls(*table_descriptions(database), embed_model)
+
+    def _vector_search(self, question: str, top_k: int) -> list[str]:
+        if self.embeddings is None or self.embed_model is None:
+            return []
+        query = np.asarray(self.embed_model.embed_query(question), dtype=np.float32)
+        scores = self.embeddings @ (query / max(np.linalg.norm(query), 1e-12))
+        return [self.tables[row] for row in np.argsort(-scores)[:top_k]]
+
+    def retrieve(
+        self, question: str, top_k: int = 5, max_tables: int | None = None
+    ) -> list[str]:
+        """the top_k tables for the question and their foreign key neighbours,
+        at most max_tables (default 2 * top_k) tables
+        """
+        max_tables = max_tables or 2 * top_k
+        lexical = [table for table, _ in self.lexical_index.search(question, top_k)]
+        fused_scores: dict[str, float] = {}
+        for ranking in (lexical, self._vector_search(question, top_k)):
+            for rank, table in enumerate(ranking):
+                fused_scores[table] = fused_scores.get(table, 0.0) + 1 / (
+                    self.rrf_k + rank + 1
+                )
+        selected = sorted(fused_scores, key=fused_scores.get, reverse=True)  # type: ignore
+        selected = selected[:top_k]
+        for table in list(selected):
+            for neighbour in sorted(self.neighbours.get(table, ())):
+                if neighbour not in selected and len(selected) < max_tables:
+                    selected.append(neighbour)
+        return selected
@@ -1,21 +1,23 @@
+import asyncio
+import hashlib
 import pathlib
+import threading
+import uuid
 import tiktoken
 import logging
 import os
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from functools import partial
+from typing import Any
 
 from llama_index import (
     SimpleWebPageReader,
-    VectorStoreIndex,
     SimpleDirectoryReader,
     ServiceContext,
-    StorageContext,
-    load_index_from_storage,
-    set_global_service_context,
     get_response_synthesizer,
 )
-from llama_index.readers import BeautifulSoupWebReader
-from llama_index.schema import Document
-from llama_index.llms import OpenAI
+from llama_index.schema import BaseNode, Document, MetadataMode, TextNode
+from llama_index.llms import ChatMessage, MessageRole, OpenAI
 from llama_index.node_parser import SimpleNodeParser
 from llama_index.text_splitter import TokenTextSplitter
 from llama_index.node_parser.extractors import (
@@ -31,41 +33,134 @@ from llama_index.callbacks import CallbackManager, TokenCountingHandler
 from llama_index.memory import ChatMemoryBuffer
 from llama_index.vector_stores.types import MetadataInfo, VectorStoreInfo
 
+from bs4 import BeautifulSoup
 from marvin import ai_model
 from marvin import settings as marvin_settings
 from llama_index.bridge.pydantic import BaseModel as LlamaBaseModel
 from llama_index.bridge.pydantic import Field as LlamaField
 
 from .document_categories import CATEGORY_LABELS
+from .http_cache import CachedHttpFetcher
+from .ingestion_cache import IngestionCache
 from .models import QuestionModel
+from .answer_cache import CachedAnswer, SemanticAnswerCache, normalize_question
+from .ann_index import IVFVectorStore
+from .index_persistence import IndexPersistence
+from .fast_path_chat_engine import FastPathCondenseQuestionChatEngine, needs_condensing
+from .lexical_index import HybridRetriever
+from .pdf_pages import iter_pages
+from .single_flight import SingleFlight
+from .vector_store import NumpyVectorStore
 
 if openai_api_key := os.getenv("OPENAI_API_KEY"):
     marvin_settings.openai.api_key = os.getenv("OPENAI_API_KEY")
     os.environ["MARVIN_OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")  # type: ignore
 
+tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
 
 class AITextDocument:
     """Loads and converts a text file into LlamaIndex nodes.
     The marvin ai_model predicts the text category based on a
     given list and gives a short summary of the text based on the given llm_str.
+
+    In the default "document" metadata mode the text is classified once based on a
+    representative sample, in "node" mode every node is classified separately.
+
+    The parsed nodes (incl. metadata and embeddings) are stored in a content
+    addressed ingestion cache, so a repeated upload of the same content only needs
+    to be inserted into the vector index.
     """
 
     cfd = pathlib.Path(__file__).parent / "data"
+    chunk_size = 1024
+    chunk_overlap = 20
+    # bump, if the ingestion pipeline changes in a way that invalidates cached nodes
+    ingestion_version = 1
+    metadata_mode = os.getenv("METADATA_EXTRACTION_MODE", "document")
+    metadata_sample_tokens = 2048
+    ingestion_cache: IngestionCache | None = IngestionCache(
+        pathlib.Path(__file__).parent / "ingestion_cache",
+        max_bytes=int(os.getenv("INGESTION_CACHE_MAX_MB", 512)) * 1024**2,
+    )
 
     def __init__(
         self,
         document_name: str,
         llm_str: str,
         callback_manager: CallbackManager | None = None,
+        metadata_mode: str | None = None,
+        stage_callback: Callable[[str], None] | None = None,
+        content_hash: str | None = None,
+        load_nodes: Callable[[], list] | None = None,
     ) -> None:
+        """load_nodes loads and splits the document (without metadata) on a cache
+        miss instead of this process, e.g. in a worker process (see load_and_split)
+        """
         self.callback_manager: CallbackManager | None = callback_manager
-        self.document = self._load_document(document_name)
-        self.nodes = self.split_document_and_extract_metadata(llm_str)
+        self.stage_callback = stage_callback
+        if metadata_mode is not None:
+            if metadata_mode not in ("document", "node"):
+                raise ValueError(f"unknown metadata mode: {metadata_mode}")
+            self.metadata_mode = metadata_mode
+        self.metadata_llm_calls = 0
+        self.metadata_tokens = 0
+        self.report_stage("load")
+        self.cache_key = self._get_cache_key(document_name, llm_str, content_hash)
+        if (cached_nodes := self._load_cached_nodes()) is not None:
+            logging.debug(f"ingestion cache hit for {document_name}")
+            self.nodes = cached_nodes
+        elif load_nodes is not None:
+            self.report_stage("split")
+            self.nodes = self.extract_metadata(load_nodes(), llm_str)
+        else:
+            self.nodes = self.split_document_and_extract_metadata(
+                llm_str, self._load_documents(document_name)
+            )
         self.category = self.nodes[0].metadata["marvin_metadata"].get("category")
         text_subject = self.nodes[0].metadata["marvin_metadata"].get("description")
         self.summary = f'You uploaded a {self.category.lower()} text, please ask any \
             question about "{text_subject}".'
 
+    def report_stage(self, stage: str) -> None:
+        if self.stage_callback is not None:
+            self.stage_callback(stage)
+
+    def _hash_content(self, identifier: str) -> str:
+        """hash of the raw content the document is built from"""
+        return IngestionCache.hash_file(AITextDocument.cfd / identifier)
+
+    def _get_cache_key(
+        self, identifier: str, llm_str: str, content_hash: str | None = None
+    ) -> str:
+        """content_hash can be passed, if it was already computed on upload"""
+        return IngestionCache.make_key(
+            content_hash or self._hash_content(identifier),
+            type(self).__name__,
+            llm_str,
+            self.chunk_size,
+            self.chunk_overlap,
+            self.metadata_mode,
+            self.ingestion_version,
+        )
+
+    def _load_cached_nodes(self) -> list | None:
+        if self.ingestion_cache is None:
+            return None
+        return self.ingestion_cache.get(self.cache_key)
+
+    def embed_nodes(self, embed_model) -> None:
+        """computes the embeddings of all nodes which have none yet and stores
+        the fully processed nodes in the ingestion cache
+        """
+        embed_documents([self], embed_model)
+
+    @classmethod
+    def invalidate_cache(cls) -> None:
+        """drops all cached ingestion results"""
+        if cls.ingestion_cache is not None:
+            cls.ingestion_cache.clear()
+
     @classmethod
     def _load_document(cls, identifier: str) -> Document:
         """loads only the data of the specified name
@@ -77,6 +172,13 @@ class AITextDocument:
             encoding="utf-8",
         ).load_data()[0]
 
+    @classmethod
+    def _load_documents(cls, identifier: str) -> Iterator[Document]:
+        """the parts of the document, which are split one after another (e.g.
+        the pages of a pdf), by default the whole document
+        """
+        yield cls._load_document(identifier)
+
     def _get_text_splitter(self):
         return TokenTextSplitter(
             separator=" ",
@@ -85,27 +187,142 @@ class AITextDocument:
             callback_manager=self.callback_manager,
         )
 
-    def _get_metadata_extractor(self, llm_str):
+    def _get_marvin_extractor(self, llm_str):
+        return TokenCountingMarvinExtractor(
+            marvin_model=AIMarvinDocument,
+            llm_model_string=llm_str,
+            show_progress=True,
+            callback_manager=self.callback_manager,
+        )
+
+    def _get_metadata_extractor(self, marvin_extractor):
         return MetadataExtractor(
-            extractors=[
-                MarvinMetadataExtractor(
-                    marvin_model=AIMarvinDocument,
-                    llm_model_string=llm_str,
-                    show_progress=True,
-                    callback_manager=self.callback_manager,
-                ),
-            ],
+            extractors=[marvin_extractor],
         )
 
-    def split_document_and_extract_metadata(self, llm_str):
+    def _get_node_parser(self, metadata_extractor=None):
         # text_splitter = self._get_text_splitter()
-        metadata_extractor = self._get_metadata_extractor(llm_str)
-        node_parser = SimpleNodeParser.from_defaults(
+        return SimpleNodeParser.from_defaults(
             # text_splitter=text_splitter,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
             metadata_extractor=metadata_extractor,
             callback_manager=self.callback_manager,
         )
-        return node_parser.get_nodes_from_documents([self.document], show_progress=True)
+
+    def split_document_and_extract_metadata(
+        self, llm_str, documents: Iterable[Document]
+    ):
+        self.report_stage("split")
+        if self.metadata_mode == "node":
+            # one marvin call per node, splitting and extraction are interleaved
+            self.report_stage("extract")
+            marvin_extractor = self._get_marvin_extractor(llm_str)
+            node_parser = self._get_node_parser(
+                self._get_metadata_extractor(marvin_extractor)
+            )
+            nodes = split_documents(node_parser, documents)
+            self.metadata_llm_calls = len(nodes)
+            self.metadata_tokens = marvin_extractor.used_tokens
+            self._log_metadata_extraction()
+            return nodes
+        nodes = split_documents(self._get_node_parser(), documents)
+        return self.extract_metadata(nodes, llm_str)
+
+    def extract_metadata(self, nodes, llm_str):
+        """adds the marvin metadata to the split nodes"""
+        self.report_stage("extract")
+        if self.metadata_mode == "node":
+            marvin_extractor = self._get_marvin_extractor(llm_str)
+            nodes = self._get_metadata_extractor(marvin_extractor).process_nodes(nodes)
+            self.metadata_llm_calls = len(nodes)
+            self.metadata_tokens = marvin_extractor.used_tokens
+        else:
+            metadata = self._extract_document_metadata(nodes, llm_str)
+            for node in nodes:
+                node.metadata["marvin_metadata"] = metadata
+        self._log_metadata_extraction()
+        return nodes
+
+    def _log_metadata_extraction(self) -> None:
+        logging.info(
+            f"metadata extraction ({self.metadata_mode} mode): "
+            f"{self.metadata_llm_calls} llm calls, {self.metadata_tokens} tokens"
+        )
+
+    def _extract_document_metadata(self, nodes, llm_str) -> dict:
+        """classifies a representative sample of the whole text with a single
+        marvin call
+        """
+        sample = self._get_metadata_sample(nodes)
+        marvin_extractor = self._get_marvin_extractor(llm_str)
+        metadata = marvin_extractor.extract([TextNode(text=sample)])[0]
+        self.metadata_llm_calls = 1
+        self.metadata_tokens = marvin_extractor.used_tokens
+        return metadata["marvin_metadata"]
+
+    def _get_metadata_sample(self, nodes) -> str:
+        """picks evenly spaced nodes (always starting with the first one, which
+        usually holds title and introduction) until the token budget is used up
+        """
+        budget = self.metadata_sample_tokens
+        n_samples = min(len(nodes), max(1, budget // self.chunk_size + 1))
+        step = len(nodes) / n_samples
+        samples = []
+        for i in range(n_samples):
+            text = nodes[int(i * step)].get_content()
+            tokens = tokenizer.encode(text)[: max(budget // n_samples, 1)]
+            samples.append(tokenizer.decode(tokens))
+        return "\n...\n".join(samples)
+
+
+def split_documents(node_parser, documents: Iterable[Document]) -> list:
+    """splits the documents one by one, only their nodes are kept in memory and
+    not all loaded parts at once
+    """
+    nodes = [
+        node
+        for document in documents
+        for node in node_parser.get_nodes_from_documents([document])
+    ]
+    if not nodes:
+        raise ValueError("The document contains no text.")
+    return nodes
+
+
+def load_and_split(
+    document_cls: type[AITextDocument], identifier: str
+) -> list[TextNode]:
+    """loads and splits a document without metadata, runs in a worker process
+    (e.g. the cpu bound parsing of pdf files)
+    """
+    node_parser = SimpleNodeParser.from_defaults(
+        chunk_size=document_cls.chunk_size, chunk_overlap=document_cls.chunk_overlap
+    )
+    return split_documents(node_parser, document_cls._load_documents(identifier))
+
+
+def embed_documents(documents: list[AITextDocument], embed_model) -> None:
+    """computes the embeddings of the nodes of all documents, which have none
+    yet, in one batched call and stores the documents in the ingestion cache
+    """
+    missing = [
+        (document, node)
+        for document in documents
+        for node in document.nodes
+        if node.embedding is None
+    ]
+    if not missing:
+        return
+    embeddings = embed_model.get_text_embedding_batch(
+        [node.get_content(metadata_mode=MetadataMode.EMBED) for _, node in missing],
+        show_progress=True,
+    )
+    for (_, node), embedding in zip(missing, embeddings):
+        node.embedding = embedding
+    for document in dict.fromkeys(document for document, _ in missing):
+        if document.ingestion_cache is not None:
+            document.ingestion_cache.put(document.cache_key, document.nodes)
 
 
 @ai_model
@@ -130,19 +347,61 @@ class AIMarvinDocument(LlamaBaseModel):
     )
 
 
+class TokenCountingMarvinExtractor(MarvinMetadataExtractor):
+    """counts the tokens of the marvin calls as reported by the openai api"""
+
+    used_tokens: int = LlamaField(default=0)
+
+    def extract(self, nodes: Sequence[BaseNode]) -> list[dict]:
+        metadata_list: list[dict] = []
+        for node in nodes:
+            if self.is_text_node_only and not isinstance(node, TextNode):
+                metadata_list.append({})
+                continue
+            metadata = self.marvin_model(node.get_content())
+            # the response of the (last) function call of the marvin executor
+            llm_response = getattr(metadata._message, "llm_response", None) or {}
+            self.used_tokens += llm_response.get("usage", {}).get("total_tokens", 0)
+            metadata_list.append({"marvin_metadata": metadata.dict()})
+        return metadata_list
+
+
 class AIPdfDocument(AITextDocument):
+    """The text of all pages is extracted with pypdf, page ranges of larger files
+    in parallel worker processes, and split page by page. The nodes keep the
+    page number (page_label) and the file name in their metadata.
+    """
+
+    # cached nodes of the first page only loader are outdated
+    ingestion_version = 2
+    pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", 16))
+
     @classmethod
-    def _load_document(cls, identifier: str) -> Document:
-        # loader = PDFReader()
-        # return loader.load_data(
-        #     file=pathlib.Path(str(AITextDocument.cfd / identifier))
-        # )[0]
-        return SimpleDirectoryReader(
-            input_files=[pathlib.Path(str(AITextDocument.cfd / identifier))]
-        ).load_data()[0]
+    def _load_documents(cls, identifier: str) -> Iterator[Document]:
+        path = AITextDocument.cfd / identifier
+        # the pages are parts of one ref doc
+        doc_id = str(uuid.uuid4())
+        for page_number, text in iter_pages(path, cls.pages_per_task):
+            # e.g. scanned pages without a text layer
+            if text.strip():
+                yield Document(
+                    id_=doc_id,
+                    text=text,
+                    metadata={"page_label": str(page_number), "file_name": path.name},
+                )
 
 
 class AIHtmlDocument(AITextDocument):
+    """The page is fetched through an http cache with pooled connections, an
+    unchanged page (same raw bytes) is an ingestion cache hit and is neither
+    parsed, split nor embedded again.
+    """
+
+    http_fetcher = CachedHttpFetcher(
+        pathlib.Path(__file__).parent / "http_cache",
+        max_bytes=int(os.getenv("HTTP_CACHE_MAX_MB", 256)) * 1024**2,
+    )
+
     @classmethod
     def _load_document_simplewebpageReader(cls, identifier: str) -> Document:
         """loads the data of a simple static website at a given url
@@ -154,27 +413,33 @@ class AIHtmlDocument(AITextDocument):
             [identifier]
         )[0]
 
-    @classmethod
-    def _load_document_BeautifulSoupWebReader(cls, identifier: str) -> Document:
-        """loads the data of an html file at a given url
-        identifier: url of the html file as str
+    def __init__(
+        self,
+        document_name: str,
+        llm_str: str,
+        *args: Any,
+        content: bytes | None = None,
+        **kwargs: Any,
+    ) -> None:
+        """content is the raw page, if it was fetched already (e.g. by the
+        crawler), else the page is fetched once for the hash and the parsing
         """
-        # from llama_index import download_loader
-
-        # BeautifulSoupWebReader = download_loader("BeautifulSoupWebReader")
+        self.content = content
+        super().__init__(document_name, llm_str, *args, **kwargs)
+        # the nodes hold the text
+        self.content = None
 
-        # loader = BeautifulSoupWebReader()
-        # return loader.load_data(urls=[identifier])[0]
-        return BeautifulSoupWebReader().load_data(urls=[identifier])[0]
+    @classmethod
+    def _parse(cls, identifier: str, content: bytes) -> Document:
+        """extracts the text of the page (like the BeautifulSoupWebReader)"""
+        soup = BeautifulSoup(content, "html.parser")
+        return Document(text=soup.getText(), metadata={"URL": identifier})
 
     @classmethod
     def _load_document(cls, identifier: str) -> Document:
         """loads the data of an html file at a given url
         identifier: url of the html file as str
         """
-        if "wikipedia" in identifier:
-            return cls._load_document_BeautifulSoupWebReader(identifier)
-
         # It's not easy to scrape complex/ dynamic websites, this is a task for
         # itself and is not covered here.
         # Currently LlamaHub offers some different options for WebReaders, but
@@ -182,11 +447,208 @@ class AIHtmlDocument(AITextDocument):
         # Check and if availabe implement better ones in future or work on
         # configuring existing ones for specific tasks ...
         # return cls._load_document_simplewebpageReader(identifier)
-        return cls._load_document_BeautifulSoupWebReader(identifier)
+        return cls._parse(
+            identifier, cls.http_fetcher.fetch(identifier, revalidate=False).content
+        )
+
+    def _load_documents(self, identifier: str) -> Iterator[Document]:  # type: ignore[override]
+        """parses the page fetched by _hash_content or passed as content"""
+        if self.content is None:
+            yield self._load_document(identifier)
+        else:
+            yield self._parse(identifier, self.content)
+
+    def _hash_content(self, identifier: str) -> str:
+        """hash of the raw page, a conditional request, if the cached copy is
+        stale, the page is only parsed on an ingestion cache miss
+        """
+        if self.content is None:
+            self.content = self.http_fetcher.fetch(identifier).content
+        return IngestionCache.hash_bytes(self.content)
+
+
+class SharedTextIndex:
+    """The vector and lexical index shared by all text chat sessions.
+
+    A document is stored once, however many sessions uploaded it: documents with
+    the same content get the same (cached) nodes and ref doc ids, the sessions
+    only hold references (one per session, however often it uploaded the
+    document). A document is deleted, when its last session releases it.
+    """
+
+    cfd = pathlib.Path(__file__).parent
+
+    def __init__(self) -> None:
+        self.service_context = ServiceContext.from_defaults(
+            chunk_size=1024, chunk_overlap=152
+        )
+        # ingestion jobs run in worker threads, index updates are serialized
+        self.index_lock = threading.Lock()
+        # snapshot + write-ahead log, an upload only appends its own nodes
+        self.persistence = IndexPersistence(
+            SharedTextIndex.cfd / "storage",
+            compact_every=int(os.getenv("INDEX_COMPACT_EVERY", 50)),
+            **self._get_vector_store_config(),
+        )
+        self.vector_index = self.persistence.load_index(self.service_context)
+        # inverted index for bm25, built incrementally and persisted with the index
+        self.lexical_index = self.persistence.lexical_index
+        # owners (sessions) per ref doc id, documents loaded from storage
+        # without a session are deleted on their first release
+        self.owners: dict[str, set[str]] = {}
+        # a document loaded once for concurrent uploads is embedded once as well
+        self.embedding_flight = SingleFlight()
+        # answers to deterministic questions, shared by sessions with equal documents
+        self.answer_cache = SemanticAnswerCache(
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", 1000)),
+            ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", 3600)),
+            similarity_threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+        )
+
+    @staticmethod
+    def _get_vector_store_config() -> dict:
+        """exact search or the approximate ivf index (which searches exactly as
+        well, until the corpus reaches IVF_MIN_TRAIN_SIZE chunks)
+        """
+        if os.getenv("VECTOR_INDEX", "ivf") == "exact":
+            return {"vector_store_cls": NumpyVectorStore}
+        n_lists = os.getenv("IVF_N_LISTS")
+        return {
+            "vector_store_cls": IVFVectorStore,
+            "vector_store_kwargs": {
+                "n_lists": int(n_lists) if n_lists else None,
+                "n_probe": int(os.getenv("IVF_N_PROBE", 8)),
+                "min_train_size": int(os.getenv("IVF_MIN_TRAIN_SIZE", 10_000)),
+            },
+        }
+
+    def _contains(self, ref_doc_id: str) -> bool:
+        return self.vector_index.docstore.get_ref_doc_info(ref_doc_id) is not None
+
+    @staticmethod
+    def _ref_doc_ids(document: AITextDocument) -> list[str]:
+        return list(dict.fromkeys(str(node.ref_doc_id) for node in document.nodes))
+
+    def _is_indexed(self, document: AITextDocument) -> bool:
+        return all(self._contains(i) for i in self._ref_doc_ids(document))
+
+    def add_document(
+        self,
+        document: AITextDocument,
+        owner: str,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> list[str]:
+        """adds the nodes of all new ref docs of the document to the index, the
+        owner holds a reference to them, returns the ref doc ids of the document
+        """
+        if stage_callback:
+            stage_callback("embed")
+        if not self._is_indexed(document):
+            self.embedding_flight.do(
+                id(document),
+                partial(document.embed_nodes, self.service_context.embed_model),
+            )
+        return self._insert([document], owner, stage_callback)[0]
+
+    def add_documents(
+        self,
+        documents: list[AITextDocument],
+        owner: str,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> list[list[str]]:
+        """like add_document for a batch of documents: the embeddings of all
+        documents are computed in one batched call, the index is updated, logged
+        and persisted once
+        """
+        if stage_callback:
+            stage_callback("embed")
+        embed_documents(
+            [document for document in documents if not self._is_indexed(document)],
+            self.service_context.embed_model,
+        )
+        return self._insert(documents, owner, stage_callback)
+
+    def _insert(
+        self,
+        documents: list[AITextDocument],
+        owner: str,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> list[list[str]]:
+        """inserts the new nodes of the embedded documents and returns the ref doc
+        ids of each document
+        """
+        if stage_callback:
+            stage_callback("persist")
+        with self.index_lock:
+            new_nodes = list(
+                {
+                    node.node_id: node
+                    for document in documents
+                    for node in document.nodes
+                    if not self._contains(str(node.ref_doc_id))
+                }.values()
+            )
+            if new_nodes:
+                self.vector_index.insert_nodes(new_nodes)
+                self.lexical_index.add_nodes(new_nodes)
+                self.persistence.log_insert(new_nodes)
+                self.persistence.maybe_compact(self.vector_index.storage_context)
+            else:
+                logging.debug(f"all nodes of {len(documents)} documents are indexed")
+            ref_doc_ids = [self._ref_doc_ids(document) for document in documents]
+            for ref_doc_id in (i for ids in ref_doc_ids for i in ids):
+                self.owners.setdefault(ref_doc_id, set()).add(owner)
+        return ref_doc_ids
+
+    def release(self, ref_doc_ids: list[str], owner: str) -> None:
+        """drops the reference of the owner to each ref doc, unreferenced ones
+        are deleted
+        """
+        with self.index_lock:
+            for ref_doc_id in ref_doc_ids:
+                owners = self.owners.pop(ref_doc_id, set())
+                owners.discard(owner)
+                if owners:
+                    self.owners[ref_doc_id] = owners
+                elif self._contains(ref_doc_id):
+                    self.vector_index.delete_ref_doc(
+                        ref_doc_id, delete_from_docstore=True
+                    )
+                    self.lexical_index.remove_group(ref_doc_id)
+                    self.persistence.log_delete(ref_doc_id)
+            self.persistence.maybe_compact(self.vector_index.storage_context)
+
+    def clear(self) -> None:
+        """deletes all documents of all sessions"""
+        with self.index_lock:
+            for ref_doc_id in list(self.vector_index.ref_doc_info.keys()):
+                self.vector_index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+            self.lexical_index.clear()
+            self.owners.clear()
+            self.answer_cache.clear()
+            # the snapshot of an empty index is small, no need to log the deletes
+            self.persistence.compact(self.vector_index.storage_context)
+
+
+_shared_text_index: SharedTextIndex | None = None
+_shared_text_index_lock = threading.Lock()
+
+
+def get_shared_text_index() -> SharedTextIndex:
+    global _shared_text_index
+    with _shared_text_index_lock:
+        if _shared_text_index is None:
+            _shared_text_index = SharedTextIndex()
+        return _shared_text_index
 
 
 class CustomLlamaIndexChatEngineWrapper:
-    """A LlamaIndex CondenseQuestionChatEngine with RetrieverQueryEngine"""
+    """A LlamaIndex CondenseQuestionChatEngine with RetrieverQueryEngine.
+
+    Every chat session has its own wrapper with llm, chat memory and callback
+    manager, the retrieval is restricted to the documents of the session in the
+    shared index.
+    """
 
     system_prompt: str = """You are a chatbot that responds to all questions about 
     the given context. The user gives you instructions on which questions to answer. 
@@ -202,74 +664,112 @@ class CustomLlamaIndexChatEngineWrapper:
     OPENAI_MODEL = "gpt-3.5-turbo-instruct"
     # OPENAI_MODEL = "text-davinci-003"
     cfd = pathlib.Path(__file__).parent
+    # identical questions about the same documents wait for the one in flight
+    answer_flight = SingleFlight()
 
-    def __init__(self, callback_manager=None):
+    def __init__(
+        self, callback_manager=None, shared_index: SharedTextIndex | None = None
+    ):
         self.callback_manager = callback_manager
         self.data_category: str = ""  # default, if no document is loaded yet
+        self.shared_index = shared_index or get_shared_text_index()
+        # the session holds one reference per ref doc in the shared index
+        self.owner_id = uuid.uuid4().hex
         self.llm = OpenAI(
             model=CustomLlamaIndexChatEngineWrapper.OPENAI_MODEL,
             temperature=0,
             max_tokens=512,
         )
         self.service_context = self._create_service_context()
-        set_global_service_context(self.service_context)
         self.documents = []
-        storage_dir = CustomLlamaIndexChatEngineWrapper.cfd / "storage"
-        storage_dir.mkdir(parents=True, exist_ok=True)
-        # logging.info(f"storage dir exists: {os.path.exists(storage_dir)}")
-        if any(
-            pathlib.Path(CustomLlamaIndexChatEngineWrapper.cfd / "storage").iterdir()
-        ):
-            self.storage_context = StorageContext.from_defaults(
-                persist_dir=str(CustomLlamaIndexChatEngineWrapper.cfd / "storage"),
-            )
-            self.vector_index = load_index_from_storage(
-                storage_context=self.storage_context
-            )
-        else:
-            logging.debug("creating new vec index")
-            self.vector_index = self.create_vector_index()
+        # ref doc ids of the session, shared with the retrievers (updated in place)
+        self.doc_ids: list[str] = []
+        self.retrieval_mode = os.getenv("RETRIEVAL_MODE", "hybrid")
+        # question embeddings of the answer cache lookup, reused by the retrieval
+        self.query_embeddings: dict[str, list[float]] = {}
+        # "fast_path" skips condensing self-contained questions, "always" condenses
+        self.condense_mode = os.getenv("CONDENSE_MODE", "fast_path")
+        # both engines share the chat memory
+        self.chat_memory = ChatMemoryBuffer.from_defaults(token_limit=1500)
         self.chat_engine = self.create_chat_engine()
+        self.streaming_chat_engine = self.create_chat_engine(streaming=True)
+
+    @property
+    def vector_index(self):
+        return self.shared_index.vector_index
+
+    @property
+    def lexical_index(self):
+        return self.shared_index.lexical_index
+
+    @property
+    def answer_cache(self) -> SemanticAnswerCache:
+        return self.shared_index.answer_cache
+
+    @property
+    def index_version(self) -> str:
+        """identifies the searchable documents and the answer settings, the
+        content of a ref doc never changes
+        """
+        key = "|".join([self.OPENAI_MODEL, self.retrieval_mode, *sorted(self.doc_ids)])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
     def _create_service_context(self):
         return ServiceContext.from_defaults(
             chunk_size=1024,
             chunk_overlap=152,
             llm=self.llm,
+            embed_model=self.shared_index.service_context.embed_model,
             system_prompt=CustomLlamaIndexChatEngineWrapper.system_prompt,
             callback_manager=self.callback_manager,
         )
 
-    def add_document(self, document: AITextDocument) -> None:
-        self.documents.append(document)
-        self._add_to_vector_index(document.nodes)
-        self.data_category = document.category
-        self.vector_index.storage_context.persist(
-            persist_dir=CustomLlamaIndexChatEngineWrapper.cfd / "storage"
+    def add_document(
+        self,
+        document: AITextDocument,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> None:
+        ref_doc_ids = self.shared_index.add_document(
+            document, self.owner_id, stage_callback
+        )
+        self._add_to_session([document], [ref_doc_ids])
+
+    def add_documents(
+        self,
+        documents: list[AITextDocument],
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> None:
+        """adds a batch of documents, embedded and persisted together"""
+        ref_doc_ids = self.shared_index.add_documents(
+            documents, self.owner_id, stage_callback
         )
+        self._add_to_session(documents, ref_doc_ids)
+
+    def _add_to_session(
+        self, documents: list[AITextDocument], ref_doc_ids: list[list[str]]
+    ) -> None:
+        self.answer_cache.invalidate(self.index_version)
+        self.documents.extend(documents)
+        for ids in ref_doc_ids:
+            self.doc_ids.extend(i for i in ids if i not in self.doc_ids)
+        self.data_category = documents[-1].category
 
     def clear_data_storage(self) -> None:
-        doc_ids = list(self.vector_index.ref_doc_info.keys())
-        for doc_id in doc_ids:
-            self.vector_index.delete_ref_doc(doc_id, delete_from_docstore=True)
-        self.vector_index.storage_context.persist(
-            persist_dir=CustomLlamaIndexChatEngineWrapper.cfd / "storage"
-        )
+        self.answer_cache.invalidate(self.index_version)
+        self.shared_index.release(self.doc_ids, self.owner_id)
+        self.doc_ids.clear()
         self.documents.clear()
         # data folder with filed is cleared in respective route in fastapi_app.py
 
-    def create_vector_index(self):
-        return VectorStoreIndex(
-            [
-                node for doc in self.documents for node in doc.nodes
-            ],  # current use case: no docs availabe, so empty list []
-            service_context=self.service_context,
-        )
-
-    def _add_to_vector_index(self, nodes):
-        self.vector_index.insert_nodes(
-            nodes,
+    def approximate_size(self) -> int:
+        """rough memory estimate in bytes (chat history and loaded documents)"""
+        size = sum(
+            len(str(message.content)) for message in self.chat_engine.chat_history
         )
+        for document in self.documents:
+            for node in document.nodes:
+                size += len(node.get_content()) + 8 * len(node.embedding or [])
+        return size
 
     def _create_vector_index_retriever(self):
         vector_store_info = VectorStoreInfo(
@@ -294,17 +794,39 @@ class CustomLlamaIndexChatEngineWrapper:
             index=self.vector_index,
             vector_store_info=vector_store_info,
             similarity_top=10,
+            doc_ids=self.doc_ids,
+        )
+
+    def _create_retriever(self) -> HybridRetriever:
+        """bm25 + vector retrieval, RETRIEVAL_MODE=lexical skips the query
+        embedding entirely
+        """
+        return HybridRetriever(
+            vector_retriever=self._create_vector_index_retriever(),
+            lexical_index=self.lexical_index,
+            docstore=self.vector_index.docstore,
+            mode=self.retrieval_mode,
+            doc_ids=self.doc_ids,
+            query_embeddings=self.query_embeddings,
         )
 
-    def create_chat_engine(self) -> CondenseQuestionChatEngine:
+    def create_chat_engine(self, streaming: bool = False) -> CondenseQuestionChatEngine:
         vector_query_engine = RetrieverQueryEngine(
-            retriever=self._create_vector_index_retriever(),
-            response_synthesizer=get_response_synthesizer(),
+            retriever=self._create_retriever(),
+            response_synthesizer=get_response_synthesizer(
+                service_context=self.service_context, streaming=streaming
+            ),
             callback_manager=self.callback_manager,
         )
-        return CondenseQuestionChatEngine.from_defaults(
+        chat_engine_cls = (
+            FastPathCondenseQuestionChatEngine
+            if self.condense_mode == "fast_path"
+            else CondenseQuestionChatEngine
+        )
+        return chat_engine_cls.from_defaults(
             query_engine=vector_query_engine,
-            memory=ChatMemoryBuffer.from_defaults(token_limit=1500),
+            memory=self.chat_memory,
+            service_context=self.service_context,
             verbose=True,
             callback_manager=self.callback_manager,
         )
@@ -315,12 +837,107 @@ class CustomLlamaIndexChatEngineWrapper:
 
     def update_temp(self, temperature):
         # see https://gpt-index.readthedocs.io/en/v0.8.34/examples/llm/XinferenceLocalDeployment.html
-        self.vector_index.service_context.llm.__dict__.update(
-            {"temperature": temperature}
+        self.llm.__dict__.update({"temperature": temperature})
+
+    def _add_to_chat_history(self, question: str, answer: str) -> None:
+        self.chat_memory.put(ChatMessage(role=MessageRole.USER, content=question))
+        self.chat_memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    def _embed_question(self, question: str) -> list[float]:
+        """the query embedding for the answer cache, kept for the retrieval"""
+        embed_model = self.shared_index.service_context.embed_model
+        embedding = embed_model.get_query_embedding(question)
+        self.query_embeddings[question] = embedding
+        return embedding
+
+    def _lookup_cached_answer(
+        self, question: QuestionModel
+    ) -> tuple[CachedAnswer | None, Callable[[str], None] | None]:
+        """returns the cached answer or, on a miss, a callback which stores the
+        new answer. Only deterministic answers (temperature 0) are cached, which
+        do not depend on the chat history: no history yet, or a self-contained
+        question, which the fast path does not condense. In lexical retrieval
+        mode, which needs no embeddings, only the exact question is looked up.
+        """
+        if question.temperature != 0 or not self.doc_ids:
+            return None, None
+        if self.chat_memory.get_all() and (
+            self.condense_mode != "fast_path" or needs_condensing(question.prompt)
+        ):
+            return None, None
+        index_version = self.index_version
+        answer, embedding = self.answer_cache.lookup(
+            question.prompt,
+            index_version,
+            None if self.retrieval_mode == "lexical" else self._embed_question,
+        )
+        if answer is not None:
+            self.query_embeddings.pop(question.prompt, None)
+            self._add_to_chat_history(question.prompt, answer)
+            return answer, None
+        store = partial(
+            self.answer_cache.put, question.prompt, index_version, embedding=embedding
         )
+        return None, store
+
+    def _answer_flight_key(self, question: QuestionModel) -> tuple[str, str]:
+        return self.index_version, normalize_question(question.prompt)
+
+    def _use_shared_answer(self, question: QuestionModel, response) -> str:
+        """the answer was computed by the chat engine of another session"""
+        self.query_embeddings.pop(question.prompt, None)
+        self._add_to_chat_history(question.prompt, str(response))
+        return str(response)
 
     def answer_question(self, question: QuestionModel) -> str:
-        return self.chat_engine.chat(question.prompt)
+        cached_answer, store_answer = self._lookup_cached_answer(question)
+        if cached_answer is not None:
+            return cached_answer
+        if store_answer is None:
+            # depends on the chat history of this session
+            return self.chat_engine.chat(question.prompt)
+        response, shared = self.answer_flight.do(
+            self._answer_flight_key(question),
+            partial(self.chat_engine.chat, question.prompt),
+        )
+        if shared:
+            return self._use_shared_answer(question, response)
+        store_answer(str(response))
+        return response
+
+    async def aanswer_question(self, question: QuestionModel) -> str:
+        # the cache lookup may need a (blocking) embedding call
+        cached_answer, store_answer = await asyncio.to_thread(
+            self._lookup_cached_answer, question
+        )
+        if cached_answer is not None:
+            return cached_answer
+        if store_answer is None:
+            return await self.chat_engine.achat(question.prompt)
+        response, shared = await self.answer_flight.ado(
+            self._answer_flight_key(question),
+            partial(self.chat_engine.achat, question.prompt),
+        )
+        if shared:
+            return self._use_shared_answer(question, response)
+        store_answer(str(response))
+        return response
+
+    def stream_answer(self, question: QuestionModel) -> Iterator[str]:
+        """yields the answer token by token, it is added to the chat history once
+        the stream is consumed. A cached answer is yielded at once.
+        """
+        cached_answer, store_answer = self._lookup_cached_answer(question)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        response = self.streaming_chat_engine.stream_chat(question.prompt)
+        tokens = []
+        for token in response.response_gen:
+            tokens.append(token)
+            yield token
+        if store_answer:
+            store_answer("".join(tokens))
 
 
 def set_up_text_chatbot():
@@ -1,43 +1,70 @@
 # https://python.langchain.com/docs/expression_language/cookbook/sql_db
 from __future__ import annotations
+import asyncio
 import logging
+import os
+import pathlib
 import re
 import sys
+import threading
+from functools import cached_property
 from typing import Any
 from operator import itemgetter
+from collections.abc import Callable, Iterator
 
+import numpy as np
+import tiktoken
 from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.utilities import SQLDatabase
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import (
     RunnableLambda,
     RunnableMap,
-    RunnablePassthrough,
     RunnableSequence,
 )
 from langchain.prompts import ChatPromptTemplate
 
 from langchain.callbacks import get_openai_callback
+from sqlalchemy.exc import DBAPIError
+
+from .models import QueryRejectedException, QuestionModel
+from .schema_index import SchemaIndex, schema_fingerprint, table_descriptions
+from .sql_examples import SQLExampleStore
+from .sqlite_engine import read_only_engine, sqlite_path
+from .sql_execution import GuardedSQLExecutor
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger(__name__).addHandler(logging.StreamHandler(stream=sys.stdout))
 
 
+def count_tokens(text: str, model: str) -> int:
+    return len(tiktoken.encoding_for_model(model).encode(text))
+
+
 class CustomTokenCounter:
     def __init__(self):
         self._total_llm_token_count = 0
+        self._prompt_llm_token_count = 0
 
     @property
     def total_llm_token_count(self):
         return self._total_llm_token_count
 
+    @property
+    def prompt_llm_token_count(self):
+        return self._prompt_llm_token_count
+
     def reset_counts(self) -> None:
         self._total_llm_token_count = 0
+        self._prompt_llm_token_count = 0
 
-    def add_count(self, value: int) -> None:
-        if isinstance(value, int) and value >= 0:
+    def add_count(self, value: int, prompt_tokens: int = 0) -> None:
+        if isinstance(value, int) and 0 <= prompt_tokens <= value:
             self._total_llm_token_count += value
+            self._prompt_llm_token_count += prompt_tokens
         else:
             raise ValueError(
                 """Invalid value to add to total_llm_token_count. 
@@ -46,79 +73,264 @@ class CustomTokenCounter:
 
 
 class AIDataBase(SQLDatabase):
-    """querying a database with langchain SQLDatabaseChain and Runnables"""
+    """querying a database with langchain SQLDatabaseChain and Runnables
+
+    The chain is compiled once per database. The table info (reflection and
+    sample rows) is cached until the database file changes. Databases with more
+    than SCHEMA_INDEX_MIN_TABLES tables get a schema index, the sql prompt then
+    only contains the tables relevant for the question.
+
+    Successful sql queries are stored as examples (shared by all databases with
+    the same schema): the sql of a very similar earlier question runs without
+    the sql generation llm call, similar questions are few-shot examples.
+    """
+
+    llm_name = "gpt-3.5-turbo"
+    schema_index_min_tables = int(os.getenv("SCHEMA_INDEX_MIN_TABLES", 15))
+    schema_top_k = int(os.getenv("SCHEMA_TOP_K", 5))
+    max_cached_schemas = 128
+    sql_examples = SQLExampleStore(
+        pathlib.Path(__file__).parent / "sql_example_store" / "examples.jsonl",
+        direct_threshold=float(os.getenv("SQL_EXAMPLE_DIRECT_THRESHOLD", 0.97)),
+        few_shot_threshold=float(os.getenv("SQL_EXAMPLE_FEW_SHOT_THRESHOLD", 0.8)),
+    )
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, embed_model: Embeddings | None = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.category = "database"
-        self.summary = (
-            "Table Info: "
-            + re.sub(r"/\*((.|\n)*?)\*/", "", self.get_table_info()).strip()
+        self._embed_model = embed_model
+        self._schema_fingerprint: tuple | None = None
+        self._schemas: dict[tuple[str, ...] | None, str] = {}
+        self._schema_lock = threading.Lock()
+        self.schema_tokens = 0  # of the last sql prompt
+        self.schema_index: SchemaIndex | None = None
+        self.query_executor = GuardedSQLExecutor(
+            self._engine,
+            fingerprint=self._fingerprint,
+            timeout_seconds=float(os.getenv("SQL_TIMEOUT_SECONDS", 10)),
+            max_rows=int(os.getenv("SQL_MAX_ROWS", 1000)),
+            max_scan_rows=int(float(os.getenv("SQL_MAX_SCAN_ROWS", 1e8))),
         )
+        descriptions, neighbours = table_descriptions(self)
+        self.schema_fingerprint = schema_fingerprint(descriptions)
+        tables = list(descriptions)
+        if len(tables) > self.schema_index_min_tables:
+            self.schema_index = SchemaIndex(
+                descriptions,
+                neighbours,
+                None
+                if os.getenv("SCHEMA_RETRIEVAL") == "lexical"
+                else self.embed_model,
+            )
+            self.summary = (
+                f"Table Info: {len(tables)} tables, the relevant tables are "
+                f"selected for each question: {', '.join(sorted(tables))}"
+            )
+        else:
+            self.summary = (
+                "Table Info: "
+                + re.sub(r"/\*((.|\n)*?)\*/", "", self.get_schema(None)).strip()
+            )
 
     @classmethod
     def from_uri(
-        cls, database_uri: str, engine_args: dict | None = None, **kwargs: Any
+        cls,
+        database_uri: str,
+        engine_args: dict | None = None,
+        read_only: bool = True,
+        **kwargs: Any,
     ) -> AIDataBase:
-        """Construct a SQLAlchemy engine from URI."""
+        """Construct a SQLAlchemy engine from URI, sqlite files are opened with
+        the shared read-only engine (uploaded databases are never written)
+        """
         from sqlalchemy import create_engine
 
+        if read_only and not engine_args and (path := sqlite_path(database_uri)):
+            return cls(read_only_engine(path), **kwargs)
         _engine_args = engine_args or {}
         return cls(create_engine(database_uri, **_engine_args), **kwargs)
 
-    def get_schema(self, _):
-        return self.get_table_info()
+    def _fingerprint(self) -> tuple | None:
+        """size and modification time of the database file (and its write-ahead
+        log), None for databases without a file
+        """
+        if not (database := sqlite_path(self._engine)):
+            return None
+        fingerprint = ()
+        for path in (database, f"{database}-wal"):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint += (stat.st_size, stat.st_mtime_ns)
+        return fingerprint
+
+    def _table_info(self, tables: tuple[str, ...] | None) -> str:
+        """cached table info of the given tables (all tables for None)"""
+        fingerprint = self._fingerprint()
+        with self._schema_lock:
+            if fingerprint != self._schema_fingerprint:
+                self._schemas.clear()
+                self._schema_fingerprint = fingerprint
+            if (schema := self._schemas.get(tables)) is None:
+                logging.debug(f"reading table info of {tables or 'all tables'}")
+                if len(self._schemas) >= self.max_cached_schemas:
+                    self._schemas.clear()
+                schema = self._schemas[tables] = self.get_table_info(
+                    list(tables) if tables else None
+                )
+            return schema
+
+    def get_schema(self, inputs: dict | None) -> str:
+        question = inputs.get("question") if isinstance(inputs, dict) else None
+        if self.schema_index is None or not question:
+            schema = self._table_info(None)
+        elif tables := self.schema_index.retrieve(question, self.schema_top_k):
+            schema = self._table_info(tuple(sorted(tables)))
+        else:
+            # no table matches, the short descriptions of all tables
+            schema = "\n".join(self.schema_index.descriptions.values())
+        self.schema_tokens = count_tokens(schema, self.llm_name)
+        logging.debug(f"schema in the sql prompt: {self.schema_tokens} tokens")
+        return schema
 
-    def run_query(self, working_dict):
-        logging.debug(f"Query: {working_dict['query']}")
-        return self.run(working_dict["query"])
+    @property
+    def embed_model(self) -> Embeddings:
+        if self._embed_model is None:
+            self._embed_model = OpenAIEmbeddings()
+        return self._embed_model
+
+    def run_query(self, query: str, stored: bool = False) -> tuple[str, bool]:
+        """the sql response and whether the query ran successfully, a stored
+        query, which fails in the database (e.g. after a schema change), is not
+        ok, so the query is generated instead
+        """
+        logging.debug(f"Query: {query}")
+        try:
+            return self.query_executor.run(query), True
+        except QueryRejectedException as e:
+            # the llm explains the problem in the answer
+            logging.info(f"query rejected: {e}")
+            return f"Error: {e}", False
+        except DBAPIError as e:
+            if not stored:
+                raise
+            logging.info(f"stored query failed: {e}")
+            return f"Error: {e}", False
+
+    def _create_chains(
+        self, llm: ChatOpenAI
+    ) -> tuple[RunnableSequence[Any, Any], RunnableSequence[Any, Any]]:
+        """with langchain Runnables, the sql query generator and the answer
+        generator
+        """
+        query_generator: RunnableSequence[Any, Any] = (
+            RunnableMap(
+                {
+                    "schema": RunnableLambda(self.get_schema),  # type: ignore
+                    "question": itemgetter("question"),
+                    "examples": itemgetter("examples"),
+                }
+            )
+            | ChatPromptTemplate.from_template(
+                """Based on the table schema below, write a SQL query that 
+                would answer the user's question:
+                {schema}
+                {examples}
+                Question: {question}
+                SQL Query:"""
+            )
+            | llm.bind(stop=["\nSQLResult:"])
+            | StrOutputParser()
+        )
+
+        answer_generator: RunnableSequence[Any, Any] = (
+            ChatPromptTemplate.from_template(
+                """Based on the question and the sql response, 
+                write a natural language response and finally add 
+                the sql query to your response:
+
+                Question: {question}
+                SQL Response: {response}
+                Query: {query}"""
+            )
+            | llm
+        )
+        return query_generator, answer_generator
+
+    @cached_property
+    def chains(self) -> tuple[RunnableSequence[Any, Any], RunnableSequence[Any, Any]]:
+        return self._create_chains(ChatOpenAI(temperature=0, model=self.llm_name))
+
+    def _find_examples(self, question: str) -> tuple[str | None, str, Any]:
+        """the sql of a direct match (or None), the few-shot examples for the
+        prompt and the question embedding, if it was computed
+        """
+        matches, embedding = self.sql_examples.search(
+            question, self.schema_fingerprint, self.embed_model.embed_query
+        )
+        if matches and matches[0][1] >= self.sql_examples.direct_threshold:
+            logging.info(f"sql of a stored example for: {question}")
+            return matches[0][0].sql, "", embedding
+        examples = "".join(
+            f"\nQuestion: {example.question}\nSQL Query: {example.sql}\n"
+            for example, _ in matches
+        )
+        if examples:
+            examples = f"Examples of questions and their SQL queries:{examples}"
+        return None, examples, embedding
+
+    def _remember(self, question: str, query: str, embedding: Any) -> None:
+        if embedding is None:
+            embedding = np.asarray(self.embed_model.embed_query(question))
+        self.sql_examples.add(question, query, self.schema_fingerprint, embedding)
 
     def ask_a_question(self, question: str, token_callback: CustomTokenCounter) -> str:
-        """with langchain SQLDatabaseChain and Runnables"""
-        llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-        # logging.debug(self.get_table_info())
+        query_generator, answer_generator = self.chains
         with get_openai_callback() as callback:
-            query_generator: RunnableSequence[Any, Any] = (
-                RunnableMap(
-                    {
-                        "schema": RunnableLambda(self.get_schema),  # type: ignore
-                        "question": itemgetter("question"),
-                    }
+            query, examples, embedding = self._find_examples(question)
+            if query is not None:
+                response, ok = self.run_query(query, stored=True)
+                if ok:
+                    self.sql_examples.record_direct()
+            if query is None or not ok:
+                query = query_generator.invoke(
+                    {"question": question, "examples": examples}
                 )
-                | ChatPromptTemplate.from_template(
-                    """Based on the table schema below, write a SQL query that 
-                    would answer the user's question:
-                    {schema}
-
-                    Question: {question}
-                    SQL Query:"""
-                )
-                | llm.bind(stop=["\nSQLResult:"])
-                | StrOutputParser()
-                | {"query": RunnablePassthrough()}
+                response, ok = self.run_query(query)
+                if ok:
+                    self._remember(question, query, embedding)
+            answer = answer_generator.invoke(
+                {"question": question, "response": response, "query": query}
             )
-
-            chain = (
-                query_generator
-                | {
-                    "response": RunnableLambda(self.run_query),
-                    "question": RunnablePassthrough(),
-                    "query": RunnablePassthrough(),
-                }
-                | ChatPromptTemplate.from_template(
-                    """Based on the question and the sql response, 
-                    write a natural language response and finally add 
-                    the sql query to your response:
-
-                    Question: {question}
-                    SQL Response: {response}
-                    Query: {query}"""
+            token_callback.add_count(callback.total_tokens, callback.prompt_tokens)
+        return answer.content
+
+    async def aask_a_question(
+        self, question: str, token_callback: CustomTokenCounter
+    ) -> str:
+        """async llm calls, the blocking sql query runs in a worker thread"""
+        query_generator, answer_generator = self.chains
+        with get_openai_callback() as callback:
+            query, examples, embedding = await asyncio.to_thread(
+                self._find_examples, question
+            )
+            if query is not None:
+                response, ok = await asyncio.to_thread(self.run_query, query, True)
+                if ok:
+                    self.sql_examples.record_direct()
+            if query is None or not ok:
+                query = await query_generator.ainvoke(
+                    {"question": question, "examples": examples}
                 )
-                | llm
+                response, ok = await asyncio.to_thread(self.run_query, query)
+                if ok:
+                    await asyncio.to_thread(self._remember, question, query, embedding)
+            answer = await answer_generator.ainvoke(
+                {"question": question, "response": response, "query": query}
             )
-            response = chain.invoke({"question": question})
-            token_callback.add_count(callback.total_tokens)
-        return response.content
+            token_callback.add_count(callback.total_tokens, callback.prompt_tokens)
+        return answer.content
 
 
 class DataChatBotWrapper:
@@ -127,7 +339,13 @@ class DataChatBotWrapper:
         self.token_callback: CustomTokenCounter = callback_manager
         self.document: AIDataBase | None = None
 
-    def add_document(self, document: AIDataBase) -> None:
+    def add_document(
+        self,
+        document: AIDataBase,
+        stage_callback: Callable[[str], None] | None = None,
+    ) -> None:
+        if stage_callback:
+            stage_callback("persist")
         self.document = document
 
     def clear_chat_history(self) -> str:
@@ -137,15 +355,33 @@ class DataChatBotWrapper:
         del self.document
         self.document = None
 
+    def approximate_size(self) -> int:
+        """rough memory estimate in bytes, the table info of the database"""
+        return len(self.document.summary) if self.document else 0
+
     def update_temp(self, temperature) -> None:  # type: ignore
         pass
 
-    def answer_question(self, question: str) -> str:
+    def answer_question(self, question: QuestionModel) -> str:
         if self.document:
-            return self.document.ask_a_question(question, self.token_callback)
+            return self.document.ask_a_question(question.prompt, self.token_callback)
         else:
             raise AttributeError("no document loaded")
 
+    async def aanswer_question(self, question: QuestionModel) -> str:
+        if self.document:
+            return await self.document.aask_a_question(
+                question.prompt, self.token_callback
+            )
+        else:
+            raise AttributeError("no document loaded")
+
+    def stream_answer(self, question: QuestionModel) -> Iterator[str]:
+        """the sql query has to run before the answer can be written, the answer
+        is yielded at once (token counting does not work for streamed responses)
+        """
+        yield self.answer_question(question)
+
 
 def set_up_database_chatbot():
     token_counter = CustomTokenCounter()
@@ -182,6 +418,6 @@ if __name__ == "__main__":
         """Which name has the user who wrote the largest amount of helpful reviews?"""
     )
     print(document.summary)
-    print(chat_engine.answer_question(question))
+    print(chat_engine.answer_question(QuestionModel(prompt=question, temperature=0)))
     logging.debug(f"Number of used tokens: {token_counter.total_llm_token_count}")
     # print(document.get_table_info())
@@ -0,0 +1,170 @@
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+DEFAULT_SESSION_ID = "default"
+
+
+class ChatSession:
+    """Chat engine, callback manager and token counter of one client session"""
+
+    # estimated fixed memory of a session (llm clients, prompts, engine objects)
+    base_size = 256 * 1024
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self.chat_engine: Any = None
+        self.callback_manager: Any = None
+        self.token_counter: Any = None
+        # uploaded files in the data folder, which belong to this session
+        self.files: set[Path] = set()
+        self.n_active = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_use(self) -> bool:
+        return self.n_active > 0
+
+    def acquire(self) -> None:
+        """marks the session as in use, e.g. by an ingestion job, so it is not
+        evicted meanwhile
+        """
+        with self._lock:
+            self.n_active += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.n_active -= 1
+
+    def set_chat_engine(
+        self, chat_engine: Any, callback_manager: Any, token_counter: Any
+    ) -> None:
+        if self.chat_engine is not None:
+            self.chat_engine.clear_data_storage()
+        self.chat_engine = chat_engine
+        self.callback_manager = callback_manager
+        self.token_counter = token_counter
+
+    def approximate_size(self) -> int:
+        if self.chat_engine is None:
+            return self.base_size
+        return self.base_size + self.chat_engine.approximate_size()
+
+    def close(self) -> None:
+        """releases the documents of the session"""
+        if self.chat_engine is not None:
+            self.chat_engine.clear_data_storage()
+        self.chat_engine = None
+        self.callback_manager = None
+        self.token_counter = None
+
+
+class SessionPool:
+    """LRU pool of chat sessions, keyed by the session id of the client.
+
+    The least recently used sessions are closed, when more than max_sessions are
+    open or their estimated memory exceeds max_bytes. Sessions in use and the
+    most recently used one are never evicted.
+    """
+
+    def __init__(self, max_sessions: int = 100, max_bytes: int = 512 * 1024**2):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self.n_evicted = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    def get(self, session_id: str | None = None) -> ChatSession:
+        """returns the session (a new one for unknown ids) as most recently used"""
+        session_id = session_id or DEFAULT_SESSION_ID
+        with self._lock:
+            if (session := self.sessions.get(session_id)) is None:
+                logging.debug(f"opening chat session {session_id}")
+                session = self.sessions[session_id] = ChatSession(session_id)
+            self.sessions.move_to_end(session_id)
+            self.evict()
+        return session
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return sum(s.approximate_size() for s in self.sessions.values())
+
+    def evict(self) -> list[str]:
+        """closes least recently used sessions until the pool is within its
+        limits, returns the ids of the evicted sessions
+        """
+        evicted: list[str] = []
+        with self._lock:
+            sizes = {
+                session_id: session.approximate_size()
+                for session_id, session in self.sessions.items()
+            }
+            total_size = sum(sizes.values())
+            candidates = [
+                session_id
+                for session_id, session in list(self.sessions.items())[:-1]
+                if not session.in_use
+            ]
+            for session_id in candidates:
+                if (
+                    len(self.sessions) <= self.max_sessions
+                    and total_size <= self.max_bytes
+                ):
+                    break
+                self.close(session_id)
+                total_size -= sizes[session_id]
+                evicted.append(session_id)
+            self.n_evicted += len(evicted)
+        if evicted:
+            logging.info(f"evicted chat sessions {evicted}")
+        return evicted
+
+    def clear(self, session_id: str) -> None:
+        """releases the documents and files of the session and keeps it open"""
+        with self._lock:
+            if session := self.sessions.get(session_id):
+                session.close()
+                self._remove_files(session)
+
+    def close(self, session_id: str) -> None:
+        with self._lock:
+            if session := self.sessions.pop(session_id, None):
+                session.close()
+                self._remove_files(session)
+
+    def close_all(self) -> None:
+        with self._lock:
+            for session_id in list(self.sessions):
+                self.close(session_id)
+
+    def _remove_files(self, session: ChatSession) -> None:
+        """deletes the uploaded files of the session, which no other session uses"""
+        files_in_use = {
+            file
+            for other in self.sessions.values()
+            if other is not session
+            for file in other.files
+        }
+        for file in session.files - files_in_use:
+            file.unlink(missing_ok=True)
+            # the folder of the content hash, if no other file is in it
+            with contextlib.suppress(OSError):
+                file.parent.rmdir()
+        session.files.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self.sessions),
+                "size_bytes": self.size_bytes(),
+                "evicted": self.n_evicted,
+            }
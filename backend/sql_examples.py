@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+
+from .answer_cache import normalize_question
+
+
+@dataclass
+class SQLExample:
+    question: str
+    sql: str
+    schema_fingerprint: str
+    embedding: np.ndarray | None = None
+
+
+class SQLExampleStore:
+    """Persistent store of successful (question, sql, schema fingerprint)
+    examples for generating sql from questions.
+
+    search returns the most similar examples of the same schema: the exact
+    normalized question (similarity 1, no embedding needed) or by the cosine
+    similarity of the question embeddings. Callers run the sql of a match above
+    direct_threshold without the llm and use matches above few_shot_threshold as
+    few-shot examples in the prompt. The examples are appended to a json lines
+    file, which is compacted once it holds twice max_entries lines.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path | None,
+        max_entries: int = 10_000,
+        direct_threshold: float = 0.97,
+        few_shot_threshold: float = 0.8,
+    ) -> None:
+        self.path = pathlib.Path(path) if path else None
+        self.max_entries = max_entries
+        self.direct_threshold = direct_threshold
+        self.few_shot_threshold = few_shot_threshold
+        # (schema fingerprint, normalized question) -> example
+        self.examples: dict[tuple[str, str], SQLExample] = {}
+        self.n_lines = 0
+        self.lookups = 0
+        self.direct = 0
+        self.few_shot = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self.examples)
+
+    @staticmethod
+    def _key(question: str, schema_fingerprint: str) -> tuple[str, str]:
+        return schema_fingerprint, normalize_question(question)
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path or not self.path.exists():
+                return
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self.n_lines += 1
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line of an interrupted write
+                        continue
+                    embedding = data.get("embedding")
+                    example = SQLExample(
+                        data["question"],
+                        data["sql"],
+                        data["schema_fingerprint"],
+                        np.asarray(embedding, np.float32) if embedding else None,
+                    )
+                    key = self._key(example.question, example.schema_fingerprint)
+                    self.examples.pop(key, None)
+                    self.examples[key] = example
+            while len(self.examples) > self.max_entries:
+                del self.examples[next(iter(self.examples))]
+            logging.debug(f"loaded {len(self.examples)} sql examples")
+
+    @staticmethod
+    def _to_json(example: SQLExample) -> str:
+        return json.dumps(
+            {
+                "question": example.question,
+                "sql": example.sql,
+                "schema_fingerprint": example.schema_fingerprint,
+                "embedding": (
+                    example.embedding.tolist()
+                    if example.embedding is not None
+                    else None
+                ),
+            }
+        )
+
+    def _compact(self) -> None:
+        """rewrites the file with the current examples"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")  # type: ignore
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for example in self.examples.values():
+                f.write(self._to_json(example) + "\n")
+        os.replace(tmp_path, self.path)  # type: ignore
+        self.n_lines = len(self.examples)
+
+    def search(
+        self,
+        question: str,
+        schema_fingerprint: str,
+        embed: Callable[[str], list[float]],
+        top_k: int = 3,
+    ) -> tuple[list[tuple[SQLExample, float]], np.ndarray | None]:
+        """the top_k examples above few_shot_threshold with their similarity and
+        the question embedding, if it had to be computed. A direct match is
+        counted by record_direct, once its sql ran.
+        """
+        self._load()
+        with self._lock:
+            self.lookups += 1
+            exact = self.examples.get(self._key(question, schema_fingerprint))
+            candidates = [
+                example
+                for example in self.examples.values()
+                if example.schema_fingerprint == schema_fingerprint
+                and example.embedding is not None
+                and example is not exact
+            ]
+        matches = [(exact, 1.0)] if exact else []
+        embedding = None
+        if candidates and not exact:
+            embedding = np.asarray(embed(question), dtype=np.float32)
+            embedding /= max(np.linalg.norm(embedding), 1e-12)
+            similarities = np.stack([e.embedding for e in candidates]) @ embedding
+            for row in np.argsort(-similarities)[:top_k]:
+                if similarities[row] >= self.few_shot_threshold:
+                    matches.append((candidates[row], float(similarities[row])))
+        if matches and matches[0][1] < self.direct_threshold:
+            with self._lock:
+                self.few_shot += 1
+        return matches, embedding
+
+    def record_direct(self) -> None:
+        """the sql of a direct match answered the question"""
+        with self._lock:
+            self.direct += 1
+
+    def add(
+        self,
+        question: str,
+        sql: str,
+        schema_fingerprint: str,
+        embedding: np.ndarray | None = None,
+    ) -> None:
+        self._load()
+        if embedding is not None:
+            embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+        example = SQLExample(question, sql, schema_fingerprint, embedding)
+        key = self._key(question, schema_fingerprint)
+        with self._lock:
+            self.examples.pop(key, None)
+            self.examples[key] = example
+            while len(self.examples) > self.max_entries:
+                del self.examples[next(iter(self.examples))]
+            if not self.path:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.n_lines >= 2 * self.max_entries:
+                self._compact()
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(self._to_json(example) + "\n")
+                self.n_lines += 1
+
+    def stats(self) -> dict:
+        return {
+            "examples": len(self),
+            "lookups": self.lookups,
+            "direct": self.direct,
+            "few_shot": self.few_shot,
+            # the sql of a direct match runs without the sql generation llm call
+            "saved_llm_calls": self.direct,
+        }
@@ -0,0 +1,198 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from .models import QueryRejectedException
+
+SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+# "from orders o", "join customers as c", ", reviews r"
+TABLE_ALIAS_PATTERN = re.compile(
+    r"(?:\bfrom|\bjoin|,)\s+[\"`\[]?(\w+)[\"`\]]?(?:\s+(?:as\s+)?(\w+))?", re.I
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """without markdown code fences, trailing semicolons and repeated whitespace"""
+    sql = re.sub(r"^```(?:sql)?|```$", "", sql.strip(), flags=re.I)
+    return " ".join(sql.split()).rstrip(";").strip()
+
+
+class GuardedSQLExecutor:
+    """Runs the llm generated sql queries with guards and caches the results.
+
+    For sqlite the query plan (EXPLAIN QUERY PLAN) is checked first: the product
+    of the row counts of all fully scanned tables estimates the rows a query
+    visits, queries above max_scan_rows (e.g. a cross join of large tables) are
+    rejected. The query is interrupted after timeout_seconds by a progress
+    handler and at most max_rows rows are fetched. Results are cached by the
+    normalized sql and the fingerprint of the database file.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        fingerprint: Callable[[], tuple | None] = lambda: None,
+        timeout_seconds: float = 10.0,
+        max_rows: int = 1000,
+        max_scan_rows: int = 10**8,
+        max_value_length: int = 300,
+        cache_size: int = 256,
+    ) -> None:
+        self.engine = engine
+        self.fingerprint = fingerprint
+        self.timeout_seconds = timeout_seconds
+        self.max_rows = max_rows
+        self.max_scan_rows = max_scan_rows
+        self.max_value_length = max_value_length
+        self.cache_size = cache_size
+        self.is_sqlite = engine.dialect.name == "sqlite"
+        self.results: OrderedDict[tuple[str, tuple | None], str] = OrderedDict()
+        self._row_counts: dict[str, int] = {}
+        self._row_counts_fingerprint: tuple | None = None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def _row_count(self, connection: Connection, table: str) -> int:
+        """approximate row count, from sqlite_stat1 (ANALYZE), the largest rowid
+        or count(*) for tables without rowid
+        """
+        if (count := self._row_counts.get(table)) is not None:
+            return count
+        try:
+            stat = connection.execute(
+                text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table LIMIT 1"),
+                {"table": table},
+            ).scalar()
+        except Exception:
+            stat = None
+        if stat:
+            count = int(stat.split()[0])
+        else:
+            try:
+                count = connection.exec_driver_sql(
+                    f'SELECT max(rowid) FROM "{table}"'
+                ).scalar()
+            except Exception:
+                count = connection.exec_driver_sql(
+                    f'SELECT count(*) FROM "{table}"'
+                ).scalar()
+        count = self._row_counts[table] = int(count or 0)
+        return count
+
+    def _check_plan(self, connection: Connection, sql: str) -> None:
+        plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        tables = {
+            name.lower() for name in connection.dialect.get_table_names(connection)
+        }
+        aliases = {
+            (alias or table).lower(): table.lower()
+            for table, alias in TABLE_ALIAS_PATTERN.findall(sql)
+            if table.lower() in tables
+        }
+        scans = []
+        for row in plan:
+            if not (match := SCAN_PATTERN.match(row[-1])):
+                continue
+            name = match.group(1).lower()
+            # unknown names (e.g. materialized subqueries) are not estimated
+            if (table := aliases.get(name, name)) in tables:
+                scans.append((table, self._row_count(connection, table)))
+        estimate = math.prod(count for _, count in scans)
+        if scans and estimate > self.max_scan_rows:
+            self.rejected += 1
+            raise QueryRejectedException(
+                f"The query would scan about {estimate:.0e} rows (full scans of "
+                f"{', '.join(table for table, _ in scans)}), please add join "
+                "conditions or filters."
+            )
+
+    def _interrupt_after(self, connection: Connection, seconds: float) -> None:
+        deadline = time.monotonic() + seconds
+        # called every 10000 sqlite vm instructions, a nonzero return aborts
+        connection.connection.set_progress_handler(
+            lambda: int(time.monotonic() > deadline), 10_000
+        )
+
+    def _format(self, rows: list, truncated: bool) -> str:
+        result = str(
+            [
+                tuple(
+                    value[: self.max_value_length] if isinstance(value, str) else value
+                    for value in row
+                )
+                for row in rows
+            ]
+        )
+        if truncated:
+            result += f"\n(only the first {self.max_rows} rows)"
+        return result
+
+    def _execute(self, sql: str) -> str:
+        with self.engine.connect() as connection:
+            if self.is_sqlite:
+                self._check_plan(connection, sql)
+                self._interrupt_after(connection, self.timeout_seconds)
+            try:
+                result = connection.exec_driver_sql(sql)
+                rows = []
+                truncated = False
+                if result.returns_rows:
+                    while len(rows) < self.max_rows:
+                        batch = result.fetchmany(min(100, self.max_rows - len(rows)))
+                        if not batch:
+                            break
+                        rows.extend(batch)
+                    truncated = result.fetchone() is not None
+                    result.close()
+            except Exception as e:
+                if self.is_sqlite and "interrupted" in str(e):
+                    self.timeouts += 1
+                    raise QueryRejectedException(
+                        f"The query was stopped after {self.timeout_seconds} seconds."
+                    ) from e
+                raise
+            finally:
+                if self.is_sqlite:
+                    connection.connection.set_progress_handler(None, 0)
+        return self._format(rows, truncated)
+
+    def run(self, sql: str) -> str:
+        sql = normalize_sql(sql)
+        fingerprint = self.fingerprint()
+        key = (sql, fingerprint)
+        with self._lock:
+            if fingerprint != self._row_counts_fingerprint:
+                self._row_counts.clear()
+                self._row_counts_fingerprint = fingerprint
+            if (result := self.results.get(key)) is not None:
+                self.results.move_to_end(key)
+                self.hits += 1
+                logging.debug(f"query result from cache: {sql}")
+                return result
+            self.misses += 1
+        result = self._execute(sql)
+        if re.match(r"(select|with)\b", sql, re.I):
+            with self._lock:
+                self.results[key] = result
+                while len(self.results) > self.cache_size:
+                    self.results.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "cached_results": len(self.results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
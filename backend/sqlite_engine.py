@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+import weakref
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.pool import QueuePool
+
+_engines: weakref.WeakValueDictionary[tuple, Engine] = weakref.WeakValueDictionary()
+_engines_lock = threading.Lock()
+
+
+def sqlite_path(database: str | URL | Engine) -> Path | None:
+    """path of the database file of a sqlite uri or engine, None for other
+    databases or in-memory sqlite
+    """
+    url = database.url if isinstance(database, Engine) else make_url(database)
+    if url.get_backend_name() != "sqlite" or not url.database:
+        return None
+    path = url.database
+    if path.startswith("file:"):
+        # uri filename (uri=true), which sqlite percent-decodes again
+        path = unquote(path[len("file:") :].split("?")[0])
+    if not path or path == ":memory:":
+        return None
+    return Path(path)
+
+
+def _set_pragmas(mmap_size: int, cache_size_kib: int):
+    def on_connect(dbapi_connection, _) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA mmap_size={mmap_size}")
+        # negative: size in KiB instead of pages
+        cursor.execute(f"PRAGMA cache_size=-{cache_size_kib}")
+        cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+    return on_connect
+
+
+def read_only_engine(
+    path: Path,
+    immutable: bool = bool(int(os.getenv("SQLITE_IMMUTABLE", 1))),
+    mmap_size: int = int(os.getenv("SQLITE_MMAP_MB", 1024)) * 1024**2,
+    cache_size_kib: int = int(os.getenv("SQLITE_CACHE_MB", 64)) * 1024,
+    pool_size: int = int(os.getenv("SQLITE_POOL_SIZE", 4)),
+) -> Engine:
+    """pooled read-only engine for an uploaded sqlite file.
+
+    The file is opened with mode=ro (and immutable=1, sqlite then skips locking
+    and change detection, the file must not be written while it is open), the
+    connections are memory-mapped, have a larger page cache and query_only set.
+    Sessions querying the same file (same size and mtime) share the engine and
+    its connection pool.
+    """
+    path = path.resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns, immutable)
+    with _engines_lock:
+        if (engine := _engines.get(key)) is not None:
+            return engine
+        uri = f"sqlite:///file:{quote(str(path))}?mode=ro&uri=true"
+        if immutable:
+            uri += "&immutable=1"
+        engine = create_engine(
+            uri,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=2 * pool_size,
+            # pooled connections are used by the threads of the workers
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(engine, "connect", _set_pragmas(mmap_size, cache_size_kib))
+        _engines[key] = engine
+        logging.debug(f"created read-only sqlite engine for {path}")
+        return engine
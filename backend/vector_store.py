@@ -0,0 +1,261 @@
+import logging
+import os
+import pathlib
+import tempfile
+from typing import Any
+
+import numpy as np
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.simple import SimpleVectorStore
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store which keeps all embeddings in one contiguous float32 matrix.
+
+    The matrix is persisted as .npy file together with side arrays for the node
+    ids and ref doc ids and is memory-mapped on load, so the cold start does not
+    depend on the corpus size and several uvicorn workers share the pages via the
+    page cache. Rows are L2 normalized, top-k is a matrix-vector product plus
+    argpartition. Inserts are appended as additional in-memory blocks, deleted rows
+    are masked, both are compacted into a single matrix on persist.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    embeddings_fname = "embeddings.npy"
+    node_ids_fname = "node_ids.npy"
+    ref_doc_ids_fname = "ref_doc_ids.npy"
+
+    def __init__(
+        self,
+        embeddings: np.ndarray | None = None,
+        node_ids: list[str] | None = None,
+        ref_doc_ids: list[str] | None = None,
+    ) -> None:
+        self._reset(embeddings, node_ids, ref_doc_ids)
+
+    def _reset(
+        self,
+        embeddings: np.ndarray | None = None,
+        node_ids: list[str] | None = None,
+        ref_doc_ids: list[str] | None = None,
+    ) -> None:
+        self._blocks: list[np.ndarray] = []
+        self._node_ids: list[str] = []
+        self._ref_doc_ids: list[str] = []
+        self._alive = np.ones(0, dtype=bool)
+        self._node_rows: dict[str, int] = {}
+        self._ref_doc_rows: dict[str, list[int]] = {}
+        if embeddings is not None and len(embeddings):
+            self._append(embeddings, node_ids or [], ref_doc_ids or [])
+        self._dirty = False
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def __len__(self) -> int:
+        return len(self._node_rows)
+
+    @property
+    def dim(self) -> int | None:
+        return self._blocks[0].shape[1] if self._blocks else None
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (embeddings / norms).astype(np.float32, copy=False)
+
+    def _append(
+        self, embeddings: np.ndarray, node_ids: list[str], ref_doc_ids: list[str]
+    ) -> None:
+        """embeddings have to be normalized already"""
+        if self.dim is not None and embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"embedding dimension {embeddings.shape[1]} does not match {self.dim}"
+            )
+        offset = len(self._node_ids)
+        self._blocks.append(embeddings)
+        self._node_ids.extend(node_ids)
+        self._ref_doc_ids.extend(ref_doc_ids)
+        self._alive = np.concatenate([self._alive, np.ones(len(node_ids), bool)])
+        self._dirty = True
+        for row, (node_id, ref_doc_id) in enumerate(
+            zip(node_ids, ref_doc_ids), start=offset
+        ):
+            if (old_row := self._node_rows.get(node_id)) is not None:
+                self._alive[old_row] = False
+            self._node_rows[node_id] = row
+            self._ref_doc_rows.setdefault(ref_doc_id, []).append(row)
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        if not nodes:
+            return []
+        embeddings = self._normalize(
+            np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        )
+        node_ids = [node.node_id for node in nodes]
+        self._append(
+            embeddings, node_ids, [node.ref_doc_id or "None" for node in nodes]
+        )
+        return node_ids
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for row in self._ref_doc_rows.pop(ref_doc_id, []):
+            if self._alive[row]:
+                self._alive[row] = False
+                self._node_rows.pop(self._node_ids[row], None)
+                self._dirty = True
+
+    def get(self, text_id: str) -> list[float]:
+        row = self._node_rows[text_id]
+        for block in self._blocks:
+            if row < len(block):
+                return block[row].tolist()
+            row -= len(block)
+        raise KeyError(text_id)
+
+    def _candidate_mask(self, query: VectorStoreQuery) -> np.ndarray:
+        mask = self._alive.copy()
+        if query.doc_ids is not None:
+            allowed = np.zeros_like(mask)
+            for doc_id in query.doc_ids:
+                allowed[self._ref_doc_rows.get(doc_id, [])] = True
+            mask &= allowed
+        if query.node_ids is not None:
+            allowed = np.zeros_like(mask)
+            rows = [self._node_rows[i] for i in query.node_ids if i in self._node_rows]
+            allowed[rows] = True
+            mask &= allowed
+        if query.filters is not None:
+            logging.warning("metadata filters are not supported by NumpyVectorStore")
+        return mask
+
+    def _scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        if not self._blocks:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate([block @ query_embedding for block in self._blocks])
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None:
+            raise ValueError("NumpyVectorStore requires a query embedding")
+        query_embedding = self._normalize(
+            np.asarray([query.query_embedding], dtype=np.float32)
+        )[0]
+        scores = self._scores(query_embedding)
+        scores[~self._candidate_mask(query)] = -np.inf
+        n_candidates = int(np.isfinite(scores).sum())
+        top_k = min(query.similarity_top_k, n_candidates)
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows = rows[np.argsort(-scores[rows])]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=scores[rows].tolist(),
+            ids=[self._node_ids[row] for row in rows],
+        )
+
+    def compact(self) -> None:
+        """merges all blocks into one matrix without the deleted rows"""
+        rows = np.flatnonzero(self._alive)
+        if len(self._blocks) <= 1 and len(rows) == len(self._alive):
+            return
+        embeddings = (
+            np.concatenate(self._blocks)[rows]
+            if self._blocks
+            else np.zeros((0, 0), np.float32)
+        )
+        node_ids = [self._node_ids[row] for row in rows]
+        ref_doc_ids = [self._ref_doc_ids[row] for row in rows]
+        self._reset(embeddings, node_ids, ref_doc_ids)
+        self._dirty = True
+
+    def persist(self, persist_path: str, fs: Any | None = None) -> None:
+        """persists into the directory of persist_path (the path of the json
+        vector store of the StorageContext)
+        """
+        persist_dir = pathlib.Path(persist_path).parent
+        if not self._dirty and (persist_dir / self.embeddings_fname).exists():
+            return
+        persist_dir.mkdir(parents=True, exist_ok=True)
+        self.compact()
+        embeddings = (
+            self._blocks[0] if self._blocks else np.zeros((0, 0), dtype=np.float32)
+        )
+        # the node id arrays first, the matrix last: a reader only trusts the
+        # matrix, if the number of rows matches the id arrays
+        _atomic_save(persist_dir / self.node_ids_fname, np.asarray(self._node_ids))
+        _atomic_save(
+            persist_dir / self.ref_doc_ids_fname, np.asarray(self._ref_doc_ids)
+        )
+        _atomic_save(persist_dir / self.embeddings_fname, embeddings)
+        # a migrated json vector store is outdated now
+        pathlib.Path(persist_path).unlink(missing_ok=True)
+        # reopen as memory map, so the persisted pages are shared again
+        self._reset(*self._load_arrays(persist_dir))
+
+    @classmethod
+    def _load_arrays(
+        cls, persist_dir: pathlib.Path
+    ) -> tuple[np.ndarray, list[str], list[str]]:
+        embeddings_path = persist_dir / cls.embeddings_fname
+        try:
+            embeddings = np.load(embeddings_path, mmap_mode="r")
+        except ValueError:
+            # an empty matrix can not be memory-mapped
+            embeddings = np.load(embeddings_path)
+        node_ids = np.load(persist_dir / cls.node_ids_fname).tolist()
+        ref_doc_ids = np.load(persist_dir / cls.ref_doc_ids_fname).tolist()
+        if not (len(embeddings) == len(node_ids) == len(ref_doc_ids)):
+            raise ValueError(f"inconsistent vector store files in {persist_dir}")
+        return embeddings, node_ids, ref_doc_ids
+
+    @classmethod
+    def from_persist_dir(
+        cls, persist_dir: str | pathlib.Path, **kwargs: Any
+    ) -> "NumpyVectorStore":
+        persist_dir = pathlib.Path(persist_dir)
+        if (persist_dir / cls.embeddings_fname).exists():
+            return cls(*cls._load_arrays(persist_dir))
+        if (persist_dir / "vector_store.json").exists():
+            logging.info("migrating json vector store to NumpyVectorStore")
+            return cls.from_simple_vector_store(
+                SimpleVectorStore.from_persist_dir(str(persist_dir))
+            )
+        return cls()
+
+    @classmethod
+    def from_simple_vector_store(
+        cls, simple_vector_store: SimpleVectorStore
+    ) -> "NumpyVectorStore":
+        data = simple_vector_store._data
+        node_ids = list(data.embedding_dict.keys())
+        if not node_ids:
+            return cls()
+        embeddings = np.asarray(
+            [data.embedding_dict[node_id] for node_id in node_ids], dtype=np.float32
+        )
+        return cls(
+            cls._normalize(embeddings),
+            node_ids,
+            [data.text_id_to_ref_doc_id.get(node_id, "None") for node_id in node_ids],
+        )
+
+
+def _atomic_save(path: pathlib.Path, array: np.ndarray) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        pathlib.Path(tmp_path).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,111 @@
+"""Load and split time of pdf files with 10, 100 and 1000 pages: sequential
+text extraction of all pages against the page-parallel extraction of
+AIPdfDocument, and the whole load and split (incl. the node parser).
+
+run from root: python -m benchmarks.bench_pdf_ingestion --pages 10 100 1000
+the sample pdfs are kept in --dir and reused on the next run
+"""
+import argparse
+import time
+from pathlib import Path
+
+from llama_index.node_parser import SimpleNodeParser
+
+from backend.pdf_pages import extract_pages, iter_pages
+from backend.script_RAG import AIPdfDocument, split_documents
+
+LINES_PER_PAGE = 40
+WORDS = "the quick brown fox jumps over the lazy dog while the hippo swims".split()
+
+
+def page_stream(page_number: int) -> bytes:
+    lines = [
+        " ".join(WORDS[(page_number + line + i) % len(WORDS)] for i in range(12))
+        for line in range(LINES_PER_PAGE)
+    ]
+    text = " T* ".join(f"({line})'" for line in [f"Page {page_number}", *lines])
+    return f"BT /F1 11 Tf 14 TL 50 780 Td {text} ET".encode()
+
+
+def write_pdf(path: Path, n_pages: int) -> None:
+    """a pdf with n_pages pages of text (Helvetica, no external dependencies)"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # pages, after the page objects are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for page_number in range(1, n_pages + 1):
+        stream = page_stream(page_number)
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, n_pages)
+
+    content = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(content)
+    content += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    content += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    content += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    path.write_bytes(content)
+
+
+def timed(function) -> tuple[float, int]:
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def sequential(path: Path) -> int:
+    return len(extract_pages(path, 0, 10**9))
+
+
+def parallel(path: Path) -> int:
+    return sum(1 for _ in iter_pages(path, AIPdfDocument.pages_per_task))
+
+
+def load_and_split(path: Path) -> int:
+    node_parser = SimpleNodeParser.from_defaults(
+        chunk_size=AIPdfDocument.chunk_size, chunk_overlap=AIPdfDocument.chunk_overlap
+    )
+    # an absolute path replaces the data folder of the documents
+    documents = AIPdfDocument._load_documents(str(path.resolve()))
+    return len(split_documents(node_parser, documents))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--dir", type=Path, default=Path("benchmark_pdfs"))
+    args = parser.parse_args()
+
+    args.dir.mkdir(parents=True, exist_ok=True)
+    for n_pages in args.pages:
+        path = args.dir / f"benchmark_{n_pages}_pages.pdf"
+        if not path.exists():
+            write_pdf(path, n_pages)
+        print(f"{n_pages} pages ({path.stat().st_size / 1024**2:.1f} MB):")
+        for name, function in [
+            ("sequential extraction", sequential),
+            ("parallel extraction", parallel),
+            ("load and split", load_and_split),
+        ]:
+            seconds, count = timed(lambda: function(path))
+            unit = "nodes" if name == "load and split" else "pages"
+            print(
+                f"  {name:22} {seconds:8.3f} s  {count:6} {unit}"
+                f"  {n_pages / seconds:8.1f} pages/s"
+            )
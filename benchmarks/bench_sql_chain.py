@@ -0,0 +1,62 @@
+"""Per-question overhead of AIDataBase without the llm calls: compiling the
+chain and reading the table info.
+
+run from root: python -m benchmarks.bench_sql_chain
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from langchain.chat_models import ChatOpenAI
+
+from backend.script_SQL_querying import AIDataBase
+
+N_QUESTIONS = 50
+
+
+def create_database(path: Path, n_tables: int = 10, n_rows: int = 10_000) -> None:
+    with sqlite3.connect(path) as connection:
+        for table in range(n_tables):
+            connection.execute(
+                f"CREATE TABLE table_{table} (id INTEGER PRIMARY KEY, name TEXT, "
+                "score REAL, created TEXT)"
+            )
+            connection.executemany(
+                f"INSERT INTO table_{table} (name, score, created) VALUES (?, ?, ?)",
+                ((f"name {i}", i / 3, "2023-10-01") for i in range(n_rows)),
+            )
+
+
+def per_question_before(database: AIDataBase) -> None:
+    # new llm and chain for every question, the table info is read every time
+    llm = ChatOpenAI(temperature=0, model=AIDataBase.llm_name)
+    database._create_chains(llm)
+    database.get_table_info()
+
+
+def per_question_after(database: AIDataBase) -> None:
+    database.chains
+    database.get_schema(None)
+
+
+def timeit(fn, database: AIDataBase) -> float:
+    start = time.perf_counter()
+    for _ in range(N_QUESTIONS):
+        fn(database)
+    return (time.perf_counter() - start) / N_QUESTIONS
+
+
+if __name__ == "__main__":
+    # no llm is called, but ChatOpenAI requires a key
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "benchmark.sqlite"
+        create_database(path)
+        database = AIDataBase.from_uri(f"sqlite:///{path}")
+        before = timeit(per_question_before, database)
+        after = timeit(per_question_after, database)
+        print(f"per question before: {before * 1000:.2f} ms")
+        print(f"per question after:  {after * 1000:.3f} ms")
+        print(f"speed-up: {before / after:.0f}x")
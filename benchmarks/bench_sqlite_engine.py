@@ -0,0 +1,101 @@
+"""Query latency of the default sqlite engine against the read-only engine
+profile (mode=ro, immutable, mmap, larger page cache, pooled connections)
+on a multi-GB sample database.
+
+run from root: python -m benchmarks.bench_sqlite_engine --size-gb 2
+the sample database is kept in --path and reused on the next run
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from backend.sqlite_engine import read_only_engine
+
+ROW_BYTES = 1024
+QUERIES = {
+    "point lookup": "SELECT * FROM reviews WHERE id = {id}",
+    "indexed range": """SELECT avg(score) FROM reviews
+        WHERE user_id BETWEEN {id} AND {id} + 100""",
+    "join": """SELECT u.name, count(*) FROM reviews r JOIN users u ON u.id = r.user_id
+        WHERE r.id BETWEEN {id} AND {id} + 1000 GROUP BY u.name""",
+}
+
+
+def create_database(path: Path, size_gb: float) -> int:
+    n_rows = int(size_gb * 1024**3 / ROW_BYTES)
+    if path.exists():
+        return n_rows
+    print(f"creating sample database with {n_rows} reviews...")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.execute(
+            """CREATE TABLE reviews (id INTEGER PRIMARY KEY, user_id INTEGER,
+            score REAL, text TEXT)"""
+        )
+        connection.executemany(
+            "INSERT INTO users (name) VALUES (?)",
+            ((f"user {i}",) for i in range(n_rows // 100)),
+        )
+        batch_size = 100_000
+        for start in range(0, n_rows, batch_size):
+            connection.executemany(
+                "INSERT INTO reviews (user_id, score, text) VALUES (?, ?, ?)",
+                (
+                    (i // 100, (i % 5) + 1, "x" * (ROW_BYTES - 40))
+                    for i in range(start, min(start + batch_size, n_rows))
+                ),
+            )
+        connection.execute("CREATE INDEX reviews_user_id ON reviews (user_id)")
+    return n_rows
+
+
+def run_queries(engine: Engine, query: str, n_rows: int, n_queries: int) -> list:
+    latencies = []
+    rng = random.Random(0)
+    for _ in range(n_queries):
+        sql = query.format(id=rng.randrange(n_rows // 100))
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            connection.exec_driver_sql(sql).fetchall()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark(engine: Engine, n_rows: int, n_queries: int, n_threads: int) -> None:
+    for name, query in QUERIES.items():
+        with ThreadPoolExecutor(n_threads) as executor:
+            results = executor.map(
+                lambda _: run_queries(engine, query, n_rows, n_queries),
+                range(n_threads),
+            )
+            latencies = sorted(latency for result in results for latency in result)
+        p95 = latencies[int(0.95 * len(latencies))]
+        print(
+            f"  {name:14} p50 {statistics.median(latencies) * 1000:8.2f} ms"
+            f"  p95 {p95 * 1000:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-gb", type=float, default=2.0)
+    parser.add_argument("--path", type=Path, default=Path("benchmark.sqlite"))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    n_rows = create_database(args.path, args.size_gb)
+    engines = {
+        "default engine": create_engine(f"sqlite:///{args.path}"),
+        "read-only engine": read_only_engine(args.path),
+    }
+    for name, engine in engines.items():
+        print(f"{name} ({args.threads} threads):")
+        benchmark(engine, n_rows, args.queries, args.threads)
@@ -1,9 +1,12 @@
 # run command from root: streamlit run streamlit_app.py
 import os
 import sys
+import json
 import logging
 import pathlib
 import random
+import time
+import uuid
 
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
@@ -37,6 +40,17 @@ API_URL = os.getenv("BACKEND_URL", "http://localhost") + ":8000"
 logging.info(f"{API_URL=}")
 
 APP_TITLE = "Quaigle"
+UPLOAD_POLL_INTERVAL = 1.0  # seconds between ingestion job status requests
+INGESTION_STAGES = ("load", "split", "extract", "embed", "persist")
+# url input modes: the page only, the page and its linked pages, or the pages of
+# a sitemap (several urls are separated by whitespace)
+CRAWL_MODES = {
+    "single page": "single",
+    "crawl linked pages": "seed",
+    "url list": "list",
+    "sitemap": "sitemap",
+}
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 50))
 cfd = pathlib.Path(__file__).parent
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -103,11 +117,20 @@ def initialize_session(refresh_session=False):
             st.session_state["file_uploader_key"] = 0
         if "url_uploader_key" not in st.session_state:
             st.session_state["url_uploader_key"] = 0
+        if "session_id" not in st.session_state:
+            # the backend keeps a separate chat engine per session id
+            st.session_state["session_id"] = uuid.uuid4().hex
+
+
+def session_headers() -> dict:
+    return {"X-Session-ID": st.session_state["session_id"]}
 
 
 def clear_history():
     initialize_session(refresh_session=True)
-    response = requests.get(os.path.join(API_URL, "clear_history"))
+    response = requests.get(
+        os.path.join(API_URL, "clear_history"), headers=session_headers()
+    )
     st.session_state["redirect_page"] = 0
     if response.status_code == 200:
         data = response.json()
@@ -126,7 +149,9 @@ def clear_storage():
     st.session_state["selected_page"] = "questionai"
     # st.session_state["url_input"]=""
     clear_history()
-    response = requests.get(os.path.join(API_URL, "clear_storage"))
+    response = requests.get(
+        os.path.join(API_URL, "clear_storage"), headers=session_headers()
+    )
     if response.status_code == 200:
         data = response.json()
         return f"{data['message']}"
@@ -171,29 +196,63 @@ def display_options_menu():
 
 
 def make_get_request(route: str) -> requests.Response:
-    return requests.get(os.path.join(API_URL, route))
+    return requests.get(os.path.join(API_URL, route), headers=session_headers())
+
+
+def wait_for_ingestion_job(job: dict) -> dict:
+    """polls the backend until the ingestion job is finished and shows its
+    current stage in a progress bar
+    """
+    progress_bar = st.sidebar.progress(0, text="Upload queued")
+    while job.get("status") in ("queued", "running"):
+        time.sleep(UPLOAD_POLL_INTERVAL)
+        response = make_get_request(f"upload/{job['job_id']}")
+        response.raise_for_status()
+        job = response.json()
+        if job.get("stage") == "crawl":
+            # a crawl reports the pages per host instead of the stages
+            progress = job.get("progress") or {}
+            progress_bar.progress(
+                min(progress.get("ingested", 0) / CRAWL_MAX_PAGES, 1.0),
+                text=f"Crawling: {progress.get('pages', 0)} pages fetched, "
+                f"{progress.get('ingested', 0)} ingested, "
+                f"{progress.get('errors', 0)} errors",
+            )
+        elif stage := job.get("stage"):
+            progress_bar.progress(
+                (INGESTION_STAGES.index(stage) + 1) / (len(INGESTION_STAGES) + 1),
+                text=f"Processing: {stage}",
+            )
+    progress_bar.empty()
+    return job
 
 
 def post_data_to_backend(
     route: str, url: str = "", uploaded_file: UploadedFile | None = None
 ) -> None:
-    with st.spinner("Waiting for openai API response"):
-        try:
-            if url:
-                data = {"upload_url": url}
-                response = requests.post(os.path.join(API_URL, route), data=data)
-            elif uploaded_file:
-                files = {"upload_file": (uploaded_file.name, uploaded_file)}
-                data = {"upload_url": ""}
-                response = requests.post(
-                    os.path.join(API_URL, route), files=files, data=data
-                )
-            else:
-                raise FileNotFoundError
-
-            if response.status_code == 200:
-                response_data = response.json()
-                logging.info(f"upload response data: {response_data}")
+    try:
+        if url:
+            data = {"upload_url": url}
+            response = requests.post(
+                os.path.join(API_URL, route), data=data, headers=session_headers()
+            )
+        elif uploaded_file:
+            files = {"upload_file": (uploaded_file.name, uploaded_file)}
+            data = {"upload_url": ""}
+            response = requests.post(
+                os.path.join(API_URL, route),
+                files=files,
+                data=data,
+                headers=session_headers(),
+            )
+        else:
+            raise FileNotFoundError
+
+        if response.status_code == 200:
+            job = wait_for_ingestion_job(response.json())
+            logging.info(f"upload job: {job}")
+            if job.get("status") == "done":
+                response_data = job.get("result") or {}
                 # st.session_state.counter += 1
                 post_ai_message_to_chat(
                     response_data.get("summary", "Unknown response"),
@@ -203,13 +262,40 @@ def post_data_to_backend(
                     response_data.get("used_tokens", 0)
                 )
             else:
-                st.sidebar.error(f"Error: {response.status_code} - {response}")
-        except FileNotFoundError:
-            st.sidebar.error(
-                "No context is given. Please provide a url or upload a file"
+                st.sidebar.error(
+                    f"Upload {job.get('status')}: {job.get('error') or ''}"
+                )
+        else:
+            st.sidebar.error(f"Error: {response.status_code} - {response}")
+    except FileNotFoundError:
+        st.sidebar.error("No context is given. Please provide a url or upload a file")
+    except requests.RequestException as e:
+        st.sidebar.error(f"Server Request Error: is backend {API_URL} up? {e}")
+
+
+def crawl_urls(urls: list[str], mode: str) -> None:
+    try:
+        response = requests.post(
+            os.path.join(API_URL, "crawl"),
+            json={"urls": urls, "mode": mode, "max_pages": CRAWL_MAX_PAGES},
+            headers=session_headers(),
+        )
+        if response.status_code != 200:
+            st.sidebar.error(f"Error: {response.status_code} - {response.text}")
+            return
+        job = wait_for_ingestion_job(response.json())
+        logging.info(f"crawl job: {job}")
+        if job.get("status") == "done":
+            response_data = job.get("result") or {}
+            post_ai_message_to_chat(
+                response_data.get("summary", "Unknown response"),
+                response_data.get("text_category"),
             )
-        except requests.RequestException as e:
-            st.sidebar.error(f"Server Request Error: is backend {API_URL} up? {e}")
+            st.session_state.total_tokens.append(response_data.get("used_tokens", 0))
+        else:
+            st.sidebar.error(f"Crawl {job.get('status')}: {job.get('error') or ''}")
+    except requests.RequestException as e:
+        st.sidebar.error(f"Server Request Error: is backend {API_URL} up? {e}")
 
 
 def uploader_callback():
@@ -221,7 +307,12 @@ def uploader_callback():
 def url_callback():
     text_input_key = "text_input" + str(st.session_state["url_uploader_key"])
     if url := st.session_state.get(text_input_key):
-        post_data_to_backend("upload", url, None)
+        if (
+            mode := CRAWL_MODES[st.session_state.get("url_mode", "single page")]
+        ) == "single":
+            post_data_to_backend("upload", url, None)
+        else:
+            crawl_urls(url.split(), mode)
 
 
 def display_sidemenu():
@@ -259,6 +350,13 @@ def display_sidemenu():
         ):
             success_message.success("url uploaded")
 
+        st.selectbox(
+            "url mode",
+            options=list(CRAWL_MODES),
+            key="url_mode",
+            label_visibility="collapsed",
+        )
+
         with stylable_container(
             key="red_container",
             css_styles="""
@@ -283,6 +381,35 @@ def display_sidemenu():
             st.rerun()
 
 
+def stream_answer(payload: dict, answer_placeholder) -> dict:
+    """posts the question to the streaming qa endpoint and renders the answer
+    while it is generated, returns the data of the final "done" event
+    """
+    with requests.post(
+        os.path.join(API_URL, "qa_text/stream"),
+        json=payload,
+        headers=session_headers(),
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        answer, event = "", None
+        answer_placeholder.markdown("Waiting for Response ...")
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line.removeprefix("event: ")
+            elif line.startswith("data: "):
+                data = json.loads(line.removeprefix("data: "))
+                if event == "token":
+                    answer += data["token"]
+                    answer_placeholder.markdown(answer + "▌")
+                elif event == "done":
+                    answer_placeholder.markdown(data["ai_answer"])
+                    return data
+                elif event == "error":
+                    raise RuntimeError(data["detail"])
+    raise RuntimeError("the answer stream ended unexpectedly")
+
+
 @MultiPage
 def questionai():
     with st.container():
@@ -311,28 +438,23 @@ def questionai():
             st.session_state.messages.append({"role": "user", "content": prompt})
             messages.chat_message("user").write(prompt)
 
-            with messages.chat_message("assistant"), st.spinner(
-                "Waiting for Response ..."
-            ):
+            with messages.chat_message("assistant"):
                 payload = {
                     "prompt": prompt,
                     "temperature": st.session_state.temperature,
                 }
-                response = requests.post(os.path.join(API_URL, "qa_text"), json=payload)
-                ai_answer = ""
-
-                if response.status_code == 200:
-                    response_data = response.json()
+                answer_placeholder = st.empty()
+                try:
+                    response_data = stream_answer(payload, answer_placeholder)
                     ai_answer = response_data.get("ai_answer", "Unknown response type")
                     st.session_state.total_tokens.append(
                         response_data.get("used_tokens", 0)
                     )
-                    st.write(ai_answer)
                     st.session_state.messages.append(
                         {"role": "assistant", "content": ai_answer}
                     )
-                else:
-                    st.error(f"Error: {response.status_code} - {response.text}")
+                except (requests.RequestException, RuntimeError) as e:
+                    st.error(f"Error: {e}")
 
         elif len(st.session_state.messages) == 0:
             with messages:
@@ -356,8 +478,11 @@ def quizme():
         st.markdown("### A Quiz for You")
         st.session_state.score = 0
         message_placeholder = st.empty()
+        size = st.number_input(
+            "Number of questions", min_value=1, max_value=10, value=3
+        )
         if st.button("Generate a Quiz"):
-            response = make_get_request("quiz")
+            response = make_get_request(f"quiz?size={size}")
             if response.status_code == 200:
                 for question in response.json().get("questions"):
                     answer_options = [
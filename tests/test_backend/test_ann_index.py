@@ -0,0 +1,91 @@
+import numpy as np
+
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from backend.ann_index import IVFVectorStore, kmeans
+from backend.vector_store import NumpyVectorStore
+
+
+def clustered_embeddings(n_rows=5000, n_clusters=50, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    rows = centers[rng.integers(n_clusters, size=n_rows)]
+    return (rows + 0.2 * rng.normal(size=(n_rows, dim))).astype(np.float32)
+
+
+def make_store(embeddings, **kwargs):
+    store = IVFVectorStore(min_train_size=1000, **kwargs)
+    store._append(
+        store._normalize(embeddings),
+        [f"node_{i}" for i in range(len(embeddings))],
+        [f"doc_{i // 10}" for i in range(len(embeddings))],
+    )
+    return store
+
+
+def test_kmeans_assigns_every_row():
+    data = IVFVectorStore._normalize(clustered_embeddings(n_rows=500))
+    centroids, assignments = kmeans(data, 10)
+    assert centroids.shape == (10, 32)
+    assert set(assignments) <= set(range(10))
+
+
+def test_recall_against_exact_search():
+    embeddings = clustered_embeddings()
+    store = make_store(embeddings, n_probe=8)
+    queries = embeddings[:20] + 0.05
+    assert store.recall_at_k(queries, k=10) >= 0.9
+    assert store.trained
+
+
+def test_incremental_insert_is_searchable():
+    store = make_store(clustered_embeddings())
+    store.query(VectorStoreQuery(query_embedding=[1.0] * 32, similarity_top_k=1))
+    new_embedding = np.full((1, 32), -1.0, dtype=np.float32)
+    store._append(store._normalize(new_embedding), ["new_node"], ["new_doc"])
+    result = store.query(
+        VectorStoreQuery(query_embedding=new_embedding[0].tolist(), similarity_top_k=1)
+    )
+    assert result.ids == ["new_node"]
+
+
+def test_small_store_uses_exact_search():
+    store = make_store(clustered_embeddings(n_rows=100))
+    store.query(VectorStoreQuery(query_embedding=[1.0] * 32, similarity_top_k=3))
+    assert not store.trained
+
+
+def test_small_filtered_document_is_found_in_trained_index():
+    embeddings = clustered_embeddings(n_rows=20_000)
+    store = make_store(embeddings, n_probe=8)
+    # a small document of a session, spread over the whole space
+    rng = np.random.default_rng(1)
+    session_embeddings = rng.normal(size=(5, 32)).astype(np.float32)
+    session_ids = [f"session_node_{i}" for i in range(5)]
+    store._append(
+        store._normalize(session_embeddings), session_ids, ["session_doc"] * 5
+    )
+    for query_embedding in embeddings[:50]:
+        query = VectorStoreQuery(
+            query_embedding=query_embedding.tolist(),
+            similarity_top_k=3,
+            doc_ids=["session_doc"],
+        )
+        assert len(store.query(query).ids) == 3
+        assert set(store.query(query).ids) <= set(session_ids)
+    assert store.trained
+
+
+def test_filter_with_many_rows_probes_more_clusters():
+    embeddings = clustered_embeddings(n_rows=5000)
+    store = make_store(embeddings, n_probe=1)
+    # half of the documents pass the filter, they are not searched exactly
+    doc_ids = [f"doc_{i}" for i in range(0, 500, 2)]
+    query = VectorStoreQuery(
+        query_embedding=embeddings[0].tolist(), similarity_top_k=200, doc_ids=doc_ids
+    )
+    result = store.query(query)
+    assert len(result.ids) == 200
+    exact = NumpyVectorStore.query(store, query)
+    assert set(result.ids) <= {f"node_{i}" for i in range(5000) if (i // 10) % 2 == 0}
+    assert result.similarities[0] == exact.similarities[0]
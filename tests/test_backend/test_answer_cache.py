@@ -0,0 +1,68 @@
+import time
+
+from backend.answer_cache import CachedAnswer, SemanticAnswerCache, normalize_question
+
+EMBEDDINGS = {
+    "what is this about?": [1.0, 0.0, 0.0],
+    "what is the text about": [0.99, 0.1, 0.0],
+    "who wrote it?": [0.0, 1.0, 0.0],
+}
+
+
+class CountingEmbedder:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, question):
+        self.calls += 1
+        return EMBEDDINGS[question.lower()]
+
+
+def test_normalize_question():
+    assert normalize_question("  What is THIS about?!") == "what is this about"
+
+
+def test_exact_hit_needs_no_embedding():
+    cache = SemanticAnswerCache()
+    embed = CountingEmbedder()
+    answer, embedding = cache.lookup("What is this about?", "v1", embed)
+    assert answer is None and embed.calls == 1
+    cache.put("What is this about?", "v1", "A test.", embedding)
+    answer, _ = cache.lookup("what is this about", "v1", embed)
+    assert answer == "A test."
+    assert isinstance(answer, CachedAnswer)
+    assert embed.calls == 1
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+
+def test_similar_question_hits_only_same_index_version():
+    cache = SemanticAnswerCache(similarity_threshold=0.95)
+    embed = CountingEmbedder()
+    _, embedding = cache.lookup("What is this about?", "v1", embed)
+    cache.put("What is this about?", "v1", "A test.", embedding)
+    assert cache.lookup("What is the text about", "v1", embed)[0] == "A test."
+    assert cache.lookup("Who wrote it?", "v1", embed)[0] is None
+    assert cache.lookup("What is the text about", "v2", embed)[0] is None
+
+
+def test_invalidate_lru_and_ttl():
+    cache = SemanticAnswerCache(max_entries=2, ttl_seconds=0.05)
+    embed = CountingEmbedder()
+    cache.put("What is this about?", "v1", "A")
+    cache.put("Who wrote it?", "v1", "B")
+    cache.put("Who wrote it?", "v2", "C")
+    assert len(cache) == 2
+    assert cache.lookup("What is this about?", "v1", embed)[0] is None
+    cache.invalidate("v1")
+    assert len(cache) == 1
+    time.sleep(0.1)
+    assert cache.lookup("Who wrote it?", "v2", embed)[0] is None
+
+
+def test_lookup_without_embedding_is_exact():
+    cache = SemanticAnswerCache()
+    cache.put("What is this about?", "v1", "A test.", None)
+    answer, embedding = cache.lookup("what is this about", "v1", None)
+    assert answer == "A test." and embedding is None
+    answer, embedding = cache.lookup("What is the text about", "v1", None)
+    assert answer is None and embedding is None
@@ -0,0 +1,41 @@
+import asyncio
+
+from backend.concurrency import ConcurrencyLimiter
+
+
+def test_limiter_bounds_concurrent_chats():
+    limiter = ConcurrencyLimiter(max_concurrent=2)
+    max_active = 0
+
+    async def chat():
+        nonlocal max_active
+        async with limiter:
+            max_active = max(max_active, limiter.active)
+            await asyncio.sleep(0.01)
+
+    async def run_chats():
+        await asyncio.gather(*(chat() for _ in range(6)))
+
+    asyncio.run(run_chats())
+    stats = limiter.stats()
+    assert max_active == 2
+    assert stats["completed"] == 6
+    assert stats["active"] == stats["waiting"] == 0
+    assert stats["max_waiting"] >= 4
+    assert stats["max_wait_seconds"] > 0
+
+
+def test_limiter_releases_on_error():
+    limiter = ConcurrencyLimiter(max_concurrent=1)
+
+    async def failing_chat():
+        async with limiter:
+            raise ValueError("llm error")
+
+    for _ in range(2):
+        try:
+            asyncio.run(failing_chat())
+        except ValueError:
+            pass
+    assert limiter.stats()["completed"] == 2
+    assert limiter.active == 0
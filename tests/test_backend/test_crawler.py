@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend.crawler import Crawler, extract_links, parse_sitemap
+from backend.http_cache import CachedHttpFetcher
+from backend.models import JobCancelledException
+
+SITE = {
+    "/": '<a href="/a">a</a> <a href="b#intro">b</a> <a href="/a?">again</a>'
+    ' <a href="/missing">missing</a> <a href="https://example.com/">external</a>',
+    "/a": '<p>page a</p> <a href="/c">c</a> <a href="/">home</a>',
+    "/b": "<p>page b</p>",
+    # same content as /b
+    "/b-copy": "<p>page b</p>",
+    "/c": '<p>page c</p> <a href="/d">d</a>',
+    "/d": "<p>page d</p>",
+}
+SITEMAP = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>{base}/a</loc></url>
+  <url><loc>{base}/b</loc></url>
+  <url><loc>{base}/b-copy</loc></url>
+</urlset>"""
+SITEMAP_INDEX = """<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>{base}/sitemap.xml</loc></sitemap>
+</sitemapindex>"""
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    base = ""
+    request_times: list[float] = []
+
+    def do_GET(self):
+        SiteHandler.request_times.append(time.monotonic())
+        if self.path in ("/sitemap.xml", "/sitemap_index.xml"):
+            template = SITEMAP if self.path == "/sitemap.xml" else SITEMAP_INDEX
+            body = template.format(base=SiteHandler.base).encode()
+            content_type = "application/xml"
+        elif self.path.split("?")[0] in SITE:
+            body = SITE[self.path.split("?")[0]].encode()
+            content_type = "text/html"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    SiteHandler.base = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield SiteHandler.base
+    server.shutdown()
+
+
+@pytest.fixture
+def fetch():
+    SiteHandler.request_times.clear()
+    return CachedHttpFetcher(None, max_retries=0).fetch
+
+
+def crawl_pages(crawler: Crawler, urls: list[str], mode: str) -> list[str]:
+    async def crawl():
+        return [page.url async for page in crawler.crawl(urls, mode)]
+
+    return asyncio.run(crawl())
+
+
+def test_extract_links():
+    links = extract_links(
+        b'<a href="/x#top">x</a><a href="mailto:a@b.c">mail</a><a href="y.pdf">y</a>',
+        "https://example.com/docs/",
+    )
+    assert links == ["https://example.com/x"]
+
+
+def test_parse_sitemap():
+    pages, sitemaps = parse_sitemap(SITEMAP.format(base="http://h").encode())
+    assert pages == ["http://h/a", "http://h/b", "http://h/b-copy"] and not sitemaps
+    pages, sitemaps = parse_sitemap(SITEMAP_INDEX.format(base="http://h").encode())
+    assert sitemaps == ["http://h/sitemap.xml"] and not pages
+
+
+def test_seed_crawl_follows_links_of_same_host(base_url, fetch):
+    crawler = Crawler(fetch, max_depth=1)
+    pages = crawl_pages(crawler, [base_url + "/"], "seed")
+    # /a? is /a, /c is too deep, example.com is another host
+    assert sorted(pages) == sorted([base_url + "/", base_url + "/a", base_url + "/b"])
+    stats = crawler.stats()
+    host = base_url.split("//")[1]
+    assert stats["hosts"][host]["errors"] == 1  # /missing
+    assert stats["hosts"][host]["pages"] == 3
+
+
+def test_list_crawl_dedupes_urls_and_content(base_url, fetch):
+    crawler = Crawler(fetch)
+    urls = [base_url + "/b", base_url + "/b/", base_url + "/b-copy", base_url + "/a"]
+    pages = crawl_pages(crawler, urls, "list")
+    assert len(pages) == 2 and base_url + "/a" in pages
+    assert crawler.stats()["duplicates"] == 1
+    # the links of /a are not followed
+    assert len(SiteHandler.request_times) == 3
+
+
+def test_sitemap_index_crawl(base_url, fetch):
+    crawler = Crawler(fetch)
+    pages = crawl_pages(crawler, [base_url + "/sitemap_index.xml"], "sitemap")
+    assert sorted(pages) == [base_url + "/a", base_url + "/b"]
+
+
+def test_host_rate_limit(base_url, fetch):
+    crawler = Crawler(fetch, max_depth=3, host_rate=20)
+    crawl_pages(crawler, [base_url + "/"], "seed")
+    times = SiteHandler.request_times
+    assert len(times) >= 6
+    # at most one request per 1/20 s (with some tolerance for the scheduling)
+    assert times[-1] - times[0] >= (len(times) - 1) / 20 * 0.8
+
+
+def test_batches_and_cancellation(base_url, fetch):
+    async def batches(crawler):
+        return [
+            len(batch)
+            async for batch in crawler.crawl_batches([base_url + "/"], "seed", 2)
+        ]
+
+    crawler = Crawler(fetch, max_depth=3)
+    assert sum(asyncio.run(batches(crawler))) == 5
+    assert max(asyncio.run(batches(Crawler(fetch, max_depth=3)))) == 2
+
+    def cancel(_):
+        raise JobCancelledException("cancelled")
+
+    with pytest.raises(JobCancelledException):
+        asyncio.run(batches(Crawler(fetch, stage_callback=cancel)))
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from backend.fast_path_chat_engine import (
+    FastPathCondenseQuestionChatEngine,
+    needs_condensing,
+)
+from llama_index.chat_engine.condense_question import CondenseQuestionChatEngine
+from llama_index.llms import ChatMessage, MessageRole
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "What is the main argument of the text?",
+        "Who wrote the article about climate change?",
+        "Summarize the chapter about neural networks.",
+    ],
+)
+def test_self_contained_questions(question):
+    assert not needs_condensing(question)
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "Why did he do it?",
+        "What are their main results?",
+        "And the second one?",
+        "Why?",
+        "What about the conclusion?",
+        "Can you explain this in more detail?",
+        "so the author...",
+    ],
+)
+def test_follow_up_questions(question):
+    assert needs_condensing(question)
+
+
+def test_condensing_is_skipped_without_history_or_references(monkeypatch):
+    condensed = []
+
+    def condense_question(self, chat_history, last_message):
+        condensed.append(last_message)
+        return f"condensed: {last_message}"
+
+    async def acondense_question(self, chat_history, last_message):
+        return condense_question(self, chat_history, last_message)
+
+    # the llm call of the parent engine
+    monkeypatch.setattr(
+        CondenseQuestionChatEngine, "_condense_question", condense_question
+    )
+    monkeypatch.setattr(
+        CondenseQuestionChatEngine, "_acondense_question", acondense_question
+    )
+    engine = FastPathCondenseQuestionChatEngine.__new__(
+        FastPathCondenseQuestionChatEngine
+    )
+    history = [ChatMessage(role=MessageRole.USER, content="Who is Ada Lovelace?")]
+    before = FastPathCondenseQuestionChatEngine.stats()
+    assert engine._condense_question([], "Why did he do it?") == "Why did he do it?"
+    question = "Who invented the analytical engine?"
+    assert engine._condense_question(history, question) == question
+    assert asyncio.run(engine._acondense_question([], question)) == question
+    assert condensed == []
+
+    assert engine._condense_question(history, "What did she write?") == (
+        "condensed: What did she write?"
+    )
+    assert asyncio.run(engine._acondense_question(history, "And why?")) == (
+        "condensed: And why?"
+    )
+    assert condensed == ["What did she write?", "And why?"]
+    after = FastPathCondenseQuestionChatEngine.stats()
+    assert after["turns"] - before["turns"] == 5
+    assert after["skipped"] - before["skipped"] == 3
+    assert 0 < after["skipped_fraction"] <= 1
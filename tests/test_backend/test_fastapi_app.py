@@ -1,14 +1,23 @@
 # python -m tests.test_backend.test_fastapi_app.py
 import logging
 import os
+import hashlib
 import io
+import json
 import pytest
 from pathlib import Path
+import sqlite3
 import sys
+import time
 
 from fastapi.testclient import TestClient
 
+from backend import fastapi_app
 from backend.fastapi_app import app
+from backend.crawler import CrawledPage, Crawler
+from backend.ingestion_jobs import IngestionJob
+from backend.session_pool import DEFAULT_SESSION_ID
+from backend.sqlite_engine import sqlite_path
 from backend.models import (
     EmptyQuestionException,
     DoubleUploadException,
@@ -27,6 +36,30 @@ example_file_dir = Path(__file__).parents[1] / "example_upload_files"
 # Todo: put fixtures into conftest.py
 
 
+def wait_for_ingestion(upload_response, timeout: float = 120) -> dict:
+    """polls the ingestion job status until the job is finished"""
+    job = upload_response.json()
+    deadline = time.monotonic() + timeout
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.2)
+        job = client.get(f"/upload/{job['job_id']}").json()
+    return job
+
+
+def uploaded_files(file_name: str) -> list[Path]:
+    """the saved copies of an upload, data/<content hash>/<file name>"""
+    return list(Path(backend_dir / "data").glob(f"*/{file_name}"))
+
+
+def read_sse_events(response) -> list[tuple[str, dict]]:
+    """parses the server-sent events of a streamed response"""
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
 @pytest.fixture
 def text_file():
     file_name = "example.txt"
@@ -35,11 +68,9 @@ def text_file():
             yield upload_file
         # clean-up app storage after tests
         finally:
-            if app.state.chat_engine:
-                app.state.chat_engine.clear_data_storage()
-                logging.debug("chat engine cleared...")
-                app.state.chat_engine = None
-            if (file := Path(backend_dir / "data" / file_name)).is_file():
+            app.state.sessions.clear(DEFAULT_SESSION_ID)
+            logging.debug("chat engine cleared...")
+            for file in uploaded_files(file_name):
                 os.remove(file)
 
 
@@ -47,12 +78,8 @@ def text_file():
 def url():
     yield "https://de.wikipedia.org/wiki/Don’t_repeat_yourself"
     # clean-up (clear_storage)
-    if app.state.chat_engine:
-        app.state.chat_engine.clear_data_storage()
-        logging.debug("chat engine cleared...")
-    app.state.chat_engine = None
-    app.state.callback_manager = None
-    app.state.token_counter = None
+    app.state.sessions.clear(DEFAULT_SESSION_ID)
+    logging.debug("chat engine cleared...")
 
 
 @pytest.fixture
@@ -62,11 +89,9 @@ def db_file():
         try:
             yield upload_file
         finally:
-            if app.state.chat_engine:
-                app.state.chat_engine.clear_data_storage()
-                logging.debug("chat engine cleared...")
-                app.state.chat_engine = None
-            if (file := Path(backend_dir / "data" / file_name)).is_file():
+            app.state.sessions.clear(DEFAULT_SESSION_ID)
+            logging.debug("chat engine cleared...")
+            for file in uploaded_files(file_name):
                 os.remove(file)
 
 
@@ -79,7 +104,10 @@ def test_upload_text_file(text_file):
         files={"upload_file": (text_file.name, text_file)},
     )
     assert response.status_code == 200
-    data = response.json()
+    job = wait_for_ingestion(response)
+    assert job["status"] == "done"
+    assert job["completed_stages"][-1] == "persist"
+    data = job["result"]
     # test if keys in response and if not None
     assert data.get("file_name", None) == text_file.name
     assert data.get("text_category", None) is not None
@@ -92,7 +120,9 @@ def test_upload_text_file(text_file):
 def test_upload_url_webpage(url):
     response = client.post("/upload", data={"upload_url": url}, files=None)
     assert response.status_code == 200
-    data = response.json()
+    job = wait_for_ingestion(response)
+    assert job["status"] == "done"
+    data = job["result"]
     # test if keys in response and if not None
     assert data.get("file_name", None) == url
     assert data.get("text_category", None) is not None
@@ -107,14 +137,17 @@ def test_upload_database_file(db_file):
         data={"upload_url": ""},
         files={"upload_file": (db_file_name, db_file)},
     )
+    assert response.status_code == 200
+    job = wait_for_ingestion(response)
+    assert job["status"] == "done"
 
-    assert app.state.chat_engine is not None
-    assert app.state.chat_engine.data_category == "database"
-    assert app.state.callback_manager is None  # is None in database mode
-    assert app.state.token_counter is not None
+    session = app.state.sessions.get(DEFAULT_SESSION_ID)
+    assert session.chat_engine is not None
+    assert session.chat_engine.data_category == "database"
+    assert session.callback_manager is None  # is None in database mode
+    assert session.token_counter is not None
 
-    assert response.status_code == 200
-    data = response.json()
+    data = job["result"]
     # test if keys in response and if not None
     assert data.get("file_name", None) == db_file_name
     assert data.get("text_category") == "database"
@@ -138,6 +171,58 @@ def test_upload_no_url_and_no_file():
     # assert response.status_code == 400
 
 
+def test_upload_file_too_large(text_file, monkeypatch):
+    monkeypatch.setitem(fastapi_app.UPLOAD_LIMITS, "txt", 10)
+    response = client.post(
+        "/upload",
+        data={"upload_url": ""},
+        files={"upload_file": (Path(text_file.name).name, text_file)},
+    )
+    assert response.status_code == 413
+    assert uploaded_files(Path(text_file.name).name) == []
+
+
+@pytest.mark.ai_call
+@pytest.mark.ai_embeddings
+def test_upload_bulk_text_files(text_file):
+    second_file = io.BytesIO(b"Hippos are large, mostly herbivorous mammals in Africa.")
+    response = client.post(
+        "/upload_bulk",
+        files=[
+            ("upload_files", (Path(text_file.name).name, text_file)),
+            ("upload_files", ("hippos.txt", second_file)),
+        ],
+    )
+    try:
+        assert response.status_code == 200
+        job = wait_for_ingestion(response)
+        assert job["status"] == "done"
+        assert job["completed_stages"][-1] == "persist"
+        data = job["result"]
+        assert data["files"] == 2
+        assert data["failed"] == {}
+        assert job["progress"]["ingested"] == 2
+        session = app.state.sessions.get(DEFAULT_SESSION_ID)
+        assert len(session.chat_engine.documents) == 2
+    finally:
+        for file in uploaded_files("hippos.txt"):
+            file.unlink(missing_ok=True)
+
+
+def test_upload_bulk_unsupported_file_type():
+    response = client.post(
+        "/upload_bulk",
+        files=[("upload_files", ("database.sqlite", io.BytesIO(b"SQLite")))],
+    )
+    assert response.status_code == 400
+    assert uploaded_files("database.sqlite") == []
+
+
+def test_upload_status_of_unknown_job():
+    response = client.get("/upload/unknown")
+    assert response.status_code == 404
+
+
 def test_upload_bad_url():
     url = "this/is/no/url"
     response = client.post("/upload", data={"upload_url": url}, files=None)
@@ -153,11 +238,12 @@ def test_upload_bad_url():
 @pytest.mark.ai_gpt35
 def test_ask_question_about_given_text(text_file):
     """Caution: openai API call required"""
-    client.post(
+    upload_response = client.post(
         "/upload",
         data={"upload_url": ""},
         files={"upload_file": (text_file.name, text_file)},
     )
+    wait_for_ingestion(upload_response)
     response = client.post(
         "/qa_text",
         json={
@@ -182,6 +268,7 @@ def test_ask_question_about_given_database(db_file):
         "/upload", files={"upload_file": (Path(db_file.name).name, db_file)}
     )
     assert upload_response.status_code == 200
+    wait_for_ingestion(upload_response)
 
     response = client.post(
         "/qa_text",
@@ -202,14 +289,72 @@ def test_ask_question_about_given_database(db_file):
     assert data.get("used_tokens", None) is not None
 
 
+def test_stream_answer_without_context():
+    response = client.post(
+        "/qa_text/stream",
+        json={"prompt": "What is this about?", "temperature": 0.0},
+        headers={"X-Session-ID": "stream-test"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = read_sse_events(response)
+    assert [event for event, _ in events] == ["token", "done"]
+    assert events[-1][1]["used_tokens"] == 0
+    assert "Sorry, no context loaded." in events[-1][1]["ai_answer"]
+    app.state.sessions.close("stream-test")
+
+
+@pytest.mark.ai_call
+@pytest.mark.ai_gpt35
+def test_stream_answer_about_given_text(text_file):
+    """Caution: openai API call required"""
+    upload_response = client.post(
+        "/upload",
+        data={"upload_url": ""},
+        files={"upload_file": (text_file.name, text_file)},
+    )
+    wait_for_ingestion(upload_response)
+    response = client.post(
+        "/qa_text/stream",
+        json={"prompt": "What is the text about?", "temperature": 0.0},
+    )
+    assert response.status_code == 200
+    events = read_sse_events(response)
+    assert events[-1][0] == "done"
+    tokens = "".join(data["token"] for event, data in events if event == "token")
+    assert tokens == events[-1][1]["ai_answer"]
+    assert events[-1][1]["used_tokens"] > 0
+
+
+@pytest.mark.ai_call
+@pytest.mark.ai_gpt35
+def test_repeated_question_hits_answer_cache(text_file):
+    """Caution: openai API call required"""
+    upload_response = client.post(
+        "/upload",
+        data={"upload_url": ""},
+        files={"upload_file": (text_file.name, text_file)},
+    )
+    wait_for_ingestion(upload_response)
+    question = {"prompt": "What is the text about?", "temperature": 0.0}
+    first = client.post("/qa_text", json=question).json()
+    assert not first["answer_cache_hit"]
+    client.get("/clear_history")
+    second = client.post("/qa_text", json=question).json()
+    assert second["answer_cache_hit"]
+    assert second["ai_answer"] == first["ai_answer"]
+    assert second["used_tokens"] == 0
+
+
 @pytest.mark.ai_call
 @pytest.mark.ai_gpt35
 def test_qa_with_empty_question(text_file):
-    client.post(
+    upload_response = client.post(
         "/upload",
         data={"upload_url": ""},
         files={"upload_file": (text_file.name, text_file)},
     )
+    wait_for_ingestion(upload_response)
     with pytest.raises(EmptyQuestionException):
         client.post(
             "/qa_text",
@@ -226,6 +371,130 @@ def test_clear_storage():
     assert response.json() == {"message": "Knowledge base succesfully cleared"}
 
 
+def test_sessions_are_isolated(db_file):
+    upload_response = client.post(
+        "/upload", files={"upload_file": (Path(db_file.name).name, db_file)}
+    )
+    assert wait_for_ingestion(upload_response)["status"] == "done"
+    response = client.get("/clear_history", headers={"X-Session-ID": "other"})
+    assert response.json() == {
+        "message": "No active chat available, please load a document."
+    }
+    # clearing another session keeps the files of the default session
+    client.get("/clear_storage", headers={"X-Session-ID": "other"})
+    assert len(uploaded_files(Path(db_file.name).name)) == 1
+    app.state.sessions.close("other")
+
+
+def test_uploads_with_the_same_name_are_kept_apart(tmp_path):
+    """two sessions upload different databases with the same file name"""
+    databases = {}
+    for session_id, table in [("first", "users"), ("second", "orders")]:
+        path = tmp_path / session_id / "shop.sqlite"
+        path.parent.mkdir()
+        with sqlite3.connect(path) as connection:
+            connection.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY)")
+        databases[session_id] = (path.read_bytes(), table)
+    try:
+        responses = [
+            client.post(
+                "/upload",
+                files={"upload_file": ("shop.sqlite", io.BytesIO(content))},
+                headers={"X-Session-ID": session_id},
+            )
+            for session_id, (content, _) in databases.items()
+        ]
+        for response in responses:
+            assert wait_for_ingestion(response)["status"] == "done"
+        assert len(uploaded_files("shop.sqlite")) == 2
+        for session_id, (content, table) in databases.items():
+            database = app.state.sessions.get(session_id).chat_engine.document
+            assert database.get_usable_table_names() == [table]
+            path = sqlite_path(database._engine)
+            assert path.read_bytes() == content
+            assert path.parent.name == hashlib.sha256(content).hexdigest()
+    finally:
+        for session_id in databases:
+            app.state.sessions.close(session_id)
+    assert uploaded_files("shop.sqlite") == []
+
+
+class InUseCheckingChatEngine:
+    """answers, whether its session was in use while the answer was awaited"""
+
+    data_category = "other"
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+
+    def update_temp(self, temperature: float) -> None:
+        pass
+
+    async def aanswer_question(self, question) -> str:
+        return str(app.state.sessions.get(self.session_id).in_use)
+
+    def clear_data_storage(self) -> None:
+        pass
+
+    def approximate_size(self) -> int:
+        return 0
+
+
+def test_session_held_while_answering():
+    session = app.state.sessions.get("answering")
+    token_counter = fastapi_app.CustomTokenCounter()
+    session.set_chat_engine(InUseCheckingChatEngine("answering"), None, token_counter)
+    try:
+        response = client.post(
+            "/qa_text",
+            json={"prompt": "Is the session in use?", "temperature": 0},
+            headers={"X-Session-ID": "answering"},
+        )
+        assert response.json()["ai_answer"] == "True"
+        assert not session.in_use
+    finally:
+        app.state.sessions.close("answering")
+
+
+class RecordingTextChatEngine:
+    def __init__(self) -> None:
+        self.batches: list[list] = []
+
+    def add_documents(self, documents, stage_callback=None) -> None:
+        self.batches.append(documents)
+
+
+def test_crawled_pages_are_added_in_one_batch(monkeypatch):
+    def build_document(url, *args, **kwargs):
+        if "broken" in url:
+            raise ValueError("no text")
+        return url
+
+    monkeypatch.setattr(fastapi_app, "AIHtmlDocument", build_document)
+    crawler = Crawler(fetch=None)
+    urls = ["https://example.com/a", "https://example.com/broken", "https://b.org/"]
+    batch = [CrawledPage(url, b"<html></html>", url) for url in urls]
+    chat_engine = RecordingTextChatEngine()
+    documents = fastapi_app.ingest_page_batch(
+        IngestionJob("crawl"), batch, crawler, chat_engine, None
+    )
+    assert documents == [urls[0], urls[2]]
+    assert chat_engine.batches == [documents]
+    stats = crawler.stats()
+    assert stats["ingested"] == 2
+    assert stats["errors"] == 1
+
+
+def test_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["chat_concurrency"]["active"] == 0
+    assert data["quiz_pool"]["pools"] >= 0
+    assert "saved_llm_calls" in data["sql_examples"]
+    assert "sessions" in data["sessions"]
+
+
 def test_clear_history_no_context_loaded():
     response = client.get("/clear_history")
     assert response.status_code == 200
@@ -0,0 +1,123 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from backend.http_cache import CachedHttpFetcher, freshness_lifetime
+from backend.script_RAG import AIHtmlDocument
+
+PAGE = b"<html><body><h1>Hippos</h1><p>Hippos live in Africa.</p></body></html>"
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """serves PAGE with the caching headers of the path"""
+
+    requests: list[tuple[str, dict]] = []
+
+    def do_GET(self):
+        PageHandler.requests.append((self.path, dict(self.headers)))
+        headers = {"Content-Type": "text/html"}
+        if self.path == "/etag":
+            headers["ETag"] = '"v1"'
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+        elif self.path == "/last-modified":
+            headers["Last-Modified"] = "Mon, 02 Oct 2023 10:00:00 GMT"
+            if self.headers.get("If-Modified-Since") == headers["Last-Modified"]:
+                self.send_response(304)
+                self.end_headers()
+                return
+        elif self.path == "/max-age":
+            headers["Cache-Control"] = "public, max-age=3600"
+        elif self.path == "/no-store":
+            headers["Cache-Control"] = "no-store"
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture
+def fetcher(tmp_path):
+    PageHandler.requests.clear()
+    return CachedHttpFetcher(tmp_path / "http_cache")
+
+
+def test_freshness_lifetime():
+    assert freshness_lifetime({"cache-control": "max-age=60"}) == 60
+    assert freshness_lifetime({"cache-control": "no-cache, max-age=60"}) == 0
+    assert freshness_lifetime({"expires": "Thu, 01 Jan 1970 00:00:00 GMT"}) == 0
+    assert freshness_lifetime({}) == 0
+
+
+@pytest.mark.parametrize("path", ["/etag", "/last-modified"])
+def test_conditional_request_reuses_cached_page(server_url, fetcher, path):
+    first = fetcher.fetch(server_url + path)
+    second = fetcher.fetch(server_url + path)
+    assert first.content == second.content == PAGE
+    assert not first.revalidated and second.revalidated
+    assert len(PageHandler.requests) == 2
+    conditional_headers = PageHandler.requests[1][1]
+    assert "If-None-Match" in conditional_headers or (
+        "If-Modified-Since" in conditional_headers
+    )
+    assert fetcher.stats()["revalidated"] == 1
+
+
+def test_fresh_page_is_served_without_request(server_url, fetcher):
+    fetcher.fetch(server_url + "/max-age")
+    response = fetcher.fetch(server_url + "/max-age")
+    assert response.from_cache
+    assert len(PageHandler.requests) == 1
+
+
+def test_no_store_is_not_cached(server_url, fetcher):
+    fetcher.fetch(server_url + "/no-store")
+    response = fetcher.fetch(server_url + "/no-store")
+    assert not response.from_cache and not response.revalidated
+    assert fetcher.stats()["downloads"] == 2
+
+
+def test_cached_copy_without_revalidation(server_url, fetcher):
+    fetcher.fetch(server_url + "/etag")
+    response = fetcher.fetch(server_url + "/etag", revalidate=False)
+    assert response.from_cache
+    assert len(PageHandler.requests) == 1
+
+
+@pytest.mark.parametrize("path", ["/no-store", "/etag"])
+def test_html_document_fetches_page_once(server_url, fetcher, monkeypatch, path):
+    monkeypatch.setattr(AIHtmlDocument, "http_fetcher", fetcher)
+    monkeypatch.setattr(AIHtmlDocument, "ingestion_cache", None)
+    marvin_extractor = SimpleNamespace(
+        used_tokens=0,
+        extract=lambda nodes: [
+            {"marvin_metadata": {"category": "Science", "description": "Hippos"}}
+        ],
+    )
+    monkeypatch.setattr(
+        AIHtmlDocument, "_get_marvin_extractor", lambda self, llm_str: marvin_extractor
+    )
+    document = AIHtmlDocument(server_url + path, "gpt-3.5-turbo")
+    assert "Hippos live in Africa." in document.nodes[0].text
+    assert len(PageHandler.requests) == 1
+    # e.g. a crawled page
+    AIHtmlDocument(server_url + path, "gpt-3.5-turbo", content=PAGE)
+    assert len(PageHandler.requests) == 1
@@ -0,0 +1,19 @@
+import importlib
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "backend.lexical_index",
+        "backend.index_persistence",
+        "backend.schema_index",
+        "backend.script_RAG",
+        "backend.script_SQL_querying",
+        "backend.fastapi_app",
+    ],
+)
+def test_backend_modules_import(module):
+    """the backend starts only, if all modules import with the pinned versions"""
+    assert importlib.import_module(module)
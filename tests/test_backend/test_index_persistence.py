@@ -0,0 +1,26 @@
+from backend.index_persistence import WriteAheadLog
+
+
+def test_log_records_are_read_in_order(tmp_path):
+    log = WriteAheadLog(tmp_path / "index.wal")
+    log.append({"op": "delete", "ref_doc_id": "a"})
+    log.append({"op": "delete", "ref_doc_id": "b"})
+
+    records = list(WriteAheadLog(tmp_path / "index.wal").read())
+    assert [record["ref_doc_id"] for record in records] == ["a", "b"]
+    assert [record["seq"] for record in records] == [1, 2]
+
+
+def test_torn_last_record_is_discarded(tmp_path):
+    log = WriteAheadLog(tmp_path / "index.wal")
+    log.append({"op": "delete", "ref_doc_id": "a"})
+    intact_size = log.size_bytes()
+    log.append({"op": "delete", "ref_doc_id": "b"})
+    # simulate a crash in the middle of the second write
+    with open(log.path, "r+b") as f:
+        f.truncate(intact_size + 10)
+
+    reopened = WriteAheadLog(tmp_path / "index.wal")
+    assert [record["ref_doc_id"] for record in reopened.read()] == ["a"]
+    assert reopened.size_bytes() == intact_size
+    assert reopened.last_seq == 1
@@ -0,0 +1,40 @@
+import os
+import time
+
+from backend.ingestion_cache import IngestionCache
+
+
+def test_put_and_get(tmp_path):
+    cache = IngestionCache(tmp_path)
+    key = IngestionCache.make_key(IngestionCache.hash_bytes(b"text"), "gpt-3.5-turbo")
+    assert cache.get(key) is None
+    cache.put(key, ["node_1", "node_2"])
+    assert cache.get(key) == ["node_1", "node_2"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_depends_on_settings():
+    content_hash = IngestionCache.hash_bytes(b"text")
+    assert IngestionCache.make_key(content_hash, 1024) != IngestionCache.make_key(
+        content_hash, 512
+    )
+
+
+def test_invalidate(tmp_path):
+    cache = IngestionCache(tmp_path)
+    cache.put("key", "value")
+    assert cache.invalidate("key")
+    assert not cache.invalidate("key")
+    assert cache.get("key") is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = IngestionCache(tmp_path, max_bytes=10**6)
+    cache.put("old", b"x" * 1000)
+    cache.put("new", b"x" * 1000)
+    past = time.time() - 100
+    os.utime(tmp_path / "old.pkl", (past, past))
+    cache.max_bytes = cache.size_bytes() - 1
+    cache.evict()
+    assert cache.get("old") is None
+    assert cache.get("new") is not None
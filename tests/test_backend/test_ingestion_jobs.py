@@ -0,0 +1,54 @@
+import threading
+
+from backend.ingestion_jobs import IngestionJobQueue
+from backend.models import TextSummaryModel
+
+
+def summary(job):
+    for stage in ("load", "split", "extract", "embed", "persist"):
+        job.report_stage(stage)
+    return TextSummaryModel(
+        file_name=job.file_name, text_category="Technical", summary="", used_tokens=0
+    )
+
+
+def test_job_runs_all_stages():
+    queue = IngestionJobQueue(max_workers=1)
+    job = queue.submit("example.txt", summary)
+    job.future.result(timeout=5)
+    assert job.status == "done"
+    assert job.completed_stages == ["load", "split", "extract", "embed", "persist"]
+    assert job.to_model().result.file_name == "example.txt"
+    queue.shutdown()
+
+
+def test_failing_job_reports_error():
+    def fail(job):
+        job.report_stage("load")
+        raise FileNotFoundError("missing file")
+
+    queue = IngestionJobQueue(max_workers=1)
+    job = queue.submit("example.txt", fail)
+    job.future.result(timeout=5)
+    assert job.status == "failed"
+    assert job.error == "missing file"
+    queue.shutdown()
+
+
+def test_cancel_running_job():
+    started, proceed = threading.Event(), threading.Event()
+
+    def slow(job):
+        job.report_stage("load")
+        started.set()
+        proceed.wait(timeout=5)
+        return summary(job)
+
+    queue = IngestionJobQueue(max_workers=1)
+    job = queue.submit("example.txt", slow)
+    started.wait(timeout=5)
+    queue.cancel(job.job_id)
+    proceed.set()
+    job.future.result(timeout=5)
+    assert job.status == "cancelled"
+    queue.shutdown()
@@ -0,0 +1,101 @@
+import asyncio
+
+from llama_index import ServiceContext, VectorStoreIndex
+from llama_index.schema import TextNode
+from llama_index.token_counter.mock_embed_model import MockEmbedding
+
+from backend.lexical_index import BM25Index, HybridRetriever, tokenize
+
+
+def make_index():
+    index = BM25Index()
+    index.add("n1", "The product code XK-200 belongs to the pump.", group="manual")
+    index.add("n2", "A pump moves fluids by mechanical action.", group="manual")
+    index.add("n3", "Don't repeat yourself is a software principle.", group="wiki")
+    return index
+
+
+def test_tokenize():
+    assert tokenize("XK-200, the Pump!") == ["xk", "200", "the", "pump"]
+
+
+def test_exact_term_ranks_first():
+    hits = make_index().search("XK-200", top_k=2)
+    assert hits[0][0] == "n1"
+    assert len(hits) == 1
+
+
+def test_search_restricted_to_groups():
+    hits = make_index().search("pump principle", groups=["wiki"])
+    assert [doc_id for doc_id, _ in hits] == ["n3"]
+
+
+def test_remove_group():
+    index = make_index()
+    index.remove_group("manual")
+    assert len(index) == 1
+    assert index.search("pump") == []
+
+
+def test_add_remove_add_keeps_groups_consistent():
+    index = make_index()
+    index.add("n1", "The product code XK-300 belongs to the pump.", group="manual")
+    assert index.groups["manual"] == ["n2", "n1"]
+    index.remove("n1")
+    index.remove("n3")
+    assert index.groups == {"manual": ["n2"]}
+    index.add("n1", "The product code XK-200 belongs to the pump.", group="manual")
+    index.add("n1", "The product code XK-200 belongs to the pump.", group="manual")
+    assert index.groups == {"manual": ["n2", "n1"]}
+    assert len(index) == 2
+    assert [doc_id for doc_id, _ in index.search("XK-200", groups=["manual"])] == ["n1"]
+
+
+def test_persist_roundtrip(tmp_path):
+    index = make_index()
+    index.persist(tmp_path / "lexical_index.json")
+    loaded = BM25Index.from_persist_path(tmp_path / "lexical_index.json")
+    assert loaded.search("pump") == index.search("pump")
+    loaded.remove("n3")
+    assert "wiki" not in loaded.groups
+
+
+class AsyncOnlyEmbedding(MockEmbedding):
+    """fails on the blocking query embedding"""
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        raise AssertionError("sync embedding call on the async path")
+
+
+def make_retriever(mode: str = "hybrid") -> HybridRetriever:
+    nodes = [
+        TextNode(text="The product code XK-200 belongs to the pump.", id_="n1"),
+        TextNode(text="A pump moves fluids by mechanical action.", id_="n2"),
+        TextNode(text="Don't repeat yourself is a software principle.", id_="n3"),
+    ]
+    service_context = ServiceContext.from_defaults(
+        llm=None, embed_model=AsyncOnlyEmbedding(embed_dim=8)
+    )
+    vector_index = VectorStoreIndex(nodes, service_context=service_context)
+    lexical_index = BM25Index()
+    lexical_index.add_nodes(nodes)
+    return HybridRetriever(
+        vector_retriever=vector_index.as_retriever(similarity_top_k=3),
+        lexical_index=lexical_index,
+        docstore=vector_index.docstore,
+        mode=mode,
+        similarity_top_k=3,
+    )
+
+
+def test_async_hybrid_retrieval_without_sync_embedding(monkeypatch):
+    results = asyncio.run(make_retriever().aretrieve("XK-200"))
+    assert results[0].node.node_id == "n1"
+    assert {result.node.node_id for result in results} == {"n1", "n2", "n3"}
+
+    # large lexical indexes are searched in a thread
+    monkeypatch.setattr(HybridRetriever, "lexical_thread_min_entries", 1)
+    results = asyncio.run(make_retriever().aretrieve("XK-200"))
+    assert results[0].node.node_id == "n1"
+    results = asyncio.run(make_retriever("vector").aretrieve("XK-200"))
+    assert len(results) == 3
@@ -0,0 +1,48 @@
+import pytest
+
+from backend.pdf_pages import extract_pages, get_pool, iter_pages, shutdown_pool
+from backend.script_RAG import AIPdfDocument, load_and_split
+from benchmarks.bench_pdf_ingestion import write_pdf
+
+
+@pytest.fixture(scope="module")
+def pdf_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp("pdf") / "pages.pdf"
+    write_pdf(path, 40)
+    return path
+
+
+def test_extract_page_range(pdf_file):
+    pages = extract_pages(pdf_file, 5, 8)
+    assert [number for number, _ in pages] == [6, 7, 8]
+    assert pages[0][1].startswith("Page 6")
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_iter_pages_in_order(pdf_file, monkeypatch, workers):
+    monkeypatch.setenv("PARSE_WORKERS", workers)
+    pages = list(iter_pages(pdf_file, pages_per_task=4))
+    assert [number for number, _ in pages] == list(range(1, 41))
+    assert pages == extract_pages(pdf_file, 0, 40)
+
+
+def test_parse_pool_is_shared_and_recreated_after_shutdown():
+    pool = get_pool()
+    assert get_pool() is pool
+    shutdown_pool()
+    assert get_pool() is not pool
+    shutdown_pool()
+
+
+def test_pdf_documents_keep_page_numbers(pdf_file):
+    documents = list(AIPdfDocument._load_documents(str(pdf_file)))
+    assert len(documents) == 40
+    assert documents[-1].metadata == {"page_label": "40", "file_name": "pages.pdf"}
+    # all pages belong to one ref doc
+    assert len({document.doc_id for document in documents}) == 1
+
+    nodes = load_and_split(AIPdfDocument, str(pdf_file))
+    assert {node.metadata["page_label"] for node in nodes} == {
+        str(number) for number in range(1, 41)
+    }
+    assert len({node.ref_doc_id for node in nodes}) == 1
@@ -0,0 +1,146 @@
+import threading
+
+import numpy as np
+
+import pytest
+
+from backend.models import MultipleChoiceQuestion
+from backend.quiz import QuizGenerator, QuizPool, dedupe_questions
+
+
+class FakeGenerator:
+    def __init__(self, fail: bool = False) -> None:
+        self.calls = 0
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+
+    def generate(self, vector_index, doc_ids, size=3):
+        self.release.wait(5)
+        self.calls += 1
+        if self.fail:
+            raise ValueError("no valid json")
+        return {"doc_ids": doc_ids, "n": self.calls, "size": size}
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def generator():
+    return FakeGenerator()
+
+
+@pytest.fixture
+def pool(generator):
+    pool = QuizPool(generator, pool_size=2, max_workers=1)
+    yield pool
+    generator.release.set()
+    pool.shutdown()
+
+
+def test_refill_generates_in_background(pool, generator):
+    pool.refill("v1", None, ["doc"])
+    for future in pool.pools[("v1", 3)]:
+        future.result(timeout=5)
+    assert generator.calls == 2
+    assert pool.stats()["ready"] == 2
+
+
+def test_get_serves_from_pool_and_refills(pool, generator):
+    pool.refill("v1", None, ["doc"])
+    for future in list(pool.pools[("v1", 3)]):
+        future.result(timeout=5)
+    quiz = pool.get("v1", None, ["doc"]).result(timeout=5)
+    assert quiz["doc_ids"] == ["doc"]
+    assert pool.stats()["served_ready"] == 1
+    assert len(pool.pools[("v1", 3)]) == 2
+
+
+def test_get_without_pool_generates(pool, generator):
+    generator.release.clear()
+    future = pool.get("v1", None, ["doc"])
+    assert not future.done()
+    generator.release.set()
+    assert future.result(timeout=5)["n"] >= 1
+    assert pool.stats()["served_pending"] == 1
+
+
+def test_pools_per_size(pool, generator):
+    quiz = pool.get("v1", None, ["doc"], size=5).result(timeout=5)
+    assert quiz["size"] == 5
+    pool.refill("v1", None, ["doc"])
+    assert set(pool.pools) == {("v1", 3), ("v1", 5)}
+    pool.invalidate("v1")
+    assert not pool.pools
+
+
+def test_invalidate_drops_version(pool, generator):
+    generator.release.clear()
+    pool.refill("v1", None, ["doc"])
+    pending = list(pool.pools[("v1", 3)])
+    pool.invalidate("v1")
+    assert not pool.pools
+    # the queued quiz is not generated anymore
+    assert pending[-1].cancelled()
+
+
+def test_failed_quizzes_are_dropped():
+    pool = QuizPool(FakeGenerator(fail=True), pool_size=1, max_workers=1)
+    with pytest.raises(ValueError):
+        pool.get("v1", None, ["doc"]).result(timeout=5)
+    failed = pool.pools[("v1", 3)][0]
+    failed.exception(timeout=5)
+    pool.refill("v1", None, ["doc"])
+    assert list(pool.pools[("v1", 3)]) != [failed]
+    pool.shutdown()
+
+
+def test_old_versions_are_evicted(generator):
+    pool = QuizPool(generator, pool_size=1, max_workers=1, max_pools=2)
+    for version in ["v1", "v2", "v3"]:
+        pool.refill(version, None, [version])
+    assert list(pool.pools) == [("v2", 3), ("v3", 3)]
+    pool.shutdown()
+
+
+def make_question(text: str) -> MultipleChoiceQuestion:
+    return MultipleChoiceQuestion(
+        question=text,
+        correct_answer="a",
+        wrong_answer_1="b",
+        wrong_answer_2="c",
+    )
+
+
+def test_dedupe_questions():
+    questions = [
+        make_question("What is the capital of France?"),
+        make_question("what is the capital of France"),
+        make_question("Which river flows through Paris?"),
+    ]
+    assert [q.question for q in dedupe_questions(questions)] == [
+        "What is the capital of France?",
+        "Which river flows through Paris?",
+    ]
+
+
+def test_cluster_contexts_cover_all_topics():
+    generator = QuizGenerator.__new__(QuizGenerator)
+    generator.chunks_per_cluster = 1
+
+    class Node:
+        def __init__(self, text):
+            self.text = text
+
+        def get_content(self, metadata_mode=None):
+            return self.text
+
+    nodes = [Node(f"{topic} {i}") for topic in ["cats", "ships"] for i in range(5)]
+    embeddings = np.array(
+        [[1.0, 0.01 * i] for i in range(5)] + [[0.01 * i, 1.0] for i in range(5)]
+    )
+    contexts = generator._cluster_contexts(nodes, embeddings, 4)
+    assert sum(n for _, n in contexts) == 4
+    topics = {context.split()[0] for context, _ in contexts}
+    assert topics == {"cats", "ships"}
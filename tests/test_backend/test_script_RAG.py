@@ -1,4 +1,15 @@
+from types import SimpleNamespace
+
+import pytest
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from backend.models import QuestionModel
+
 from backend.script_RAG import (
+    AIMarvinDocument,
+    AITextDocument,
+    CustomLlamaIndexChatEngineWrapper,
+    SharedTextIndex,
     set_up_text_chatbot,
 )
 
@@ -8,3 +19,101 @@ def test_set_up_chatbot():
     assert chat_engine is not None
     assert callback_manager is not None
     assert token_counter is not None
+
+
+def embedded_document(ref_doc_id: str) -> SimpleNamespace:
+    """an uploaded document, whose nodes are embedded already"""
+    node = TextNode(
+        text=f"text of {ref_doc_id}",
+        embedding=[1.0, 0.0, 0.0, 0.0],
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=ref_doc_id)},
+    )
+    return SimpleNamespace(
+        nodes=[node], category="other", embed_nodes=lambda embed_model: None
+    )
+
+
+def test_shared_index_holds_one_reference_per_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(SharedTextIndex, "cfd", tmp_path)
+    shared_index = SharedTextIndex()
+    session = CustomLlamaIndexChatEngineWrapper(shared_index=shared_index)
+    other_session = CustomLlamaIndexChatEngineWrapper(shared_index=shared_index)
+    # uploaded twice in the same session, once in the other one
+    session.add_document(embedded_document("doc-1"))
+    session.add_documents([embedded_document("doc-1"), embedded_document("doc-2")])
+    other_session.add_document(embedded_document("doc-1"))
+    assert session.doc_ids == ["doc-1", "doc-2"]
+    assert len(shared_index.owners["doc-1"]) == 2
+
+    other_session.clear_data_storage()
+    assert shared_index._contains("doc-1")
+    session.clear_data_storage()
+    assert not shared_index._contains("doc-1")
+    assert not shared_index._contains("doc-2")
+    assert shared_index.owners == {}
+
+
+def make_session(tmp_path, monkeypatch, retrieval_mode: str):
+    monkeypatch.setattr(SharedTextIndex, "cfd", tmp_path)
+    monkeypatch.setenv("RETRIEVAL_MODE", retrieval_mode)
+    shared_index = SharedTextIndex()
+    embedded = []
+
+    def get_query_embedding(self, query: str) -> list[float]:
+        embedded.append(query)
+        return [1.0, 0.0, 0.0, 0.0]
+
+    embed_model = shared_index.service_context.embed_model
+    monkeypatch.setattr(type(embed_model), "_get_query_embedding", get_query_embedding)
+    session = CustomLlamaIndexChatEngineWrapper(shared_index=shared_index)
+    session.add_document(embedded_document("doc-1"))
+    return session, embedded
+
+
+def test_answer_cache_lookup_embedding_is_reused_by_retrieval(tmp_path, monkeypatch):
+    session, embedded = make_session(tmp_path, monkeypatch, "hybrid")
+    question = QuestionModel(prompt="What is the text of doc-1?", temperature=0)
+    answer, store_answer = session._lookup_cached_answer(question)
+    assert answer is None and store_answer is not None
+    results = session._create_retriever().retrieve(question.prompt)
+    assert results[0].node.ref_doc_id == "doc-1"
+    assert embedded == [question.prompt]
+    assert session.query_embeddings == {}
+
+
+def test_lexical_mode_answer_cache_needs_no_embedding(tmp_path, monkeypatch):
+    session, embedded = make_session(tmp_path, monkeypatch, "lexical")
+    question = QuestionModel(prompt="What is the text of doc-1?", temperature=0)
+    answer, store_answer = session._lookup_cached_answer(question)
+    store_answer("The text of doc-1.")
+    answer, _ = session._lookup_cached_answer(question)
+    assert answer == "The text of doc-1."
+    assert session._create_retriever().retrieve(question.prompt)
+    assert embedded == []
+
+
+@pytest.mark.parametrize("metadata_mode, llm_calls", [("document", 1), ("node", 2)])
+def test_metadata_tokens_are_the_reported_usage(
+    tmp_path, monkeypatch, metadata_mode, llm_calls
+):
+    async def get_arguments(cls, model, prompts, render_kwargs=None):
+        return {
+            "description": "Hippos",
+            "category": "Science",
+            "_message": SimpleNamespace(llm_response={"usage": {"total_tokens": 42}}),
+        }
+
+    monkeypatch.setattr(AIMarvinDocument, "_get_arguments", classmethod(get_arguments))
+    monkeypatch.setattr(AITextDocument, "cfd", tmp_path)
+    monkeypatch.setattr(AITextDocument, "ingestion_cache", None)
+    monkeypatch.setattr(AITextDocument, "chunk_size", 64)
+    (tmp_path / "hippos.txt").write_text(
+        " ".join(["Hippos live in Africa."] * 20), encoding="utf-8"
+    )
+    document = AITextDocument(
+        "hippos.txt", "gpt-3.5-turbo", metadata_mode=metadata_mode
+    )
+    assert len(document.nodes) == 2
+    assert document.category == "Science"
+    assert document.metadata_llm_calls == llm_calls
+    assert document.metadata_tokens == 42 * llm_calls
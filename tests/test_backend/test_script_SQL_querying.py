@@ -1,4 +1,17 @@
+import asyncio
+import sqlite3
+
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.embeddings import FakeEmbeddings
+from langchain.utilities import SQLDatabase
+
+from backend.models import QuestionModel
+
+from backend.schema_index import SchemaIndex
+from backend.sql_examples import SQLExampleStore
 from backend.script_SQL_querying import (
+    AIDataBase,
+    count_tokens,
     set_up_database_chatbot,
 )
 
@@ -8,3 +21,177 @@ def test_set_up_chatbot():
     assert chat_engine is not None
     assert callback_manager is None
     assert token_counter is not None
+
+
+def test_schema_cached_until_database_changes(tmp_path, monkeypatch):
+    path = tmp_path / "test.sqlite"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+    # the database is changed below, which the immutable read-only engine ignores
+    database = AIDataBase.from_uri(f"sqlite:///{path}", read_only=False)
+
+    calls = []
+    get_table_info = database.get_table_info
+    monkeypatch.setattr(
+        database,
+        "get_table_info",
+        lambda *args: calls.append(1) or get_table_info(*args),
+    )
+    assert "users" in database.get_schema(None)
+    assert "users" in database.get_schema({"question": "How many users?"})
+    assert calls == []
+
+    # the sample rows change
+    with sqlite3.connect(path) as connection:
+        connection.execute("INSERT INTO users (name) VALUES ('alice')")
+    assert "alice" in database.get_schema(None)
+    assert calls == [1]
+
+
+def test_fingerprint_of_read_only_database(tmp_path):
+    path = tmp_path / "test database.sqlite"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+    stat = path.stat()
+    for read_only in (True, False):
+        database = AIDataBase.from_uri(f"sqlite:///{path}", read_only=read_only)
+        assert database._fingerprint() == (stat.st_size, stat.st_mtime_ns)
+
+
+def create_shop_database(path):
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name)")
+        connection.execute(
+            """CREATE TABLE orders (id INTEGER PRIMARY KEY, total REAL,
+            customer_id INTEGER REFERENCES customers(id))"""
+        )
+        for i in range(20):
+            connection.execute(f"CREATE TABLE log_{i} (id INTEGER, message TEXT)")
+
+
+def test_schema_index_retrieves_tables_and_neighbours(tmp_path):
+    path = tmp_path / "shop.sqlite"
+    create_shop_database(path)
+    database = SQLDatabase.from_uri(f"sqlite:///{path}")
+    index = SchemaIndex.from_database(database)
+    assert len(index) == 22
+    assert index.neighbours["customers"] == {"orders"}
+    tables = index.retrieve("What is the total of all orders?", top_k=1)
+    assert tables == ["orders", "customers"]
+
+
+def test_large_database_prompt_contains_relevant_tables(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCHEMA_RETRIEVAL", "lexical")
+    path = tmp_path / "shop.sqlite"
+    create_shop_database(path)
+    database = AIDataBase.from_uri(f"sqlite:///{path}")
+    assert database.schema_index is not None
+    assert "22 tables" in database.summary
+    schema = database.get_schema({"question": "Which customer has most orders?"})
+    assert "CREATE TABLE customers" in schema
+    assert "log_1" not in schema
+    assert (
+        0
+        < database.schema_tokens
+        < count_tokens(database.get_table_info(), AIDataBase.llm_name)
+    )
+
+
+class RecordingChatModel(FakeListChatModel):
+    """fake llm, which keeps the prompts it was called with"""
+
+    prompts: list = []
+
+    def _call(self, messages, *args, **kwargs) -> str:
+        self.prompts.append(messages[-1].content)
+        return super()._call(messages, *args, **kwargs)
+
+
+def create_users_database(path):
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.execute("INSERT INTO users (name) VALUES ('alice'), ('bob')")
+
+
+def create_database_chatbot(
+    path, monkeypatch, responses: list[str], create_database=create_users_database
+):
+    create_database(path)
+    monkeypatch.setattr(AIDataBase, "sql_examples", SQLExampleStore(None))
+    database = AIDataBase.from_uri(
+        f"sqlite:///{path}", embed_model=FakeEmbeddings(size=8)
+    )
+    llm = RecordingChatModel(responses=responses, prompts=[])
+    database.chains = database._create_chains(llm)
+    chat_engine, _, token_counter = set_up_database_chatbot()
+    chat_engine.add_document(database)
+    return chat_engine, llm
+
+
+def test_database_question_answered_with_fake_llm(tmp_path, monkeypatch):
+    chat_engine, llm = create_database_chatbot(
+        tmp_path / "users.sqlite",
+        monkeypatch,
+        ["SELECT count(*) FROM users", "There are 2 users.", "There are 2 users."],
+    )
+    question = QuestionModel(prompt="How many users are there?", temperature=0)
+    assert chat_engine.answer_question(question) == "There are 2 users."
+    assert "CREATE TABLE users" in llm.prompts[0]
+    assert "Question: How many users are there?" in llm.prompts[0]
+    assert "SQL Response: [(2,)]" in llm.prompts[1]
+
+    # the stored example answers the same question without the sql generation
+    assert list(chat_engine.stream_answer(question)) == ["There are 2 users."]
+    assert len(llm.prompts) == 3
+    assert AIDataBase.sql_examples.stats()["direct"] == 1
+
+
+def test_failing_stored_sql_falls_back_to_generation(tmp_path, monkeypatch):
+    chat_engine, llm = create_database_chatbot(
+        tmp_path / "users.sqlite",
+        monkeypatch,
+        ["SELECT count(*) FROM users", "There are 2 users."],
+    )
+    database = chat_engine.document
+    question = "How many users are there?"
+    # e.g. stored for an earlier version of the schema
+    database.sql_examples.add(
+        question, "SELECT count(*) FROM accounts", database.schema_fingerprint
+    )
+    answer = chat_engine.answer_question(QuestionModel(prompt=question, temperature=0))
+    assert answer == "There are 2 users."
+    assert len(llm.prompts) == 2
+    assert "SQL Response: [(2,)]" in llm.prompts[1]
+    assert database.sql_examples.stats()["saved_llm_calls"] == 0
+    matches, _ = database.sql_examples.search(
+        question, database.schema_fingerprint, embed=lambda _: 1 / 0
+    )
+    assert matches[0][0].sql == "SELECT count(*) FROM users"
+
+
+def test_database_question_answered_async_with_fake_llm(tmp_path, monkeypatch):
+    chat_engine, llm = create_database_chatbot(
+        tmp_path / "users.sqlite",
+        monkeypatch,
+        ["SELECT name FROM users ORDER BY name", "alice and bob"],
+    )
+    question = QuestionModel(prompt="Which users exist?", temperature=0)
+    assert asyncio.run(chat_engine.aanswer_question(question)) == "alice and bob"
+    assert "SQL Response: [('alice',), ('bob',)]" in llm.prompts[1]
+
+
+def test_large_database_question_uses_retrieved_schema(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCHEMA_RETRIEVAL", "lexical")
+    chat_engine, llm = create_database_chatbot(
+        tmp_path / "shop.sqlite",
+        monkeypatch,
+        ["SELECT count(*) FROM orders", "There are no orders."],
+        create_database=create_shop_database,
+    )
+    assert chat_engine.document.schema_index is not None
+    question = QuestionModel(prompt="How many orders are there?", temperature=0)
+    assert chat_engine.answer_question(question) == "There are no orders."
+    # get_schema got the inputs of the query generator chain
+    assert "CREATE TABLE orders" in llm.prompts[0]
+    assert "CREATE TABLE customers" in llm.prompts[0]
+    assert "log_1" not in llm.prompts[0]
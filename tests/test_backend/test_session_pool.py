@@ -0,0 +1,71 @@
+from backend.session_pool import DEFAULT_SESSION_ID, SessionPool
+
+
+class FakeChatEngine:
+    def __init__(self, size=0):
+        self.size = size
+        self.cleared = False
+        self.data_category = "database"
+
+    def clear_data_storage(self):
+        self.cleared = True
+
+    def approximate_size(self):
+        return self.size
+
+
+def test_sessions_are_separate():
+    pool = SessionPool()
+    first = pool.get("first")
+    first.set_chat_engine(FakeChatEngine(), None, object())
+    assert pool.get("first") is first
+    assert pool.get("second").chat_engine is None
+    assert pool.get(None).session_id == DEFAULT_SESSION_ID
+
+
+def test_least_recently_used_session_is_evicted():
+    pool = SessionPool(max_sessions=2)
+    engine = FakeChatEngine()
+    pool.get("a").set_chat_engine(engine, None, None)
+    pool.get("b")
+    pool.get("a")
+    pool.get("c")
+    assert "b" not in pool
+    assert "a" in pool and "c" in pool
+    assert not engine.cleared
+    pool.get("d")
+    assert "a" not in pool
+    assert engine.cleared
+    assert pool.stats()["evicted"] == 2
+
+
+def test_memory_cap_and_sessions_in_use():
+    pool = SessionPool(max_bytes=3 * 1024**2)
+    busy = pool.get("busy")
+    busy.set_chat_engine(FakeChatEngine(size=2 * 1024**2), None, None)
+    busy.acquire()
+    pool.get("idle").set_chat_engine(FakeChatEngine(size=2 * 1024**2), None, None)
+    pool.get("new")
+    # the session in use is kept, the idle one is evicted
+    assert "busy" in pool
+    assert "idle" not in pool
+    busy.release()
+    pool.get("new").set_chat_engine(FakeChatEngine(size=2 * 1024**2), None, None)
+    assert pool.evict() == ["busy"]
+
+
+def test_clear_removes_only_unshared_files(tmp_path):
+    shared_file, own_file = tmp_path / "shared.txt", tmp_path / "own.txt"
+    shared_file.write_text("shared")
+    own_file.write_text("own")
+    pool = SessionPool()
+    first, second = pool.get("first"), pool.get("second")
+    first.files.update({shared_file, own_file})
+    second.files.add(shared_file)
+    engine = FakeChatEngine()
+    first.set_chat_engine(engine, None, None)
+    pool.clear("first")
+    assert engine.cleared and first.chat_engine is None
+    assert shared_file.exists()
+    assert not own_file.exists()
+    assert "first" in pool
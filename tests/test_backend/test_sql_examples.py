@@ -0,0 +1,81 @@
+import numpy as np
+
+from backend.sql_examples import SQLExampleStore
+
+EMBEDDINGS = {
+    "How many users are there?": [1.0, 0.0, 0.0],
+    "What is the number of users?": [0.99, 0.1, 0.0],
+    "How many users wrote a review?": [0.85, 0.5, 0.0],
+    "Which product is the cheapest?": [0.0, 0.0, 1.0],
+}
+
+
+def embed(question: str) -> list[float]:
+    return EMBEDDINGS[question]
+
+
+def add(store: SQLExampleStore, question: str, sql: str, schema: str = "s1"):
+    store.add(question, sql, schema, np.asarray(embed(question)))
+
+
+def test_exact_question_needs_no_embedding(tmp_path):
+    store = SQLExampleStore(tmp_path / "examples.jsonl")
+    add(store, "How many users are there?", "SELECT count(*) FROM users")
+    matches, embedding = store.search(
+        "how many users are there", "s1", embed=lambda _: 1 / 0
+    )
+    assert [(m.sql, similarity) for m, similarity in matches] == [
+        ("SELECT count(*) FROM users", 1.0)
+    ]
+    assert embedding is None
+    # counted, once the stored sql ran
+    assert store.stats()["saved_llm_calls"] == 0
+    store.record_direct()
+    assert store.stats()["saved_llm_calls"] == 1
+
+
+def test_direct_and_few_shot_matches(tmp_path):
+    store = SQLExampleStore(
+        tmp_path / "examples.jsonl", direct_threshold=0.97, few_shot_threshold=0.8
+    )
+    add(store, "How many users are there?", "SELECT count(*) FROM users")
+    add(store, "Which product is the cheapest?", "SELECT min(price) FROM products")
+
+    matches, embedding = store.search("What is the number of users?", "s1", embed)
+    assert matches[0][0].question == "How many users are there?"
+    assert matches[0][1] >= 0.97
+    assert len(matches) == 1
+    assert embedding is not None
+
+    matches, _ = store.search("How many users wrote a review?", "s1", embed)
+    assert 0.8 <= matches[0][1] < 0.97
+    assert store.stats() | {"examples": 2} == {
+        "examples": 2,
+        "lookups": 2,
+        "direct": 0,
+        "few_shot": 1,
+        "saved_llm_calls": 0,
+    }
+
+
+def test_examples_are_separated_by_schema(tmp_path):
+    store = SQLExampleStore(tmp_path / "examples.jsonl")
+    add(store, "How many users are there?", "SELECT count(*) FROM users", "s1")
+    matches, _ = store.search("How many users are there?", "s2", embed)
+    assert matches == []
+
+
+def test_examples_are_persisted_and_compacted(tmp_path):
+    path = tmp_path / "examples.jsonl"
+    store = SQLExampleStore(path, max_entries=2)
+    for sql in ["SELECT 1", "SELECT 2", "SELECT 3"]:
+        add(store, "How many users are there?", sql)
+    add(store, "Which product is the cheapest?", "SELECT 4")
+    # four lines reached twice max_entries, the next add rewrites the file
+    add(store, "What is the number of users?", "SELECT 5")
+    assert len(path.read_text().splitlines()) == 2
+
+    loaded = SQLExampleStore(path, max_entries=2)
+    matches, _ = loaded.search("What is the number of users?", "s1", embed)
+    assert matches[0][0].sql == "SELECT 5"
+    assert len(loaded) == 2
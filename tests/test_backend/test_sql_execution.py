@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from backend.models import QueryRejectedException
+from backend.sql_execution import GuardedSQLExecutor, normalize_sql
+
+
+@pytest.fixture
+def engine(tmp_path):
+    path = tmp_path / "test.sqlite"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.execute(
+            "CREATE TABLE reviews (id INTEGER PRIMARY KEY, user_id INTEGER)"
+        )
+        connection.executemany(
+            "INSERT INTO users (name) VALUES (?)", [(f"user {i}",) for i in range(5000)]
+        )
+        connection.executemany(
+            "INSERT INTO reviews (user_id) VALUES (?)", [(i,) for i in range(5000)]
+        )
+    return create_engine(f"sqlite:///{path}")
+
+
+def test_normalize_sql():
+    assert normalize_sql("```sql\nSELECT *\n  FROM users;\n```") == (
+        "SELECT * FROM users"
+    )
+
+
+def test_rows_are_capped(engine):
+    executor = GuardedSQLExecutor(engine, max_rows=3)
+    result = executor.run("SELECT id FROM users ORDER BY id")
+    assert result.startswith("[(1,), (2,), (3,)]")
+    assert "only the first 3 rows" in result
+
+
+def test_results_are_cached_per_fingerprint(engine):
+    fingerprint = [1]
+    executor = GuardedSQLExecutor(engine, fingerprint=lambda: tuple(fingerprint))
+    assert executor.run("SELECT count(*) FROM users") == "[(5000,)]"
+    assert executor.run("SELECT count(*)\n  FROM users;") == "[(5000,)]"
+    assert executor.stats()["hits"] == 1
+    fingerprint[0] = 2
+    executor.run("SELECT count(*) FROM users")
+    assert executor.stats()["misses"] == 2
+
+
+def test_cross_join_of_large_tables_is_rejected(engine):
+    executor = GuardedSQLExecutor(engine, max_scan_rows=10**6)
+    with pytest.raises(QueryRejectedException, match="users, reviews"):
+        executor.run("SELECT count(*) FROM users u, reviews r")
+    assert (
+        executor.run("SELECT count(*) FROM reviews r JOIN users u ON u.id = r.user_id")
+        == "[(4999,)]"
+    )
+    assert executor.stats()["rejected"] == 1
+
+
+def test_slow_query_is_interrupted(engine):
+    executor = GuardedSQLExecutor(engine, timeout_seconds=0.2, max_scan_rows=10**15)
+    with pytest.raises(QueryRejectedException, match="stopped"):
+        executor.run("SELECT count(*) FROM users a, users b, users c")
+    assert executor.stats()["timeouts"] == 1
+    # the connection can be used again
+    assert executor.run("SELECT 1") == "[(1,)]"
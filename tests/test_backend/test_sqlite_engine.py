@@ -0,0 +1,47 @@
+import sqlite3
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from backend.sqlite_engine import read_only_engine, sqlite_path
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = tmp_path / "uploaded database.sqlite"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.execute("INSERT INTO users (name) VALUES ('alice')")
+    return path
+
+
+def test_sqlite_path():
+    assert str(sqlite_path("sqlite:///data/test.db")) == "data/test.db"
+    assert str(sqlite_path("sqlite:///file:/data/my%20test.db?mode=ro&uri=true")) == (
+        "/data/my test.db"
+    )
+    assert sqlite_path("sqlite://") is None
+    assert sqlite_path("sqlite:///:memory:") is None
+    assert sqlite_path("sqlite:///file::memory:?uri=true") is None
+    assert sqlite_path("postgresql://user@host/db") is None
+
+
+def test_read_only_engine(database_path):
+    engine = read_only_engine(database_path, mmap_size=2**20, cache_size_kib=1024)
+    # sqlalchemy 2 renders the url as sqlite:///file%3A...?mode=ro&uri=true
+    assert sqlite_path(engine) == database_path.resolve()
+    assert sqlite_path(engine.url) == database_path.resolve()
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT name FROM users").scalar() == "alice"
+        assert connection.exec_driver_sql("PRAGMA query_only").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA cache_size").scalar() == -1024
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql("INSERT INTO users (name) VALUES ('bob')")
+
+
+def test_engine_is_shared_per_file_version(database_path):
+    engine = read_only_engine(database_path)
+    assert read_only_engine(database_path) is engine
+    with sqlite3.connect(database_path) as connection:
+        connection.execute("INSERT INTO users (name) VALUES ('bob')")
+    assert read_only_engine(database_path) is not engine
@@ -0,0 +1,58 @@
+import numpy as np
+
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from backend.vector_store import NumpyVectorStore
+
+
+def make_nodes(embeddings, doc_id="doc"):
+    return [
+        TextNode(
+            id_=f"{doc_id}_{i}",
+            text=f"text {i}",
+            embedding=embedding.tolist(),
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+        )
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+def test_query_returns_most_similar_nodes():
+    embeddings = np.random.default_rng(0).normal(size=(50, 8))
+    store = NumpyVectorStore()
+    store.add(make_nodes(embeddings))
+    result = store.query(
+        VectorStoreQuery(query_embedding=embeddings[7].tolist(), similarity_top_k=3)
+    )
+    assert result.ids[0] == "doc_7"
+    assert len(result.ids) == 3
+    assert result.similarities == sorted(result.similarities, reverse=True)
+
+
+def test_delete_ref_doc():
+    rng = np.random.default_rng(1)
+    store = NumpyVectorStore()
+    store.add(make_nodes(rng.normal(size=(5, 4)), "doc_a"))
+    store.add(make_nodes(rng.normal(size=(5, 4)), "doc_b"))
+    store.delete("doc_a")
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1.0] * 4, similarity_top_k=10)
+    )
+    assert len(result.ids) == 5
+    assert all(node_id.startswith("doc_b") for node_id in result.ids)
+
+
+def test_persist_and_memory_mapped_load(tmp_path):
+    embeddings = np.random.default_rng(2).normal(size=(20, 8))
+    store = NumpyVectorStore()
+    store.add(make_nodes(embeddings))
+    store.persist(str(tmp_path / "vector_store.json"))
+
+    loaded = NumpyVectorStore.from_persist_dir(tmp_path)
+    assert len(loaded) == 20
+    assert isinstance(loaded._blocks[0], np.memmap)
+    result = loaded.query(
+        VectorStoreQuery(query_embedding=embeddings[3].tolist(), similarity_top_k=1)
+    )
+    assert result.ids == ["doc_3"]